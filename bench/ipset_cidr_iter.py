@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+"""
+Benchmark for ip_set.cidr_iter() in the pure-Python netsa_silk
+implementation.
+
+For each requested size, builds an ip_set of that many IPv4 addresses
+out of randomly placed, randomly sized, unaligned address ranges (so
+that each range needs several CIDR blocks), and reports how long it
+takes to walk every CIDR block in the set.
+
+Usage: ipset_cidr_iter.py [-r REPEAT] [-m MAX_RUN] [SIZE ...]
+"""
+
+import os, sys, time, random
+from optparse import OptionParser
+
+sys.path[:0] = [os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, "src"))]
+
+from netsa._netsa_silk import ip_set, IPWildcard
+
+DEFAULT_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+def make_set(size, max_run, rng):
+    """
+    Returns an ip_set of exactly *size* IPv4 addresses, made up of
+    runs of between 1 and *max_run* consecutive addresses.
+    """
+    wildcards = []
+    count = 0
+    addr = rng.randrange(0x01000000)
+    while count < size:
+        run = min(rng.randint(1, max_run), size - count)
+        wildcards.append(IPWildcard("%d-%d" % (addr, addr + run - 1)))
+        count += run
+        addr += run + rng.randint(1, max_run)
+    return ip_set(wildcards)
+
+def time_cidr_iter(s, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        blocks = 0
+        for block in s.cidr_iter():
+            blocks += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return blocks, best
+
+def main(argv):
+    parser = OptionParser(usage="%prog [-r REPEAT] [-m MAX_RUN] [SIZE ...]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="timing runs per size, best is reported")
+    parser.add_option("-m", "--max-run", type="int", default=64,
+                      help="longest run of consecutive addresses")
+    parser.add_option("--seed", type="int", default=1)
+    (options, args) = parser.parse_args(argv[1:])
+    sizes = [int(float(a)) for a in args] or DEFAULT_SIZES
+    rng = random.Random(options.seed)
+    print "%10s %10s %10s %10s %12s" % (
+        "addresses", "ranges", "blocks", "seconds", "blocks/sec")
+    for size in sizes:
+        s = make_set(size, options.max_run, rng)
+        ranges = len(list(s._range_iter()))
+        (blocks, elapsed) = time_cidr_iter(s, options.repeat)
+        print "%10d %10d %10d %10.4f %12.0f" % (
+            size, ranges, blocks, elapsed, blocks / max(elapsed, 1e-9))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+"""
+Benchmark for process launching in netsa.util.shell.
+
+Runs COUNT copies of a trivial command through run_parallel, in
+batches of BATCH pipelines at a time, and reports how many commands
+were launched (and reaped) per second.  The cost of each launch
+includes the child's descriptor cleanup before exec, which depends on
+the open file limit, so the limit can be raised or lowered with -n to
+see its effect.
+
+Usage: shell_launch.py [-r REPEAT] [-b BATCH] [-n NOFILE] [-c COMMAND] [COUNT ...]
+"""
+
+import os, sys, time
+from optparse import OptionParser
+
+sys.path[:0] = [os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, "src"))]
+
+DEFAULT_COUNTS = [100, 1000]
+
+def set_nofile(nofile):
+    import resource
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        nofile = min(nofile, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (nofile, hard))
+
+def time_launch(run_parallel, command, count, batch, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        left = count
+        while left > 0:
+            n = min(batch, left)
+            run_parallel(*([command] * n))
+            left -= n
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(argv):
+    parser = OptionParser(usage="%prog [-r REPEAT] [-b BATCH] [-n NOFILE] "
+                          "[-c COMMAND] [COUNT ...]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="timing runs per count, best is reported")
+    parser.add_option("-b", "--batch", type="int", default=10,
+                      help="pipelines per run_parallel call")
+    parser.add_option("-n", "--nofile", type="int", default=None,
+                      help="set the open file limit before launching")
+    parser.add_option("-c", "--command", default="true",
+                      help="command to launch")
+    (options, args) = parser.parse_args(argv[1:])
+    if options.nofile is not None:
+        set_nofile(options.nofile)
+    # Import after changing the limit, since MAXFD is read at import
+    from netsa.util.shell import run_parallel, MAXFD
+    counts = [int(float(a)) for a in args] or DEFAULT_COUNTS
+    print "open file limit: %d" % MAXFD
+    print "%10s %10s %10s %12s" % ("commands", "batch", "seconds", "cmds/sec")
+    for count in counts:
+        elapsed = time_launch(run_parallel, options.command, count,
+                              options.batch, options.repeat)
+        print "%10d %10d %10.4f %12.0f" % (
+            count, options.batch, elapsed, count / max(elapsed, 1e-9))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+"""
+Benchmark for loading many rows with netsa.sql.
+
+Inserts the same rows into a temporary table in three ways: by calling
+execute() once per row, by execute_many(), and by bulk_load(), and
+reports rows per second for each.  Runs against an in-memory sqlite3
+database if the nsql-sqlite3 driver is available, and against each
+database URI given on the command line.  The psycopg2 and pygresql
+drivers both handle nsql-postgres URIs, so use -d to pick which one
+to measure.
+
+Usage: sql_bulk_load.py [-n ROWS] [-r REPEAT] [-d DRIVER] [URI ...]
+"""
+
+import os, sys, time
+from optparse import OptionParser
+
+sys.path[:0] = [os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, "src"))]
+
+import netsa.sql
+from netsa.sql import db_query
+
+INSERT_SQL = db_query(
+    "insert into flows values (:addr, :sensor, :stime, :note)")
+
+COLUMNS = ["addr", "sensor", "stime", "note"]
+
+def make_rows(count):
+    return [(167772161 + i, i % 4, i * 60, "note %d" % i)
+            for i in xrange(count)]
+
+def load_execute(conn, rows):
+    for (addr, sensor, stime, note) in rows:
+        conn.execute(INSERT_SQL, addr=addr, sensor=sensor,
+                     stime=stime, note=note)
+
+def load_execute_many(conn, rows):
+    conn.execute_many(INSERT_SQL, (dict(zip(COLUMNS, row)) for row in rows))
+
+def load_bulk(conn, rows):
+    conn.bulk_load("flows", COLUMNS, rows)
+
+METHODS = [("execute", load_execute),
+           ("execute_many", load_execute_many),
+           ("bulk_load", load_bulk)]
+
+def time_load(conn, load, rows, repeat):
+    best = None
+    for i in xrange(repeat):
+        conn.execute("create temporary table flows (addr bigint, "
+                     "sensor integer, stime integer, note varchar(20))")
+        start = time.time()
+        load(conn, rows)
+        conn.commit()
+        elapsed = time.time() - start
+        conn.execute("drop table flows")
+        conn.commit()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def find_driver(name):
+    for d in netsa.sql.get_drivers():
+        if d.__class__.__module__ == "netsa.sql.driver_" + name:
+            return d
+    return None
+
+def main(argv):
+    parser = OptionParser(
+        usage="%prog [-n ROWS] [-r REPEAT] [-d DRIVER] [URI ...]")
+    parser.add_option("-n", "--rows", type="int", default=50000,
+                      help="rows loaded per timing run")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="timing runs per test, best is reported")
+    parser.add_option("-d", "--driver", default=None,
+                      help="driver module to use for the URIs "
+                      "(e.g. psycopg2 or pygresql)")
+    (options, args) = parser.parse_args(argv[1:])
+    targets = []
+    sqlite3_driver = find_driver("sqlite3")
+    if sqlite3_driver is not None:
+        targets.append(("sqlite3 :memory:", sqlite3_driver.connect(
+            "nsql-sqlite3::memory:", None, None)))
+    for uri in args:
+        if options.driver:
+            driver = find_driver(options.driver)
+            if driver is None:
+                parser.error("driver %s is not available" % options.driver)
+            targets.append((uri, driver.connect(uri, None, None)))
+        else:
+            targets.append((uri, netsa.sql.db_connect(uri)))
+    rows = make_rows(options.rows)
+    print "%-30s %-14s %14s" % ("database", "method", "rows/sec")
+    for (name, conn) in targets:
+        for (method, load) in METHODS:
+            elapsed = time_load(conn, load, rows, options.repeat)
+            print "%-30s %-14s %14.0f" % (
+                name, method, options.rows / max(elapsed, 1e-9))
+
+if __name__ == "__main__":
+    main(sys.argv)
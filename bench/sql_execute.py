@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+"""
+Benchmark for the per-execute overhead of netsa.sql.
+
+First reports how long it takes to translate a typical lookup query
+into each DB API paramstyle, both with the translation cached on the
+db_query (as normal) and with a fresh db_query each time (which
+translates on every call, as before the cache existed).
+
+Then runs the same lookup query repeatedly on a small temporary table,
+against an in-memory sqlite3 database if the nsql-sqlite3 driver is
+available and against each database URI given on the command line.
+This reports the time per execute and executes per second, again both
+with a cached db_query and with a fresh db_query for each execute.
+The psycopg2 and pygresql drivers both handle nsql-postgres URIs, so
+use -d to pick which one to measure.
+
+Usage: sql_execute.py [-n COUNT] [-r REPEAT] [-d DRIVER] [URI ...]
+"""
+
+import os, sys, time
+from optparse import OptionParser
+
+sys.path[:0] = [os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, "src"))]
+
+import netsa.sql
+from netsa.sql import db_query
+
+LOOKUP_SQL = """
+    select sensor, stime, note from lookup
+    where addr = :addr and sensor = :sensor
+      and stime >= :start and stime < :end and note <> 'n:a'
+"""
+
+PARAMS = dict(addr=167772161, sensor=3, start=0, end=86400)
+
+PARAMSTYLES = ['qmark', 'numeric', 'named', 'format', 'pyformat']
+
+def best_time(func, count, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(count)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def time_translate(paramstyle, cached, count, repeat):
+    method = "get_variant_%s_params" % paramstyle
+    query = db_query(LOOKUP_SQL)
+    def run(count):
+        for i in xrange(count):
+            if cached:
+                q = query
+            else:
+                q = db_query(LOOKUP_SQL)
+            getattr(q, method)(['postgres'], PARAMS)
+    return best_time(run, count, repeat)
+
+def setup_db(conn):
+    conn.execute("create temporary table lookup (addr integer, "
+                 "sensor integer, stime integer, note varchar(20))")
+    for i in xrange(100):
+        conn.execute("insert into lookup values (:addr, :sensor, :stime, 'x')",
+                     addr=167772161 + i, sensor=i % 4, stime=i * 60)
+
+def time_execute(conn, cached, count, repeat):
+    query = db_query(LOOKUP_SQL)
+    def run(count):
+        for i in xrange(count):
+            if cached:
+                q = query
+            else:
+                q = db_query(LOOKUP_SQL)
+            for row in conn.execute(q, **PARAMS):
+                pass
+    return best_time(run, count, repeat)
+
+def find_driver(name):
+    for d in netsa.sql.get_drivers():
+        if d.__class__.__module__ == "netsa.sql.driver_" + name:
+            return d
+    return None
+
+def main(argv):
+    parser = OptionParser(
+        usage="%prog [-n COUNT] [-r REPEAT] [-d DRIVER] [URI ...]")
+    parser.add_option("-n", "--count", type="int", default=20000,
+                      help="executes per timing run")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="timing runs per test, best is reported")
+    parser.add_option("-d", "--driver", default=None,
+                      help="driver module to use for the URIs "
+                      "(e.g. psycopg2 or pygresql)")
+    (options, args) = parser.parse_args(argv[1:])
+    print "%-10s %14s %14s" % ("paramstyle", "cached us", "uncached us")
+    for paramstyle in PARAMSTYLES:
+        cached = time_translate(paramstyle, True,
+                                options.count, options.repeat)
+        uncached = time_translate(paramstyle, False,
+                                  options.count, options.repeat)
+        print "%-10s %14.2f %14.2f" % (
+            paramstyle, cached / options.count * 1e6,
+            uncached / options.count * 1e6)
+    print
+    targets = []
+    sqlite3_driver = find_driver("sqlite3")
+    if sqlite3_driver is not None:
+        conn = sqlite3_driver.connect("nsql-sqlite3::memory:", None, None)
+        setup_db(conn)
+        targets.append(("sqlite3 :memory:", conn))
+    for uri in args:
+        if options.driver:
+            driver = find_driver(options.driver)
+            if driver is None:
+                parser.error("driver %s is not available" % options.driver)
+            conn = driver.connect(uri, None, None)
+        else:
+            conn = netsa.sql.db_connect(uri)
+        setup_db(conn)
+        targets.append((uri, conn))
+    if targets:
+        print "%-30s %-10s %14s %14s" % (
+            "database", "query", "us/execute", "executes/sec")
+    for (name, conn) in targets:
+        for cached in (True, False):
+            elapsed = time_execute(conn, cached,
+                                   options.count, options.repeat)
+            print "%-30s %-10s %14.2f %14.0f" % (
+                name, cached and "cached" or "uncached",
+                elapsed / options.count * 1e6,
+                options.count / max(elapsed, 1e-9))
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -6,9 +6,11 @@ from netsa._netsa_silk.python_impl import *
 __all__ = """
     has_IPv6Addr
     IPAddr IPv4Addr IPv6Addr
-    ip_set
-    IPWildcard
-    TCPFlags
+    parse_ip_array format_many
+    ip_set mapped_ip_set
+    ip_prefix_map
+    IPWildcard IPWildcardSet
+    TCPFlags tcpflags_filter
 
     TCP_FIN TCP_SYN TCP_RST TCP_PSH TCP_ACK TCP_URG TCP_ECE TCP_CWR
 
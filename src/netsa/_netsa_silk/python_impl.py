@@ -1,6 +1,14 @@
 # Copyright 2008-2016 by Carnegie Mellon University
 # See license information in LICENSE-OPENSOURCE.txt
 
+import array
+import bisect
+import heapq
+import itertools
+import mmap
+import re
+import socket
+import struct
 import sys
 
 def has_IPv6Addr():
@@ -15,6 +23,10 @@ def has_IPv6Addr():
 IPv4_MAX = 0xFFFFFFFF;
 IPv6_MAX = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF;
 
+# Bounds of the IPv4-mapped block (::ffff:0:0/96) in IPv6 space
+_IPv4_MAPPED_MIN = 0xFFFF00000000
+_IPv4_MAPPED_MAX = 0xFFFFFFFFFFFF
+
 def _chunk_ipv4(a):
     """
     Takes an address-like string in the form of a dot-separated IPv4
@@ -152,8 +164,16 @@ def _parse_ipv6(addr):
             "IPv6 value must be a string, integer, or IPAddr: %r" % addr)
         raise type_error
 
+# Interned addresses, see IPAddr.interned
+_intern_cache = {}
+_INTERN_CACHE_MAX = 1 << 16
+
 class IPAddr(object):
+    # Every address has an integer key in IPv6 space, _key_base |
+    # _addr, by which all addresses are ordered.  The base is a class
+    # attribute, so comparisons need no conversion between classes.
     __slots__ = []
+    _key_base = 0
     def __new__(cls, addr):
         if cls == IPAddr:
             if isinstance(addr, IPAddr):
@@ -169,6 +189,32 @@ class IPAddr(object):
                     return object.__new__(IPv6Addr)
         else:
             return object.__new__(cls)
+    @classmethod
+    def interned(cls, addr):
+        """
+        Returns an address equal to ``cls(addr)``, reusing a single
+        shared object for each distinct *addr*.  This saves both time
+        and memory when the same few addresses are created over and
+        over.  Up to 65536 addresses are kept, after which the cache
+        is emptied and starts again.
+        """
+        if isinstance(addr, IPAddr):
+            key = (cls, addr.__class__, addr._addr)
+        else:
+            key = (cls, addr)
+        try:
+            return _intern_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            type_error = TypeError(
+                "Address must be a string, integer, or IPAddr: %r" % addr)
+            raise type_error
+        result = cls(addr)
+        if len(_intern_cache) >= _INTERN_CACHE_MAX:
+            _intern_cache.clear()
+        _intern_cache[key] = result
+        return result
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, str(self))
     def __hash__(self):
@@ -178,7 +224,19 @@ class IPAddr(object):
     def __int__(self):
         raise NotImplementedError("IPAddr.__int__")
     def __cmp__(self, other):
-        raise NotImplementedError("IPAddr.__cmp__")
+        try:
+            return cmp(self._key_base | self._addr,
+                       other._key_base | other._addr)
+        except AttributeError:
+            return cmp(self.__class__, other.__class__)
+    def __lt__(self, other):
+        # Defined directly, as sorting uses only __lt__, which is
+        # much faster than falling back to __cmp__.
+        try:
+            return ((self._key_base | self._addr) <
+                    (other._key_base | other._addr))
+        except AttributeError:
+            return self.__class__ < other.__class__
     def is_ipv6(self):
         raise NotImplementedError("IPAddr.is_ipv6")
     def to_ipv4(self):
@@ -197,11 +255,71 @@ class IPAddr(object):
         raise NotImplementedError("IPAddr.mask_prefix")
 
 def _str_dotted_quad(v):
-    v = v & 0xFFFFFFFF
-    return ("%d.%d.%d.%d" % tuple((v >> (8*(3-i))) & 0xFF for i in xrange(4)))
+    return "%d.%d.%d.%d" % ((v >> 24) & 0xFF, (v >> 16) & 0xFF,
+                            (v >> 8) & 0xFF, v & 0xFF)
+
+# Matches a run of zero fields in a formatted IPv6 address which has
+# been wrapped in colons, such as ":0:0" in ":1:0:0:2:3:4:5:6:".
+_ipv6_zero_run = re.compile(r'(?::0)+(?=:)')
+
+def _str_ipv6(a):
+    """
+    Returns the canonical string form of the integer IPv6 address *a*.
+    """
+    # special case 0, 1, and IPv4 mappings
+    if a < 0x100000000:
+        if a == 0:
+            return "::"
+        elif a == 1:
+            return "::1"        # localhost
+        return "::" + _str_dotted_quad(a)
+    elif a >= 0xFFFF00000000 and a <= 0xFFFFFFFFFFFF:
+        return "::ffff:" + _str_dotted_quad(a)
+    # otherwise, format all eight fields at once and compress the
+    # first of the longest runs of zero fields (if longer than one)
+    s = ":%x:%x:%x:%x:%x:%x:%x:%x:" % (
+        a >> 112, (a >> 96) & 0xFFFF, (a >> 80) & 0xFFFF,
+        (a >> 64) & 0xFFFF, (a >> 48) & 0xFFFF, (a >> 32) & 0xFFFF,
+        (a >> 16) & 0xFFFF, a & 0xFFFF)
+    if ':0:0:' not in s:
+        return s[1:-1]
+    (start, end) = (0, 0)
+    for m in _ipv6_zero_run.finditer(s):
+        if m.end() - m.start() > end - start:
+            (start, end) = m.span()
+    return s[1:start] + "::" + s[end + 1:-1]
+
+def _str_ipv6_padded(a):
+    """
+    Returns the fully zero-padded string form of the integer IPv6
+    address *a*.
+    """
+    return "%04x:%04x:%04x:%04x:%04x:%04x:%04x:%04x" % (
+        a >> 112, (a >> 96) & 0xFFFF, (a >> 80) & 0xFFFF,
+        (a >> 64) & 0xFFFF, (a >> 48) & 0xFFFF, (a >> 32) & 0xFFFF,
+        (a >> 16) & 0xFFFF, a & 0xFFFF)
+
+def _new_ipv4(a):
+    """
+    Returns a new IPv4Addr for the integer *a*, which must be a valid
+    IPv4 address value.  This skips argument parsing.
+    """
+    result = object.__new__(IPv4Addr)
+    result._addr = a
+    return result
+
+def _new_ipv6(a):
+    """
+    Returns a new IPv6Addr for the integer *a*, which must be a valid
+    IPv6 address value.  This skips argument parsing.
+    """
+    result = object.__new__(IPv6Addr)
+    result._addr = a
+    return result
 
 class IPv4Addr(IPAddr):
     __slots__ = ['_addr']
+    _key_base = _IPv4_MAPPED_MIN
     def __init__(self, addr):
         if isinstance(addr, IPAddr):
             a = addr.to_ipv4()
@@ -218,29 +336,25 @@ class IPv4Addr(IPAddr):
         return bool(self._addr)
     def __int__(self):
         return self._addr
-    def __cmp__(self, other):
-        if not isinstance(other, IPAddr):
-            return cmp(self.__class__, other.__class__)
-        if other.is_ipv6():
-            self = self.to_ipv6()
-        return cmp(self._addr, other._addr)
     def is_ipv6(self):
         return False
     def to_ipv4(self):
         return self
     def to_ipv6(self):
-        return IPv6Addr(0xFFFF00000000 | (self._addr & 0xFFFFFFFF))
+        return _new_ipv6(_IPv4_MAPPED_MIN | self._addr)
     def __str__(self):
         return _str_dotted_quad(self._addr)
     def padded(self):
-        return ('%03d.%03d.%03d.%03d' % self.octets())
+        a = self._addr
+        return '%03d.%03d.%03d.%03d' % ((a >> 24) & 0xFF, (a >> 16) & 0xFF,
+                                        (a >> 8) & 0xFF, a & 0xFF)
     def octets(self):
         a = self._addr
         return tuple((a >> (8*(3-i))) & 0xFF for i in xrange(4))
     def mask(self, mask):
-        return IPv4Addr(self._addr & int(mask))
+        return _new_ipv4(self._addr & int(mask))
     def mask_prefix(self, len):
-        return IPv4Addr(self._addr & (IPv4_MAX << (32-len)) & IPv4_MAX)
+        return _new_ipv4(self._addr & (IPv4_MAX << (32-len)) & IPv4_MAX)
 
 class IPv6Addr(IPAddr):
     __slots__ = ['_addr']
@@ -256,52 +370,18 @@ class IPv6Addr(IPAddr):
         return bool(self._addr)
     def __int__(self):
         return self._addr
-    def __cmp__(self, other):
-        if not isinstance(other, IPAddr):
-            return cmp(self.__class__, other.__class__)
-        if not other.is_ipv6():
-            other = other.to_ipv6()
-        return cmp(self._addr, other._addr)
     def is_ipv6(self):
         return True
     def to_ipv4(self):
         if self._addr >= 0xFFFF00000000 and self._addr <= 0xFFFFFFFFFFFF:
-            return IPv4Addr(self._addr & 0xFFFFFFFF)
+            return _new_ipv4(self._addr & 0xFFFFFFFF)
         return None
     def to_ipv6(self):
         return self
     def __str__(self):
-        # special case 0, 1, and IPv4 mappings
-        if self._addr == 0:
-            return "::"
-        elif self._addr == 1:
-            return "::1"        # localhost
-        elif self._addr < 0x100000000:
-            return "::" + _str_dotted_quad(self._addr)
-        elif self._addr >= 0xFFFF00000000 and self._addr <= 0xFFFFFFFFFFFF:
-            return "::ffff:" + _str_dotted_quad(self._addr)
-        # otherwise, normal procedure
-        shorts = self._shorts()
-        max_len = 0
-        max_start = 0
-        cur_len = 0
-        cur_start = 0
-        for i in xrange(8):
-            if shorts[i] == 0:
-                cur_len += 1
-            if cur_len > max_len:
-                max_len = cur_len
-                max_start = cur_start
-            if shorts[i] != 0:
-                cur_len = 0
-                cur_start = i + 1
-        if max_len > 1:
-            return (':'.join('%x' % q for q in shorts[:max_start]) + '::' +
-                    ':'.join('%x' % q for q in shorts[max_start+max_len:]))
-        else:
-            return (':'.join('%x' % q for q in shorts))
+        return _str_ipv6(self._addr)
     def padded(self):
-        return ("%04x:%04x:%04x:%04x:%04x:%04x:%04x:%04x" % self._shorts())
+        return _str_ipv6_padded(self._addr)
     def octets(self):
         a = self._addr
         return tuple((a >> (8*(15-i))) & 0xFF for i in xrange(16))
@@ -309,9 +389,228 @@ class IPv6Addr(IPAddr):
         a = self._addr
         return tuple((a >> (16*(7-i))) & 0xFFFF for i in xrange(8))
     def mask(self, mask):
-        return IPv6Addr(self._addr & int(mask.to_ipv6()))
+        return _new_ipv6(self._addr & _ipv6_int(mask))
     def mask_prefix(self, len):
-        return IPv6Addr(self._addr & (IPv6_MAX << (128-len)) & IPv6_MAX)
+        return _new_ipv6(self._addr & (IPv6_MAX << (128-len)) & IPv6_MAX)
+
+# Bulk address parsing.  When the platform provides inet_pton, it is
+# used as a fast path: it accepts only canonical address strings, all
+# of which the parsers above agree with, and anything it rejects is
+# handed to the full parser so that the results are always the same
+# as for IPAddr.
+
+_inet_pton = getattr(socket, 'inet_pton', None)
+
+if array.array('I').itemsize == 4:
+    _UINT32_CODE = 'I'
+else:
+    _UINT32_CODE = 'L'
+
+def _parse_ip_list(addrs):
+    """
+    Parses a list of stripped address strings one at a time.  Returns
+    a list of integer values and a list of IPv6 flags.
+    """
+    values = []
+    flags = []
+    unpack = struct.unpack
+    for a in addrs:
+        if _inet_pton is not None:
+            try:
+                values.append(unpack('>I', _inet_pton(socket.AF_INET, a))[0])
+                flags.append(0)
+                continue
+            except (socket.error, TypeError, ValueError):
+                pass
+            if ':' in a:
+                try:
+                    (hi, lo) = unpack('>QQ', _inet_pton(socket.AF_INET6, a))
+                    values.append((hi << 64) | lo)
+                    flags.append(1)
+                    continue
+                except (socket.error, TypeError, ValueError):
+                    pass
+        addr = IPAddr(a)
+        values.append(addr._addr)
+        flags.append(int(addr.is_ipv6()))
+    return values, flags
+
+def parse_ip_array(addrs, numpy=False):
+    """
+    Parses every address string in *addrs* (a list, a file, or any
+    other iterable of strings) and returns a pair ``(values,
+    is_ipv6)``, where *values* holds the integer value of each
+    address and *is_ipv6* holds a 1 for each IPv6 address and a 0 for
+    each IPv4 address.  Surrounding whitespace (such as the newline
+    at the end of a line read from a file) is ignored.
+
+    If every address is IPv4, *values* is an unsigned 32-bit
+    :class:`array.array`.  Otherwise, since no compact array type
+    holds 128-bit values, *values* is a list of integers.  *is_ipv6*
+    is always an :class:`array.array` of bytes.
+
+    If *numpy* is ``True``, the results are NumPy arrays instead: a
+    ``uint32`` array (or an ``object`` array if any address is IPv6)
+    and a ``bool`` array.
+
+    Raises :exc:`ValueError` for the first string that
+    :class:`IPAddr` would not accept.
+    """
+    try:
+        addrs = [a.strip() for a in addrs]
+    except AttributeError:
+        type_error = TypeError(
+            "parse_ip_array values must be strings: %r" % addrs)
+        raise type_error
+    values = None
+    if _inet_pton is not None:
+        # Fast path: every address is a canonical dotted quad
+        try:
+            packed = ''.join([_inet_pton(socket.AF_INET, a) for a in addrs])
+            values = array.array(_UINT32_CODE)
+            values.fromstring(packed)
+            if sys.byteorder == 'little':
+                values.byteswap()
+            flags = array.array('B', [0]) * len(addrs)
+        except (socket.error, TypeError, ValueError):
+            values = None
+    if values is None:
+        (values, flags) = _parse_ip_list(addrs)
+        if any(flags):
+            flags = array.array('B', flags)
+        else:
+            values = array.array(_UINT32_CODE, values)
+            flags = array.array('B', flags)
+    if numpy:
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError(
+                "NumPy output from parse_ip_array requires NumPy.")
+        if isinstance(values, array.array):
+            values = np.asarray(values, dtype=np.uint32)
+        else:
+            values = np.array(values, dtype=object)
+        flags = np.asarray(flags, dtype=bool)
+    return values, flags
+
+# Bulk address formatting.  Each style is a function of an integer
+# address value and an IPv6 flag.
+
+def _format_canonical(a, is_ipv6):
+    if is_ipv6:
+        return _str_ipv6(a)
+    return _str_dotted_quad(a)
+
+def _format_padded(a, is_ipv6):
+    if is_ipv6:
+        return _str_ipv6_padded(a)
+    return '%03d.%03d.%03d.%03d' % ((a >> 24) & 0xFF, (a >> 16) & 0xFF,
+                                    (a >> 8) & 0xFF, a & 0xFF)
+
+def _format_ipv6(a, is_ipv6):
+    if is_ipv6:
+        return _str_ipv6(a)
+    return "::ffff:" + _str_dotted_quad(a)
+
+def _format_decimal(a, is_ipv6):
+    return '%d' % a
+
+_format_styles = {
+    'canonical': _format_canonical,
+    'padded': _format_padded,
+    'ipv6': _format_ipv6,
+    'decimal': _format_decimal,
+}
+
+# Number of formatted addresses remembered by format_many
+_FORMAT_CACHE_MAX = 4096
+
+# Number of lines format_many joins into each write
+_FORMAT_WRITE_CHUNK = 1024
+
+def _format_iter(addrs, formatter, is_ipv6):
+    if is_ipv6 is None:
+        pairs = ((a._addr, a.is_ipv6()) for a in
+                 (a if isinstance(a, IPAddr) else IPAddr(a) for a in addrs))
+    elif isinstance(is_ipv6, (bool, int, long)):
+        pairs = itertools.izip(addrs, itertools.repeat(bool(is_ipv6)))
+    else:
+        pairs = itertools.izip(addrs, is_ipv6)
+    # Repeated addresses are formatted once.  The cache is keyed by
+    # value for IPv6 addresses and by the (negative) complement of
+    # the value for IPv4 addresses, so the two never collide.
+    cache = {}
+    get = cache.get
+    for (a, v6) in pairs:
+        if v6:
+            key = a
+        else:
+            key = ~a
+        s = get(key)
+        if s is None:
+            s = formatter(a, v6)
+            if len(cache) >= _FORMAT_CACHE_MAX:
+                cache.clear()
+            cache[key] = s
+        yield s
+
+def format_many(addrs, style='canonical', out=None, is_ipv6=None):
+    """
+    Formats each of the addresses in *addrs* as a string.  *style* is
+    one of:
+
+    ``'canonical'``
+        the same as ``str(addr)``
+    ``'padded'``
+        the same as ``addr.padded()``
+    ``'ipv6'``
+        like ``'canonical'``, but IPv4 addresses are written as
+        IPv4-mapped IPv6 addresses (``::ffff:1.2.3.4``)
+    ``'decimal'``
+        the integer value of the address
+
+    If *is_ipv6* is ``None``, *addrs* contains :class:`IPAddr` objects
+    or strings which can be parsed as addresses.  Otherwise *addrs*
+    contains integer address values, as returned by
+    :func:`parse_ip_array`, and *is_ipv6* is either a single boolean
+    for all of them or a sequence of flags, one for each.
+
+    If *out* is ``None``, returns an iterator of the formatted
+    strings.  Otherwise *out* is a file object, and each string is
+    written to it followed by a newline.
+    """
+    try:
+        formatter = _format_styles[style]
+    except KeyError:
+        value_error = ValueError("Unknown address style: %r" % style)
+        raise value_error
+    strings = _format_iter(addrs, formatter, is_ipv6)
+    if out is None:
+        return strings
+    write = out.write
+    while True:
+        chunk = list(itertools.islice(strings, _FORMAT_WRITE_CHUNK))
+        if not chunk:
+            break
+        chunk.append('')
+        write('\n'.join(chunk))
+
+def _ipv6_int(addr):
+    """
+    Returns the integer value of the IPAddr *addr* in IPv6 space,
+    without creating an intermediate IPv6Addr.
+    """
+    return addr._key_base | addr._addr
+
+def _ip_int(addr):
+    """
+    Returns the integer value in IPv6 space of *addr*, an IPAddr or
+    a parsable IPAddr string.
+    """
+    if isinstance(addr, IPAddr):
+        return addr._key_base | addr._addr
+    return _ip_conv(addr)._addr
 
 def _ip_conv(addr):
     if isinstance(addr, IPAddr):
@@ -325,101 +624,434 @@ def _ip_conv(addr):
         "Addr must be an IPAddr or parsable IPAddr string: %r" % addr)
     raise type_error
 
-def _ip_iter(iterable):
-    if isinstance(iterable, ip_set):
-        for v in iterable._content:
-            yield v
-    else:
-        for v in iterable:
-            if isinstance(v, IPAddr):
-                yield v.to_ipv6()
-                continue
-            if isinstance(v, IPWildcard):
-                for addr in v:
-                    yield addr.to_ipv6()
-                continue
-            if isinstance(v, basestring):
-                try:
-                    yield IPAddr(v).to_ipv6()
-                    continue
-                except ValueError:
-                    for addr in IPWildcard(v):
-                        yield addr.to_ipv6()
-                    continue
-            type_error = TypeError(
-                "iterables must contain IPAddr, IPWildcard, or parsable "
-                "strings: %r" % v)
-            raise type_error
+# Address ranges are handled throughout as sorted lists of closed
+# integer intervals (lo, hi) in IPv6 space, with IPv4 addresses mapped
+# into ::ffff:0:0/96.  A list is "coalesced" when no two of its
+# intervals overlap or are adjacent, which makes it a canonical form.
+
+def _ranges_coalesce(ranges):
+    """
+    Given an iterable of (lo, hi) pairs sorted by lo, returns a
+    coalesced list covering the same values.
+    """
+    result = []
+    cur_lo = cur_hi = None
+    for (lo, hi) in ranges:
+        if cur_hi is not None and lo <= cur_hi + 1:
+            if hi > cur_hi:
+                cur_hi = hi
+        else:
+            if cur_hi is not None:
+                result.append((cur_lo, cur_hi))
+            (cur_lo, cur_hi) = (lo, hi)
+    if cur_hi is not None:
+        result.append((cur_lo, cur_hi))
+    return result
 
-def _ip_iters(iterables):
-    for iterable in iterables:
-        for addr in _ip_iter(iterable):
-            yield addr
-
-def _ip_iters_check(iterables, s):
-    addrs = _ip_iters(iterables)
-    if not s._contains_ipv6:
-        while True:
-            addr = addrs.next()
-            yield addr
-            if addr._addr < 0xFFFF00000000 or addr._addr > 0xFFFFFFFFFFFF:
-                s._contains_ipv6 = True
+def _ranges_union(*range_lists):
+    """
+    Returns the coalesced union of several coalesced range lists.
+    """
+    return _ranges_coalesce(heapq.merge(*range_lists))
+
+def _ranges_intersection(xs, ys):
+    """
+    Returns the coalesced intersection of two coalesced range lists.
+    """
+    result = []
+    (i, j) = (0, 0)
+    (nx, ny) = (len(xs), len(ys))
+    while i < nx and j < ny:
+        (xlo, xhi) = xs[i]
+        (ylo, yhi) = ys[j]
+        lo = max(xlo, ylo)
+        hi = min(xhi, yhi)
+        if lo <= hi:
+            result.append((lo, hi))
+        if xhi < yhi:
+            i += 1
+        else:
+            j += 1
+    return result
+
+def _ranges_difference(xs, ys):
+    """
+    Returns the coalesced list of values in the coalesced range list
+    *xs* which are not in the coalesced range list *ys*.
+    """
+    result = []
+    j = 0
+    ny = len(ys)
+    for (lo, hi) in xs:
+        while j < ny and ys[j][1] < lo:
+            j += 1
+        while j < ny and ys[j][0] <= hi:
+            (ylo, yhi) = ys[j]
+            if ylo > lo:
+                result.append((lo, ylo - 1))
+            if yhi >= hi:
+                lo = hi + 1
                 break
-    while True:
-        yield addrs.next()
+            lo = yhi + 1
+            j += 1
+        if lo <= hi:
+            result.append((lo, hi))
+    return result
+
+def _ranges_symmetric_difference(xs, ys):
+    """
+    Returns the coalesced list of values in exactly one of the two
+    coalesced range lists *xs* and *ys*.
+    """
+    return _ranges_union(_ranges_difference(xs, ys),
+                         _ranges_difference(ys, xs))
+
+if hasattr(0, 'bit_length'):
+    def _bit_length(n):
+        return n.bit_length()
+else:
+    # int.bit_length is new in Python 2.7
+    def _bit_length(n):
+        """
+        Returns the number of bits needed to represent the
+        non-negative integer *n*.
+        """
+        if not n:
+            return 0
+        return len(bin(n)) - 2
+
+def _cidr_blocks(lo, hi, bits):
+    """
+    Yields ``(prefix, prefix_len)`` pairs for the smallest list of CIDR
+    blocks exactly covering the closed interval [*lo*, *hi*] in a
+    *bits*-bit address space, in ascending order.  Each block is found
+    directly from the alignment of its first address and the number
+    of addresses remaining, so the cost is proportional to the number
+    of blocks produced.
+    """
+    while lo <= hi:
+        if lo:
+            # Largest block that is aligned at lo
+            size_bits = _bit_length(lo & -lo) - 1
+        else:
+            size_bits = bits
+        # Largest block that fits in what is left of the interval
+        fit_bits = _bit_length(hi - lo + 1) - 1
+        if fit_bits < size_bits:
+            size_bits = fit_bits
+        yield (lo, bits - size_bits)
+        lo += 1 << size_bits
+
+def _ranges_has_ipv6(ranges):
+    """
+    Returns ``True`` if the sorted range list *ranges* contains any
+    value outside of the IPv4-mapped block.
+    """
+    return bool(ranges) and (ranges[0][0] < _IPv4_MAPPED_MIN or
+                             ranges[-1][1] > _IPv4_MAPPED_MAX)
+
+def _ip_ranges(iterable):
+    """
+    Returns a coalesced range list of all the addresses in an
+    ip_set, an IPWildcard, or an iterable of IPAddr objects,
+    IPWildcard objects, or strings parsable as either.
+    """
+    if isinstance(iterable, ip_set):
+        return iterable._ranges
+    if isinstance(iterable, IPWildcard):
+        return iterable._ranges()
+    ranges = []
+    append = ranges.append
+    for v in iterable:
+        if isinstance(v, IPAddr):
+            a = v._key_base | v._addr
+            append((a, a))
+            continue
+        if isinstance(v, IPWildcard):
+            ranges.extend(v._ranges())
+            continue
+        if isinstance(v, basestring):
+            try:
+                a = _ipv6_int(IPAddr(v))
+                append((a, a))
+            except ValueError:
+                ranges.extend(IPWildcard(v)._ranges())
+            continue
+        type_error = TypeError(
+            "iterables must contain IPAddr, IPWildcard, or parsable "
+            "strings: %r" % v)
+        raise type_error
+    ranges.sort()
+    return _ranges_coalesce(ranges)
+
+# Streaming n-way set operations.  Each source is turned into an
+# iterator of coalesced ranges without being read into memory, and the
+# sources are merged by sweeping over the start and end points of all
+# of their ranges at once, counting how many sources cover each point.
 
-ip_iters_check = _ip_iters_check
+def _ranges_coalesce_iter(ranges):
+    """
+    Like :func:`_ranges_coalesce`, but yields the coalesced ranges one
+    at a time instead of building a list.
+    """
+    cur_lo = cur_hi = None
+    for (lo, hi) in ranges:
+        if cur_hi is not None and lo <= cur_hi + 1:
+            if hi > cur_hi:
+                cur_hi = hi
+        else:
+            if cur_hi is not None:
+                yield (cur_lo, cur_hi)
+            (cur_lo, cur_hi) = (lo, hi)
+    if cur_hi is not None:
+        yield (cur_lo, cur_hi)
+
+def _ranges_at_least(k, range_iters):
+    """
+    Yields the ranges of values covered by at least *k* of the
+    coalesced range iterators in *range_iters*.  Adjacent ranges may
+    be yielded separately.
+    """
+    def events(ranges):
+        for (lo, hi) in ranges:
+            yield (lo, 1)
+            yield (hi + 1, -1)
+    count = 0
+    start = None
+    # At any one point, ends (-1) sort before starts (+1)
+    for (a, delta) in heapq.merge(*[events(r) for r in range_iters]):
+        count += delta
+        if count == k and delta > 0:
+            start = a
+        elif count == k - 1 and delta < 0:
+            yield (start, a - 1)
+
+def _ip_sorted_ranges(source, seen_ipv6):
+    """
+    Yields ``(lo, hi)`` for each element of *source*, an iterable of
+    IPAddr objects, address strings, or ``(low, high)`` pairs of
+    those, which must be in order.  Sets ``seen_ipv6[0]`` when an
+    IPv6 address is seen.
+    """
+    prev = None
+    for v in source:
+        if isinstance(v, tuple) and len(v) == 2:
+            (lo, hi) = (_ip_addr(v[0]), _ip_addr(v[1]))
+        else:
+            lo = hi = _ip_addr(v)
+        if lo.is_ipv6() or hi.is_ipv6():
+            seen_ipv6[0] = True
+        (lo, hi) = (_ipv6_int(lo), _ipv6_int(hi))
+        if lo > hi or (prev is not None and lo < prev):
+            value_error = ValueError(
+                "Streamed addresses must be in sorted order: %r" % (v,))
+            raise value_error
+        prev = lo
+        yield (lo, hi)
+
+def _ip_addr(v):
+    if isinstance(v, IPAddr):
+        return v
+    if isinstance(v, basestring):
+        return IPAddr(v)
+    type_error = TypeError(
+        "Addr must be an IPAddr or parsable IPAddr string: %r" % (v,))
+    raise type_error
+
+def _ip_range_stream(source, seen_ipv6):
+    """
+    Returns an iterator of coalesced ranges for *source*, which is an
+    ip_set, mapped_ip_set, IPWildcard, or sorted iterable as accepted
+    by :func:`_ip_sorted_ranges`.  Sets ``seen_ipv6[0]`` if *source*
+    contains IPv6 addresses.
+    """
+    if isinstance(source, ip_set):
+        if source._contains_ipv6:
+            seen_ipv6[0] = True
+        return iter(source._ranges)
+    if isinstance(source, mapped_ip_set):
+        if source._is_ipv6:
+            seen_ipv6[0] = True
+        return source._range_iter()
+    if isinstance(source, IPWildcard):
+        if source.is_ipv6():
+            seen_ipv6[0] = True
+        return iter(source._ranges())
+    return _ranges_coalesce_iter(_ip_sorted_ranges(source, seen_ipv6))
+
+# ip_set files begin with a 16-byte header: the magic string "NSIPSET",
+# a format version byte, a flags byte, three zero bytes, and a 32-bit
+# count of ranges.  The ranges follow in order as (lo, hi) pairs, as
+# 32-bit IPv4 values unless the IPv6 flag is set, in which case they
+# are 128-bit IPv6 values.  All values are big-endian.
+_IPSET_MAGIC = 'NSIPSET'
+_IPSET_VERSION = 1
+_IPSET_FLAG_IPV6 = 0x01
+_IPSET_HEADER = '>7sBB3xI'
+_IPSET_HEADER_LEN = struct.calcsize(_IPSET_HEADER)
+_IPSET_CHUNK = 8192
+
+def _ipset_file_header(data, path):
+    """
+    Parses an ip_set file header from the start of *data*, returning
+    ``(is_ipv6, count, record_len)``.
+    """
+    if len(data) >= _IPSET_HEADER_LEN:
+        (magic, version, flags, count) = struct.unpack(
+            _IPSET_HEADER, data[:_IPSET_HEADER_LEN])
+        if (magic == _IPSET_MAGIC and version == _IPSET_VERSION and
+                not flags & ~_IPSET_FLAG_IPV6):
+            if flags & _IPSET_FLAG_IPV6:
+                record_len = 32
+            else:
+                record_len = 8
+            if len(data) == _IPSET_HEADER_LEN + count * record_len:
+                return (bool(flags & _IPSET_FLAG_IPV6), count, record_len)
+    value_error = ValueError("Not a valid ip_set file: %r" % (path,))
+    raise value_error
+
+def _ipset_file_write(f, ranges, is_ipv6):
+    """
+    Writes the coalesced range list *ranges* to the file *f* in ip_set
+    file format.
+    """
+    if is_ipv6:
+        flags = _IPSET_FLAG_IPV6
+    else:
+        flags = 0
+    f.write(struct.pack(_IPSET_HEADER, _IPSET_MAGIC, _IPSET_VERSION,
+                        flags, len(ranges)))
+    for i in xrange(0, len(ranges), _IPSET_CHUNK):
+        chunk = ranges[i:i + _IPSET_CHUNK]
+        if is_ipv6:
+            values = []
+            for r in chunk:
+                for v in r:
+                    values.append(v >> 64)
+                    values.append(v & 0xFFFFFFFFFFFFFFFF)
+            f.write(struct.pack('>%dQ' % len(values), *values))
+        else:
+            values = array.array(_UINT32_CODE,
+                                 [v - _IPv4_MAPPED_MIN
+                                  for r in chunk for v in r])
+            if sys.byteorder == 'little':
+                values.byteswap()
+            f.write(values.tostring())
+
+def _ipset_file_read(data, path):
+    """
+    Returns ``(ranges, is_ipv6)`` from the contents *data* of an
+    ip_set file.
+    """
+    (is_ipv6, count, record_len) = _ipset_file_header(data, path)
+    body = data[_IPSET_HEADER_LEN:]
+    if is_ipv6:
+        values = struct.unpack('>%dQ' % (count * 4), body)
+        values = [(values[i] << 64) | values[i + 1]
+                  for i in xrange(0, len(values), 2)]
+    else:
+        values = array.array(_UINT32_CODE, body)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        values = [_IPv4_MAPPED_MIN + v for v in values]
+    ranges = []
+    prev = -2
+    for i in xrange(0, len(values), 2):
+        (lo, hi) = (values[i], values[i + 1])
+        if not prev + 1 < lo <= hi:
+            value_error = ValueError(
+                "Not a valid ip_set file: %r" % (path,))
+            raise value_error
+        ranges.append((lo, hi))
+        prev = hi
+    return (ranges, is_ipv6)
 
 class ip_set(object):
-    __slots__ = ['_content', '_contains_ipv6']
+    # _ranges is a coalesced range list (see _ranges_coalesce above)
+    __slots__ = ['_ranges', '_contains_ipv6']
     def __init__(self, iterable=None):
-        self._content = set()
+        self._ranges = []
         self._contains_ipv6 = False
         if iterable:
             self.update(iterable)
+    @classmethod
+    def from_strings(class_, addrs):
+        """
+        Returns a new set containing every address in *addrs*, a
+        list, file, or other iterable of IP address strings.  This is
+        much faster than passing the strings to the constructor, but
+        does not accept wildcard strings.  See :func:`parse_ip_array`.
+        """
+        (values, flags) = parse_ip_array(addrs)
+        if isinstance(values, array.array):
+            values = [_IPv4_MAPPED_MIN + v for v in values]
+        else:
+            values = [v if f else _IPv4_MAPPED_MIN + v
+                      for (v, f) in itertools.izip(values, flags)]
+        values.sort()
+        result = class_()
+        result._ranges = _ranges_coalesce((v, v) for v in values)
+        result._contains_ipv6 = _ranges_has_ipv6(result._ranges)
+        return result
+    def _out_addr(self, a):
+        if self._contains_ipv6:
+            return _new_ipv6(a)
+        else:
+            return _new_ipv4(a & IPv4_MAX)
+    def _find(self, a):
+        """
+        Returns the index of the range that would contain the integer
+        address *a*: the last range starting at or before *a*, or -1.
+        """
+        return bisect.bisect_right(self._ranges, (a, IPv6_MAX)) - 1
     def cardinality(self):
-        return len(self._content)
+        count = 0
+        for (lo, hi) in self._ranges:
+            count += hi - lo + 1
+        return count
     def __len__(self):
         return self.cardinality()
     def __contains__(self, addr):
-        return _ip_conv(addr) in self._content
+        a = _ip_int(addr)
+        i = self._find(a)
+        return i >= 0 and a <= self._ranges[i][1]
     def __iter__(self):
-        if self._contains_ipv6:
-            for addr in self._content:
-                yield addr
-        else:
-            for addr in self._content:
-                yield addr.to_ipv4()
+        out_addr = self._out_addr
+        for (lo, hi) in self._ranges:
+            a = lo
+            while a <= hi:
+                yield out_addr(a)
+                a += 1
     def __eq__(self, s2):
         if not isinstance(s2, ip_set):
             return False
-        return (self._content == s2._content)
+        return (self._ranges == s2._ranges)
     def __ne__(self, s2):
         if not isinstance(s2, ip_set):
             return True
-        return (self._content != s2._content)
+        return (self._ranges != s2._ranges)
     def isdisjoint(self, iterable):
-        return self._content.isdisjoint(_ip_iter(iterable))
+        return not _ranges_intersection(self._ranges, _ip_ranges(iterable))
     def issubset(self, iterable):
-        return self._content.issubset(_ip_iter(iterable))
+        return not _ranges_difference(self._ranges, _ip_ranges(iterable))
     def __le__(self, s2):
         if not isinstance(s2, ip_set):
             raise TypeError("can only compare to an ip_set")
-        return self._content <= s2._content
+        return self.issubset(s2)
     def __lt__(self, s2):
         if not isinstance(s2, ip_set):
             raise TypeError("can only compare to an ip_set")
-        return self._content < s2._content
+        return self.issubset(s2) and self._ranges != s2._ranges
     def issuperset(self, iterable):
-        return self._content.issuperset(_ip_iter(iterable))
+        return not _ranges_difference(_ip_ranges(iterable), self._ranges)
     def __ge__(self, s2):
         if not isinstance(s2, ip_set):
             raise TypeError("can only compare to an ip_set")
-        return self._content >= s2._content
+        return self.issuperset(s2)
     def __gt__(self, s2):
         if not isinstance(s2, ip_set):
             raise TypeError("can only compare to an ip_set")
-        return self._content > s2._content
+        return self.issuperset(s2) and self._ranges != s2._ranges
     def union(self, *iterables):
         result = self.copy()
         result.update(*iterables)
@@ -448,94 +1080,191 @@ class ip_set(object):
     def __xor__(self, s2):
         if not isinstance(s2, ip_set): return NotImplemented
         return self.symmetric_difference(s2)
+    @classmethod
+    def count_at_least(class_, k, *sources):
+        """
+        Returns a new set of the addresses which appear in at least
+        *k* of the *sources*.  The sources are read in a single pass,
+        without being read into memory, so this works well for many
+        large inputs.  Each source may be an :class:`ip_set`, a
+        :class:`mapped_ip_set`, an :class:`IPWildcard`, or an
+        iterable of addresses, address strings, or ``(low, high)``
+        pairs of either, in sorted order.
+        """
+        if not isinstance(k, (int, long)) or k < 1:
+            value_error = ValueError(
+                "count_at_least requires a positive count: %r" % (k,))
+            raise value_error
+        seen_ipv6 = [False]
+        range_iters = [_ip_range_stream(source, seen_ipv6)
+                       for source in sources]
+        result = class_()
+        if k <= len(range_iters):
+            result._ranges = _ranges_coalesce(
+                _ranges_at_least(k, range_iters))
+        result._contains_ipv6 = seen_ipv6[0]
+        return result
+    @classmethod
+    def union_of(class_, *sources):
+        """
+        Returns a new set of the addresses which appear in any of the
+        *sources*, read as by :meth:`count_at_least`.
+        """
+        return class_.count_at_least(1, *sources)
+    @classmethod
+    def intersection_of(class_, *sources):
+        """
+        Returns a new set of the addresses which appear in all of the
+        *sources*, read as by :meth:`count_at_least`.
+        """
+        if not sources:
+            return class_()
+        return class_.count_at_least(len(sources), *sources)
     def copy(self):
-        return self.__class__(self)
+        result = self.__class__()
+        result._ranges = list(self._ranges)
+        result._contains_ipv6 = self._contains_ipv6
+        return result
     def update(self, *iterables):
-        self._content.update(_ip_iters_check(iterables, self))
+        range_lists = [_ip_ranges(iterable) for iterable in iterables]
+        for ranges in range_lists:
+            if _ranges_has_ipv6(ranges):
+                self._contains_ipv6 = True
+        self._ranges = _ranges_union(self._ranges, *range_lists)
     def __ior__(self, s2):
         if not isinstance(s2, ip_set): return NotImplemented
         self.update(s2)
         return self
     def intersection_update(self, *iterables):
-        self._content.intersection_update(_ip_iters(iterables))
+        for iterable in iterables:
+            self._ranges = _ranges_intersection(self._ranges,
+                                                _ip_ranges(iterable))
     def __iand__(self, s2):
         if not isinstance(s2, ip_set): return NotImplemented
         self.intersection_update(s2)
         return self
     def difference_update(self, *iterables):
-        self._content.difference_update(_ip_iters(iterables))
+        self._ranges = _ranges_difference(
+            self._ranges,
+            _ranges_union(*[_ip_ranges(iterable) for iterable in iterables]))
     def __isub__(self, s2):
         if not isinstance(s2, ip_set): return NotImplemented
         self.difference_update(s2)
         return self
     def symmetric_difference_update(self, iterable):
-        self._content.symmetric_difference_update(
-            _ip_iters_check([iterable], self))
+        ranges = _ip_ranges(iterable)
+        if _ranges_has_ipv6(ranges):
+            self._contains_ipv6 = True
+        self._ranges = _ranges_symmetric_difference(self._ranges, ranges)
     def __ixor__(self, s2):
         if not isinstance(s2, ip_set): return NotImplemented
         self.symmetric_difference_update(s2)
         return self
     def add(self, addr):
-        addr = _ip_conv(addr)
-        if addr._addr < 0xFFFF00000000 or addr._addr > 0xFFFFFFFFFFFF:
+        a = _ip_int(addr)
+        if a < _IPv4_MAPPED_MIN or a > _IPv4_MAPPED_MAX:
             self._contains_ipv6 = True
-        self._content.add(addr)
+        r = self._ranges
+        i = self._find(a)
+        joins_next = (i + 1 < len(r) and r[i + 1][0] == a + 1)
+        if i >= 0:
+            (lo, hi) = r[i]
+            if a <= hi:
+                return
+            if a == hi + 1:
+                if joins_next:
+                    r[i:i+2] = [(lo, r[i + 1][1])]
+                else:
+                    r[i] = (lo, a)
+                return
+        if joins_next:
+            r[i + 1] = (a, r[i + 1][1])
+        else:
+            r.insert(i + 1, (a, a))
+    def _discard(self, a):
+        """
+        Removes the integer address *a* from this set, returning
+        ``True`` if it was present and ``False`` otherwise.
+        """
+        r = self._ranges
+        i = self._find(a)
+        if i < 0 or a > r[i][1]:
+            return False
+        (lo, hi) = r[i]
+        pieces = []
+        if lo < a:
+            pieces.append((lo, a - 1))
+        if a < hi:
+            pieces.append((a + 1, hi))
+        r[i:i+1] = pieces
+        return True
     def remove(self, addr):
-        addr = _ip_conv(addr)
-        self._content.remove(addr)
+        if not self._discard(_ip_int(addr)):
+            raise KeyError(addr)
     def discard(self, addr):
-        addr = _ip_conv(addr)
-        self._content.discard(addr)
+        self._discard(_ip_int(addr))
     def pop(self):
-        addr = self._content.pop()
-        if self._contains_ipv6:
-            return addr.to_ipv4()
+        r = self._ranges
+        if not r:
+            raise KeyError('pop from an empty ip_set')
+        (lo, hi) = r[-1]
+        if lo == hi:
+            r.pop()
         else:
-            return addr
+            r[-1] = (lo, hi - 1)
+        return self._out_addr(hi)
     def clear(self):
         self._contains_ipv6 = False
-        self._content.clear()
+        self._ranges = []
     def _range_iter(self):
-        sorted_ips = sorted(self)
-        while sorted_ips:
-            range_min = sorted_ips.pop(0)._addr
-            range_max = range_min
-            while sorted_ips and sorted_ips[0]._addr == range_max + 1:
-                range_max = sorted_ips.pop(0)._addr
+        for (range_min, range_max) in self._ranges:
             if self._contains_ipv6:
-                yield (IPv6Addr(range_min), IPv6Addr(range_max))
+                yield (_new_ipv6(range_min), _new_ipv6(range_max))
             else:
-                yield (IPv4Addr(range_min & IPv4_MAX),
-                       IPv4Addr(range_max & IPv4_MAX))
+                yield (_new_ipv4(range_min & IPv4_MAX),
+                       _new_ipv4(range_max & IPv4_MAX))
     def cidr_iter(self):
-        for (range_min, range_max) in self._range_iter():
-            range_min = range_min._addr
-            range_max = range_max._addr
-            if self._contains_ipv6:
-                bit, bits = 1, 128
-                make_ip = IPv6Addr
-            else:
-                bit, bits = 1, 32
-                range_min &= IPv4_MAX
-                range_max &= IPv4_MAX
-                make_ip = IPv4Addr
-            while bits:
-                if range_min + bit > range_max:
-                    break
-                elif range_min & bit:
-                    yield make_ip(range_min & ~(bit - 1)), bits
-                    range_min += bit
-                bit <<= 1
-                bits -= 1
-            prefix = range_max & ~(bit - 1)
-            while bit:
-                if prefix + bit - 1 <= range_max:
-                    yield make_ip(prefix), bits
-                    prefix += bit
-                    if prefix > range_max:
-                        break
-                bit >>= 1
-                bits += 1
+        if self._contains_ipv6:
+            (bits, mask, make_ip) = (128, IPv6_MAX, IPv6Addr)
+        else:
+            (bits, mask, make_ip) = (32, IPv4_MAX, IPv4Addr)
+        for (range_min, range_max) in self._ranges:
+            for (prefix, prefix_len) in _cidr_blocks(range_min & mask,
+                                                     range_max & mask, bits):
+                yield make_ip(prefix), prefix_len
+    def save(self, path):
+        """
+        Writes the set to *path*, a filename or a file object opened
+        for binary writing, in a compact binary format which can be
+        read by :meth:`load` or :class:`mapped_ip_set`.
+        """
+        if isinstance(path, basestring):
+            f = open(path, 'wb')
+            try:
+                _ipset_file_write(f, self._ranges, self._contains_ipv6)
+            finally:
+                f.close()
+        else:
+            _ipset_file_write(path, self._ranges, self._contains_ipv6)
+    @classmethod
+    def load(class_, path):
+        """
+        Returns a new set read from *path*, a filename or a file
+        object opened for binary reading, which was written by
+        :meth:`save`.
+        """
+        if isinstance(path, basestring):
+            f = open(path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        else:
+            data = path.read()
+        result = class_()
+        (result._ranges, result._contains_ipv6) = _ipset_file_read(
+            data, path)
+        return result
     @classmethod
     def supports_ipv6(class_):
         return True
@@ -552,6 +1281,429 @@ class ip_set(object):
                                list(start_of(self)))
         return "%s(%r)" % (self.__class__.__name__, list(self))
 
+class mapped_ip_set(object):
+    """
+    A read-only view of an ip_set file written by :meth:`ip_set.save`.
+    The file is memory-mapped, and membership is tested by a binary
+    search of the mapped ranges, so that opening even a very large
+    file is immediate and takes no memory for its contents.
+    """
+    __slots__ = ['_map', '_count', '_is_ipv6', '_record']
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                # Empty files cannot be mapped
+                m = f.read()
+        finally:
+            f.close()
+        (self._is_ipv6, self._count, record_len) = _ipset_file_header(
+            m, path)
+        self._map = m
+        if self._is_ipv6:
+            self._record = '>QQQQ'
+        else:
+            self._record = '>II'
+    def _range(self, i):
+        """
+        Returns the integer range *i* of the file, in IPv6 space.
+        """
+        values = struct.unpack_from(
+            self._record, self._map,
+            _IPSET_HEADER_LEN + i * struct.calcsize(self._record))
+        if self._is_ipv6:
+            return ((values[0] << 64) | values[1],
+                    (values[2] << 64) | values[3])
+        return (_IPv4_MAPPED_MIN + values[0], _IPv4_MAPPED_MIN + values[1])
+    def _range_iter(self):
+        for i in xrange(self._count):
+            yield self._range(i)
+    def __contains__(self, addr):
+        a = _ip_int(addr)
+        if not self._is_ipv6 and not (
+                _IPv4_MAPPED_MIN <= a <= _IPv4_MAPPED_MAX):
+            return False
+        # Find the last range starting at or before a
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._range(mid)[0] <= a:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo > 0 and a <= self._range(lo - 1)[1]
+    def cardinality(self):
+        count = 0
+        for (lo, hi) in self._range_iter():
+            count += hi - lo + 1
+        return count
+    def __len__(self):
+        return self.cardinality()
+    def to_ip_set(self):
+        """
+        Returns an :class:`ip_set` containing the contents of the file.
+        """
+        result = ip_set()
+        result._ranges = list(self._range_iter())
+        result._contains_ipv6 = self._is_ipv6
+        return result
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def __repr__(self):
+        return '<%s of %d ranges>' % (self.__class__.__name__, self._count)
+
+def _prefix_conv(block):
+    """
+    Converts a CIDR block into a pair ``(base, prefix_len)`` in IPv6
+    space.  The block may be a string such as "10.0.0.0/8", a pair
+    ``(addr, prefix_len)`` as produced by :meth:`ip_set.cidr_iter`, or
+    a single address.  Host bits below the prefix are cleared.
+    """
+    if isinstance(block, tuple) and len(block) == 2:
+        (addr, prefix_len) = block
+    elif isinstance(block, IPAddr):
+        (addr, prefix_len) = (block, None)
+    elif isinstance(block, basestring):
+        if '/' in block:
+            (addr, prefix_len) = block.split('/', 1)
+            try:
+                prefix_len = int(prefix_len)
+            except ValueError:
+                value_error = ValueError("Invalid CIDR block: %r" % block)
+                raise value_error
+        else:
+            (addr, prefix_len) = (block, None)
+    else:
+        type_error = TypeError(
+            "CIDR block must be a string, IPAddr, or (IPAddr, int) "
+            "pair: %r" % (block,))
+        raise type_error
+    addr = IPAddr(addr)
+    if addr.is_ipv6():
+        bits = 128
+    else:
+        bits = 32
+    if prefix_len is None:
+        prefix_len = bits
+    if (not isinstance(prefix_len, (int, long)) or
+            not 0 <= prefix_len <= bits):
+        value_error = ValueError("Invalid CIDR block: %r" % (block,))
+        raise value_error
+    prefix_len += 128 - bits
+    base = _ipv6_int(addr) & (IPv6_MAX << (128 - prefix_len)) & IPv6_MAX
+    return (base, prefix_len)
+
+class ip_prefix_map(object):
+    """
+    A mapping from CIDR blocks to values, supporting longest-prefix
+    match lookups of addresses.
+
+    The blocks are kept in a dict, and flattened on demand into a
+    sorted table of disjoint intervals, each labelled with the longest
+    block covering it.  A lookup is then a single binary search.
+    """
+    # _prefixes maps (base, prefix_len) in IPv6 space to values.
+    # _table is (starts, keys) or None if it must be rebuilt: the
+    # interval beginning at starts[i] is covered most specifically by
+    # the block keys[i], or by no block if keys[i] is None.
+    __slots__ = ['_prefixes', '_table', '_contains_ipv6']
+    def __init__(self, items=None):
+        self._prefixes = {}
+        self._table = None
+        self._contains_ipv6 = False
+        if items:
+            self.update(items)
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for (block, value) in items:
+            self[block] = value
+    def _out_block(self, key):
+        (base, prefix_len) = key
+        if self._contains_ipv6:
+            return (IPv6Addr(base), prefix_len)
+        else:
+            return (IPv4Addr(base & IPv4_MAX), prefix_len - 96)
+    def _out_addr(self, a):
+        if self._contains_ipv6:
+            return _new_ipv6(a)
+        else:
+            return _new_ipv4(a & IPv4_MAX)
+    def __setitem__(self, block, value):
+        key = _prefix_conv(block)
+        (base, prefix_len) = key
+        if (prefix_len < 96 or
+                not _IPv4_MAPPED_MIN <= base <= _IPv4_MAPPED_MAX):
+            self._contains_ipv6 = True
+        if key not in self._prefixes:
+            self._table = None
+        self._prefixes[key] = value
+    def __getitem__(self, block):
+        try:
+            return self._prefixes[_prefix_conv(block)]
+        except KeyError:
+            raise KeyError(block)
+    def __delitem__(self, block):
+        try:
+            del self._prefixes[_prefix_conv(block)]
+        except KeyError:
+            raise KeyError(block)
+        self._table = None
+    def __contains__(self, block):
+        return _prefix_conv(block) in self._prefixes
+    def get(self, block, default=None):
+        return self._prefixes.get(_prefix_conv(block), default)
+    def __len__(self):
+        return len(self._prefixes)
+    def __iter__(self):
+        for key in sorted(self._prefixes):
+            yield self._out_block(key)
+    def iteritems(self):
+        """
+        Returns an iterator of ``((addr, prefix_len), value)`` pairs
+        for every block in the map, in order of address, with shorter
+        prefixes before longer ones.
+        """
+        for key in sorted(self._prefixes):
+            yield (self._out_block(key), self._prefixes[key])
+    def clear(self):
+        self._prefixes.clear()
+        self._table = None
+        self._contains_ipv6 = False
+    def _build_table(self):
+        # CIDR blocks are either nested or disjoint, so walking them
+        # in order of (base, prefix_len) with a stack of enclosing
+        # blocks finds every point at which the longest match changes.
+        starts = []
+        keys = []
+        def mark(a, key):
+            if starts and starts[-1] == a:
+                keys[-1] = key
+            else:
+                starts.append(a)
+                keys.append(key)
+        stack = []
+        for key in sorted(self._prefixes):
+            (base, prefix_len) = key
+            while stack and stack[-1][0] < base:
+                end = stack.pop()[0]
+                mark(end + 1, stack[-1][1] if stack else None)
+            mark(base, key)
+            stack.append((base + (1 << (128 - prefix_len)) - 1, key))
+        while stack:
+            end = stack.pop()[0]
+            mark(end + 1, stack[-1][1] if stack else None)
+        self._table = (starts, keys)
+    def _lookup_key(self, a):
+        if self._table is None:
+            self._build_table()
+        (starts, keys) = self._table
+        i = bisect.bisect_right(starts, a) - 1
+        if i < 0:
+            return None
+        return keys[i]
+    def lookup(self, addr, default=None):
+        """
+        Returns the value of the longest block containing *addr*, or
+        *default* if no block contains it.
+        """
+        key = self._lookup_key(_ipv6_int(IPAddr(addr)))
+        if key is None:
+            return default
+        return self._prefixes[key]
+    def lookup_prefix(self, addr):
+        """
+        Returns a pair ``((addr, prefix_len), value)`` for the longest
+        block containing *addr*, or ``None`` if no block contains it.
+        """
+        key = self._lookup_key(_ipv6_int(IPAddr(addr)))
+        if key is None:
+            return None
+        return (self._out_block(key), self._prefixes[key])
+    def lookup_many(self, addrs, default=None):
+        """
+        Returns a list of the result of :meth:`lookup` for each
+        address in *addrs*.
+        """
+        lookup_key = self._lookup_key
+        prefixes = self._prefixes
+        result = []
+        for addr in addrs:
+            key = lookup_key(_ipv6_int(IPAddr(addr)))
+            if key is None:
+                result.append(default)
+            else:
+                result.append(prefixes[key])
+        return result
+    def lookup_ints(self, values, is_ipv6=False, default=None):
+        """
+        Like :meth:`lookup_many`, but takes integer address values,
+        interpreted as with :meth:`IPWildcard.match_ints`.
+        """
+        lookup_key = self._lookup_key
+        prefixes = self._prefixes
+        mapped = _IPv4_MAPPED_MIN
+        if isinstance(is_ipv6, (bool, int, long)):
+            if is_ipv6:
+                keys = [lookup_key(v) for v in values]
+            else:
+                keys = [lookup_key(mapped + v) for v in values]
+        else:
+            keys = [lookup_key(v if f else mapped + v)
+                    for (v, f) in itertools.izip(values, is_ipv6)]
+        return [default if key is None else prefixes[key] for key in keys]
+    def _iter_intervals(self):
+        """
+        Yields ``(lo, hi, value)`` for each maximal interval of
+        integer addresses which map to the same value.
+        """
+        if self._table is None:
+            self._build_table()
+        (starts, keys) = self._table
+        prefixes = self._prefixes
+        cur = None
+        for i in xrange(len(starts)):
+            if keys[i] is None:
+                continue
+            lo = starts[i]
+            if i + 1 < len(starts):
+                hi = starts[i + 1] - 1
+            else:
+                hi = IPv6_MAX
+            value = prefixes[keys[i]]
+            if cur is not None:
+                if cur[1] + 1 == lo and cur[2] == value:
+                    cur = (cur[0], hi, value)
+                    continue
+                yield cur
+            cur = (lo, hi, value)
+        if cur is not None:
+            yield cur
+    def iterranges(self):
+        """
+        Returns an iterator of ``((low_addr, high_addr), value)``
+        pairs for each maximal range of addresses which map to the
+        same value, in order.
+        """
+        for (lo, hi, value) in self._iter_intervals():
+            yield ((self._out_addr(lo), self._out_addr(hi)), value)
+    def cidr_iter(self):
+        """
+        Returns an iterator of ``((addr, prefix_len), value)`` pairs
+        covering every address in the map with the fewest CIDR blocks,
+        in the same form as :meth:`ip_set.cidr_iter`.  Unlike
+        :meth:`iteritems`, blocks do not overlap: each address falls
+        in exactly one block, labelled with its longest match.
+        """
+        if self._contains_ipv6:
+            (bits, mask, make_ip) = (128, IPv6_MAX, IPv6Addr)
+        else:
+            (bits, mask, make_ip) = (32, IPv4_MAX, IPv4Addr)
+        for (lo, hi, value) in self._iter_intervals():
+            for (prefix, prefix_len) in _cidr_blocks(lo & mask, hi & mask,
+                                                     bits):
+                yield ((make_ip(prefix), prefix_len), value)
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self.iteritems()))
+
+def _wildcard_ranges(fields, base=0):
+    """
+    Given a list of ``(bits, ranges)`` pairs describing each field of a
+    wildcard (most significant first), returns a coalesced range list
+    of all of the values matched by the wildcard, offset by *base*.
+
+    Trailing fields that accept every value are folded into the low
+    bits of each range instead of being enumerated, so that
+    "10.x.x.x" produces a single range rather than 16 million.
+    """
+    fields = [(bits, _ranges_coalesce(sorted(ranges)))
+              for (bits, ranges) in fields]
+    low_bits = 0
+    while fields and fields[-1][1] == [(0, (1 << fields[-1][0]) - 1)]:
+        low_bits += fields.pop()[0]
+    low_mask = (1 << low_bits) - 1
+    if not fields:
+        return [(base, base + low_mask)]
+    (last_bits, last_ranges) = fields.pop()
+    field_values = [[(bits, v) for (lo, hi) in ranges
+                               for v in xrange(lo, hi + 1)]
+                    for (bits, ranges) in fields]
+    def gen():
+        for prefix_fields in itertools.product(*field_values):
+            prefix = 0
+            for (bits, v) in prefix_fields:
+                prefix = (prefix << bits) | v
+            prefix <<= last_bits
+            for (lo, hi) in last_ranges:
+                yield (base + ((prefix | lo) << low_bits),
+                       base + (((prefix | hi) << low_bits) | low_mask))
+    return _ranges_coalesce(gen())
+
+# A wildcard is compiled from a "spec" pair (ranges, fields).  A
+# matching address (an integer in IPv6 space) must fall within one of
+# the coalesced range list *ranges*, and for each (shift, mask,
+# field_ranges) triple in *fields*, the field value (addr >> shift) &
+# mask must fall within the coalesced range list *field_ranges*.
+# Fields are only used along with a single range.
+
+def _field_specs(fields):
+    """
+    Given a list of ``(shift, bits, ranges)`` triples describing the
+    fields of a wildcard, returns the *fields* part of a wildcard
+    spec.  Fields which match every value need no test and are
+    omitted.
+    """
+    result = []
+    for (shift, bits, ranges) in fields:
+        mask = (1 << bits) - 1
+        ranges = _ranges_coalesce(sorted(ranges))
+        if ranges != [(0, mask)]:
+            result.append((shift, mask, ranges))
+    return result
+
+def _wildcard_matcher(ranges, fields):
+    """
+    Compiles a wildcard spec into a function which takes an integer
+    address in IPv6 space and returns whether it matches.  Each field
+    test is a single lookup in a bytearray indexed by field value.
+    """
+    tables = []
+    for (shift, mask, field_ranges) in fields:
+        table = bytearray(mask + 1)
+        for (lo, hi) in field_ranges:
+            table[lo:hi+1] = '\x01' * (hi - lo + 1)
+        tables.append((shift, mask, table))
+    tables = tuple(tables)
+    if len(ranges) == 1:
+        (lo, hi) = ranges[0]
+        if not tables:
+            def match(a):
+                return lo <= a <= hi
+        else:
+            def match(a):
+                if a < lo or a > hi:
+                    return False
+                for (shift, mask, table) in tables:
+                    if not table[(a >> shift) & mask]:
+                        return False
+                return True
+    else:
+        starts = [lo for (lo, hi) in ranges]
+        ends = [hi for (lo, hi) in ranges]
+        bisect_right = bisect.bisect_right
+        def match(a):
+            i = bisect_right(starts, a) - 1
+            return i >= 0 and a <= ends[i]
+    return match
+
 def _parse_ipv4_ranges(a):
     ipv4_part = _chunk_ipv4(a)
     octet_ranges = []
@@ -578,19 +1730,8 @@ def _parse_ipv4_ranges(a):
                     raise ValueError()
                 octet_range.append((r, r))
         octet_ranges.append(octet_range)
-    def check(x):
-        x = x.to_ipv4()
-        if x is None:
-            return False
-        for (octet, octet_range) in zip(x.octets(), octet_ranges):
-            matched = False
-            for (r_min, r_max) in octet_range:
-                if octet >= r_min and octet <= r_max:
-                    matched = True
-                    break
-            if matched == False:
-                return False
-        return True
+    spec = ([(_IPv4_MAPPED_MIN, _IPv4_MAPPED_MAX)],
+            _field_specs([(8*(3-i), 8, octet_ranges[i]) for i in xrange(4)]))
     def gen():
         # inelegant, but all "elegant" solutions are worse
         for (min0, max0) in octet_ranges[0]:
@@ -606,7 +1747,10 @@ def _parse_ipv4_ranges(a):
                       for o3 in xrange(min3, max3+1):
                         a = a2 | o3
                         yield IPv4Addr(a)
-    return check, gen, False
+    def ranges():
+        return _wildcard_ranges([(8, r) for r in octet_ranges],
+                                _IPv4_MAPPED_MIN)
+    return spec, gen, ranges, False
 
 def _parse_ipv6_ranges(a):
     # already know addr is a string
@@ -663,33 +1807,12 @@ def _parse_ipv6_ranges(a):
                         raise ValueError()
                     octet_range.append((r, r))
             octet_ranges.append(octet_range)
-    def check(x):
-        x = x.to_ipv6()
-        x = int(x)
-        fields = tuple((x >> (16*(7-i))) & 0xFFFF for i in xrange(8))
-        octets = tuple((x >> (8*(3-i))) & 0xFF for i in xrange(4))
-        if ipv4_part:
-            num_fields = 6
-        else:
-            num_fields = 8
-        for (field, field_range) in zip(fields, field_ranges)[:num_fields]:
-            matched = False
-            for (r_min, r_max) in field_range:
-                if field >= r_min and field <= r_max:
-                    matched = True
-                    break
-            if matched == False:
-                return False
-        if ipv4_part:
-            for (octet, octet_range) in zip(octets, octet_ranges):
-                matched = False
-                for (r_min, r_max) in octet_range:
-                    if octet >= r_min and octet <= r_max:
-                        matched = True
-                        break
-                if matched == False:
-                    return False
-        return True
+    if ipv4_part:
+        fields = ([(16*(7-i), 16, field_ranges[i]) for i in xrange(6)] +
+                  [(8*(3-i), 8, octet_ranges[i]) for i in xrange(4)])
+    else:
+        fields = [(16*(7-i), 16, field_ranges[i]) for i in xrange(8)]
+    spec = ([(0, IPv6_MAX)], _field_specs(fields))
     def gen():
         # inelegant, but all "elegant" solutions are worse
         for (min0, max0) in field_ranges[0]:
@@ -732,7 +1855,13 @@ def _parse_ipv6_ranges(a):
                         for p7 in xrange(min7, max7+1):
                          a = (a6 << 16) | p7
                          yield IPv6Addr(a)
-    return check, gen, True
+    def ranges():
+        if ipv4_part:
+            return _wildcard_ranges([(16, r) for r in field_ranges[:6]] +
+                                    [(8, r) for r in octet_ranges])
+        else:
+            return _wildcard_ranges([(16, r) for r in field_ranges])
+    return spec, gen, ranges, True
 
 def _parse_wildcard(addr):
     a = addr
@@ -753,30 +1882,34 @@ def _parse_wildcard(addr):
                 a = a.mask_prefix(cidr_len)
                 ai = int(a)
                 if a.is_ipv6():
-                    def check(x):
-                        x = x.to_ipv6()
-                        return a == x.mask_prefix(cidr_len)
                     def gen():
-                        for i in xrange(ai, (ai | (IPv6_MAX >> cidr_len)) + 1):
+                        # xrange() cannot handle values this large
+                        i = ai
+                        while i <= (ai | (IPv6_MAX >> cidr_len)):
                             yield IPv6Addr(i)
-                    return check, gen, True
+                            i += 1
+                    cidr_ranges = [(ai, ai | (IPv6_MAX >> cidr_len))]
+                    def ranges():
+                        return list(cidr_ranges)
+                    return (cidr_ranges, []), gen, ranges, True
                 else:
-                    def check(x):
-                        x = x.to_ipv4()
-                        if x is None:
-                            return False
-                        return a == x.mask_prefix(cidr_len)
                     def gen():
                         for i in xrange(ai, (ai | (IPv4_MAX >> cidr_len)) + 1):
                             yield IPv4Addr(i)
-                    return check, gen, False
+                    cidr_ranges = [(_IPv4_MAPPED_MIN + ai,
+                                    _IPv4_MAPPED_MIN +
+                                    (ai | (IPv4_MAX >> cidr_len)))]
+                    def ranges():
+                        return list(cidr_ranges)
+                    return (cidr_ranges, []), gen, ranges, False
             else:
                 a = IPAddr(a)
-                def check(x):
-                    return a == x
+                ai = _ipv6_int(a)
                 def gen():
                     yield a
-                return check, gen, a.is_ipv6()
+                def ranges():
+                    return [(ai, ai)]
+                return ([(ai, ai)], []), gen, ranges, a.is_ipv6()
         # ',' or '-', or 'x'  mean it has ranges
         else:
             if ':' in a:
@@ -787,50 +1920,67 @@ def _parse_wildcard(addr):
                 return _parse_ipv4_ranges(a)
             else:
                 # IPv4 by integers
-                ranges = []
+                int_ranges = []
                 a_ranges = a.split(',')
                 for a_range in a_ranges:
                     if '-' in a_range:
                         (a_min, a_max) = a_range.split('-')
                         a_min = int(IPv4Addr(a_min))
                         a_max = int(IPv4Addr(a_max))
-                        ranges.append((a_min, a_max))
+                        int_ranges.append((a_min, a_max))
                     else:
                         a_range = int(IPv4Addr(a_range))
-                        ranges.append((a_range, a_range))
-                def check(x):
-                    if x.is_ipv6():
-                        return False
-                    for (a_min, a_max) in ranges:
-                        ix = int(x)
-                        if ix >= a_min and ix <= a_max:
-                            return True
-                    return False
+                        int_ranges.append((a_range, a_range))
                 def gen():
-                    for (a_min, a_max) in ranges:
+                    for (a_min, a_max) in int_ranges:
                         for a in xrange(a_min, a_max + 1):
                             yield IPv4Addr(a)
-                return check, gen, False
+                mapped_ranges = _ranges_coalesce(
+                    (_IPv4_MAPPED_MIN + a_min, _IPv4_MAPPED_MIN + a_max)
+                    for (a_min, a_max) in sorted(int_ranges))
+                def ranges():
+                    return list(mapped_ranges)
+                return (mapped_ranges, []), gen, ranges, False
     except ValueError:
         value_error = ValueError("IPWildcard is not valid: %r" % addr)
         raise value_error
 
 class IPWildcard(object):
-    __slots__ = ['_check', '_gen', '_str', '_is_ipv6']
+    __slots__ = ['_spec', '_match', '_gen', '_ranges', '_str', '_is_ipv6']
     def __init__(self, wildcard):
         if isinstance(wildcard, IPWildcard):
-            self._check = wildcard._check
+            self._spec = wildcard._spec
+            self._match = wildcard._match
             self._gen = wildcard._gen
+            self._ranges = wildcard._ranges
             self._str = wildcard._str
             self._is_ipv6 = wildcard._is_ipv6
         else:
             self._str = wildcard
-            self._check, self._gen, self._is_ipv6 = _parse_wildcard(wildcard)
+            (self._spec, self._gen, self._ranges,
+             self._is_ipv6) = _parse_wildcard(wildcard)
+            self._match = _wildcard_matcher(*self._spec)
     def __iter__(self):
         return self._gen()
     def __contains__(self, addr):
-        addr = IPAddr(addr)
-        return self._check(addr)
+        return self._match(_ipv6_int(IPAddr(addr)))
+    def match_ints(self, values, is_ipv6=False):
+        """
+        Tests many integer address values against this wildcard at
+        once, without creating :class:`IPAddr` objects, and returns a
+        list of bools.  The values are IPv4 addresses if *is_ipv6* is
+        false, and IPv6 addresses if it is true.  *is_ipv6* may also
+        be a sequence of flags parallel to *values*, such as the one
+        returned by :func:`parse_ip_array`.
+        """
+        match = self._match
+        mapped = _IPv4_MAPPED_MIN
+        if isinstance(is_ipv6, (bool, int, long)):
+            if is_ipv6:
+                return [match(v) for v in values]
+            return [match(mapped + v) for v in values]
+        return [match(v if f else mapped + v)
+                for (v, f) in itertools.izip(values, is_ipv6)]
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self._str)
     def __str__(self):
@@ -838,6 +1988,134 @@ class IPWildcard(object):
     def is_ipv6(self):
         return self._is_ipv6
 
+class IPWildcardSet(object):
+    """
+    A collection of :class:`IPWildcard` patterns, indexed so that the
+    patterns matching an address can be found in time that does not
+    depend on how many patterns there are.
+
+    The index has two parts.  The address ranges of all the patterns
+    are cut into elementary intervals, each labelled with a bitmask of
+    the patterns covering it.  Then, for every octet or hextet that
+    any pattern restricts, a table maps each field value to a bitmask
+    of the patterns that accept it.  A lookup is one binary search and
+    one table lookup per restricted field, and-ing the masks together.
+    """
+    __slots__ = ['_wildcards', '_index']
+    def __init__(self, wildcards=None):
+        self._wildcards = []
+        self._index = None
+        if wildcards:
+            self.update(wildcards)
+    def add(self, wildcard):
+        self._wildcards.append(IPWildcard(wildcard))
+        self._index = None
+    def update(self, wildcards):
+        self._wildcards.extend(IPWildcard(w) for w in wildcards)
+        self._index = None
+    def __len__(self):
+        return len(self._wildcards)
+    def __iter__(self):
+        return iter(self._wildcards)
+    def _compile(self):
+        # Elementary intervals: each pattern's ranges are coalesced,
+        # so toggling its bit at the start and just past the end of
+        # each range tracks exactly which patterns cover each point.
+        events = {}
+        fields = {}
+        for (i, w) in enumerate(self._wildcards):
+            bit = 1 << i
+            (ranges, field_specs) = w._spec
+            for (lo, hi) in ranges:
+                events[lo] = events.get(lo, 0) ^ bit
+                events[hi + 1] = events.get(hi + 1, 0) ^ bit
+            for (shift, mask, field_ranges) in field_specs:
+                fields.setdefault((shift, mask), []).append(
+                    (bit, field_ranges))
+        starts = sorted(events)
+        masks = []
+        m = 0
+        for p in starts:
+            m ^= events[p]
+            masks.append(m)
+        all_bits = (1 << len(self._wildcards)) - 1
+        tables = []
+        for ((shift, mask), entries) in sorted(fields.iteritems(),
+                                               reverse=True):
+            free = all_bits
+            field_events = {}
+            for (bit, field_ranges) in entries:
+                free &= ~bit
+                for (lo, hi) in field_ranges:
+                    field_events[lo] = field_events.get(lo, 0) ^ bit
+                    field_events[hi + 1] = field_events.get(hi + 1, 0) ^ bit
+            table = [free] * (mask + 1)
+            points = sorted(field_events)
+            m = 0
+            for (p, q) in zip(points, points[1:]):
+                m ^= field_events[p]
+                if m:
+                    table[p:q] = [free | m] * (q - p)
+            tables.append((shift, mask, table))
+        self._index = (starts, masks, tables)
+    def _match_bits(self, a):
+        """
+        Returns a bitmask of the patterns matching the integer address
+        *a* in IPv6 space.
+        """
+        if self._index is None:
+            self._compile()
+        (starts, masks, tables) = self._index
+        i = bisect.bisect_right(starts, a) - 1
+        if i < 0:
+            return 0
+        m = masks[i]
+        for (shift, mask, table) in tables:
+            if not m:
+                break
+            m &= table[(a >> shift) & mask]
+        return m
+    def _bit_wildcards(self, m):
+        result = []
+        while m:
+            low = m & -m
+            result.append(self._wildcards[_bit_length(low) - 1])
+            m ^= low
+        return result
+    def __contains__(self, addr):
+        return bool(self._match_bits(_ipv6_int(IPAddr(addr))))
+    def matching(self, addr):
+        """
+        Returns a list of the patterns that match *addr*, in the order
+        in which they were added.
+        """
+        return self._bit_wildcards(self._match_bits(_ipv6_int(IPAddr(addr))))
+    def match_ints(self, values, is_ipv6=False):
+        """
+        Like :meth:`IPWildcard.match_ints`, returns a list of bools
+        telling whether each integer address matches any pattern.
+        """
+        match_bits = self._match_bits
+        mapped = _IPv4_MAPPED_MIN
+        if isinstance(is_ipv6, (bool, int, long)):
+            if is_ipv6:
+                return [bool(match_bits(v)) for v in values]
+            return [bool(match_bits(mapped + v)) for v in values]
+        return [bool(match_bits(v if f else mapped + v))
+                for (v, f) in itertools.izip(values, is_ipv6)]
+    def to_ip_set(self):
+        """
+        Returns an :class:`ip_set` of every address matched by any
+        pattern.  Patterns are merged range by range, so addresses
+        matched by several patterns are not enumerated repeatedly.
+        """
+        result = ip_set()
+        result.update(*self._wildcards)
+        return result
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__,
+                           [str(w) for w in self._wildcards])
+
 _BITS_FIN = 0x01
 _BITS_SYN = 0x02
 _BITS_RST = 0x04
@@ -868,62 +2146,101 @@ def _parse_tcpflags(value):
         computed_value |= _flag_values[c]
     return computed_value
 
+# Precomputed tables for every TCP flags value: the flag string, the
+# padded flag string, and a tuple of booleans for each flag in order
+# (FIN, SYN, RST, PSH, ACK, URG, ECE, CWR).
+_tcpflags_letters = zip('FSRPAUEC', (_BITS_FIN, _BITS_SYN, _BITS_RST,
+                                     _BITS_PSH, _BITS_ACK, _BITS_URG,
+                                     _BITS_ECE, _BITS_CWR))
+_tcpflags_str = [''.join(c for (c, b) in _tcpflags_letters if v & b)
+                 for v in xrange(256)]
+_tcpflags_padded = [''.join(c if v & b else ' '
+                            for (c, b) in _tcpflags_letters)
+                    for v in xrange(256)]
+_tcpflags_bools = [tuple(bool(v & b) for (c, b) in _tcpflags_letters)
+                   for v in xrange(256)]
+
+# Maps each valid flags value to itself, so that looking up a value
+# both validates it and leaves it unchanged.
+_tcpflags_valid = dict((v, v) for v in xrange(256))
+
+# Flag strings already parsed, and the shared TCPFlags for each value
+_tcpflags_parsed = {}
+_TCPFLAGS_PARSED_MAX = 1024
+_tcpflags_cache = [None] * 256
+
+def _tcpflags_int(value):
+    """
+    Returns the integer flags value of *value*, a flag string, an
+    integer, or a TCPFlags object.
+    """
+    if isinstance(value, basestring):
+        try:
+            return _tcpflags_parsed[value]
+        except KeyError:
+            pass
+        result = _parse_tcpflags(value)
+        if len(_tcpflags_parsed) >= _TCPFLAGS_PARSED_MAX:
+            _tcpflags_parsed.clear()
+        _tcpflags_parsed[value] = result
+        return result
+    elif isinstance(value, (int, long)):
+        if value < 0 or value > 0xFF:
+            value_error = ValueError(
+                "Illegal TCP flag value: %r" % value)
+            raise value_error
+        return value
+    elif isinstance(value, TCPFlags):
+        return value._value
+    else:
+        type_error = TypeError(
+            "TCP flag value must be string, int, or TCPFlags: %r" % value)
+        raise type_error
+
+def _parse_tcpflags_mask(flagmask, where):
+    """
+    Parses a flag mask string such as "S/SA" into a pair of integers
+    ``(high, mask)``.  A string with no "/" is its own mask.
+    """
+    if not isinstance(flagmask, basestring):
+        type_error = TypeError(
+            "flag mask not a string in %s: %r" % (where, flagmask))
+        raise type_error
+    parts = flagmask.split('/', 3)
+    if len(parts) == 1:
+        flag_bits = _tcpflags_int(parts[0])
+        mask_bits = flag_bits
+    elif len(parts) == 2:
+        flag_bits = _tcpflags_int(parts[0])
+        mask_bits = _tcpflags_int(parts[1])
+    else:
+        value_error = ValueError(
+            "invalid flag mask in %s: %r" % (where, flagmask))
+        raise value_error
+    return (flag_bits, mask_bits)
+
 class TCPFlags(object):
+    # TCPFlags objects are immutable, so only one is ever created for
+    # each value.
     __slots__ = '_value'
-    def __init__(self, value):
-        if isinstance(value, basestring):
-            self._value = _parse_tcpflags(value)
-        elif isinstance(value, (int, long)):
-            if value < 0 or value > 0xFF:
-                value_error = ValueError(
-                    "Illegal TCP flag value: %r" % value)
-                raise value_error
-            self._value = value
-        elif isinstance(value, TCPFlags):
-            self._value = value._value
-        else:
-            type_error = TypeError(
-                "TCP flag value must be string, int, or TCPFlags: %r" % value)
-            raise type_error
-    def _stringify(self, padding):
-        result = ""
-        if self._value & _BITS_FIN:
-            result += 'F'
-        else:
-            result += padding
-        if self._value & _BITS_SYN:
-            result += 'S'
-        else:
-            result += padding
-        if self._value & _BITS_RST:
-            result += 'R'
-        else:
-            result += padding
-        if self._value & _BITS_PSH:
-            result += 'P'
-        else:
-            result += padding
-        if self._value & _BITS_ACK:
-            result += 'A'
-        else:
-            result += padding
-        if self._value & _BITS_URG:
-            result += 'U'
-        else:
-            result += padding
-        if self._value & _BITS_ECE:
-            result += 'E'
-        else:
-            result += padding
-        if self._value & _BITS_CWR:
-            result += 'C'
-        else:
-            result += padding
+    def __new__(cls, value):
+        v = _tcpflags_int(value)
+        if cls is not TCPFlags:
+            result = object.__new__(cls)
+            result._value = v
+            return result
+        result = _tcpflags_cache[v]
+        if result is None:
+            result = object.__new__(cls)
+            result._value = v
+            _tcpflags_cache[v] = result
         return result
+    def __reduce__(self):
+        return (self.__class__, (self._value,))
     def __str__(self):
-        return self._stringify('')
+        return _tcpflags_str[self._value]
     def padded(self):
-        return self._stringify(' ')
+        return _tcpflags_padded[self._value]
     def __repr__(self):
         return "TCPFlags(%r)" % self.padded()
     def __cmp__(self, other):
@@ -973,22 +2290,145 @@ class TCPFlags(object):
     def __nonzero__(self):
         return bool(self._value)
     def matches(self, flagmask):
-        if not isinstance(flagmask, basestring):
+        (flag_bits, mask_bits) = _parse_tcpflags_mask(
+            flagmask, "TCPFlags.matches")
+        return ((self._value & mask_bits) == flag_bits)
+    @staticmethod
+    def histogram(values):
+        """
+        Returns a list of 256 counts of how many times each integer
+        flags value occurs in *values*, a sequence of integers.
+        """
+        counts = [0] * 256
+        # Report the whole argument if it can't be iterated over
+        v = values
+        try:
+            for v in values:
+                counts[_tcpflags_valid[v]] += 1
+        except (KeyError, TypeError):
+            value_error = ValueError("Illegal TCP flag value: %r" % (v,))
+            raise value_error
+        return counts
+    @staticmethod
+    def flag_counts(values):
+        """
+        Returns a tuple of the number of values in *values*, a
+        sequence of integers, which have each flag set, in the order
+        (FIN, SYN, RST, PSH, ACK, URG, ECE, CWR).
+        """
+        totals = [0] * 8
+        for (v, count) in enumerate(TCPFlags.histogram(values)):
+            if count:
+                for (i, is_set) in enumerate(_tcpflags_bools[v]):
+                    if is_set:
+                        totals[i] += count
+        return tuple(totals)
+    @staticmethod
+    def matches_mask(values, high, mask):
+        """
+        Returns a list of booleans, one for each integer in *values*,
+        telling whether the bits of the value selected by *mask* are
+        exactly those set in *high*.  *high* and *mask* may be flag
+        strings, integers, or TCPFlags objects.
+        """
+        high = _tcpflags_int(high)
+        mask = _tcpflags_int(mask)
+        table = dict((v, (v & mask) == high) for v in xrange(256))
+        return _tcpflags_match_table(values, table, "TCPFlags.matches_mask")
+
+def _tcpflags_match_table(values, table, where):
+    """
+    Returns a list of ``table[v]`` for each integer *v* in *values*,
+    where *table* is a dict with an entry for every valid flags value.
+    """
+    try:
+        result = map(table.get, values)
+    except TypeError:
+        result = [None]
+    if None in result:
+        value_error = ValueError("Illegal TCP flag value in %s" % where)
+        raise value_error
+    return result
+
+class tcpflags_filter(object):
+    """
+    A compiled TCP flags test, equivalent to rwfilter's ``--flags-all``
+    option.  *patterns* is a string of one or more comma-separated
+    ``HIGH/MASK`` expressions (such as ``"S/SA,SA/SA"``), or a list
+    of such strings or of ``(high, mask)`` pairs.  A flags value
+    matches if, for any one of the patterns, the flags selected by
+    MASK are exactly those in HIGH.  At least one pattern must be
+    given, and empty patterns (as in ``"S/SA,"``) are an error.
+
+    The patterns are compiled into a 256-entry table, so testing a
+    value takes the same time however many patterns there are.
+    """
+    __slots__ = ['_patterns', '_table']
+    def __init__(self, patterns):
+        source = patterns
+        if isinstance(patterns, basestring):
+            patterns = patterns.split(',')
+        elif not hasattr(patterns, '__iter__'):
             type_error = TypeError(
-                "flag mask not a string in TCPFlags.matches: %r" % flagmask)
+                "flag patterns not a string or list in tcpflags_filter: "
+                "%r" % (patterns,))
             raise type_error
-        parts = flagmask.split('/', 3)
-        if len(parts) == 1:
-            flag_bits = _parse_tcpflags(parts[0])
-            mask_bits = flag_bits
-        elif len(parts) == 2:
-            flag_bits = _parse_tcpflags(parts[0])
-            mask_bits = _parse_tcpflags(parts[1])
-        else:
+        self._patterns = []
+        for pattern in patterns:
+            if isinstance(pattern, basestring):
+                if not pattern.strip():
+                    value_error = ValueError(
+                        "empty flag pattern in tcpflags_filter: %r" %
+                        (source,))
+                    raise value_error
+                (high, mask) = _parse_tcpflags_mask(
+                    pattern.strip(), "tcpflags_filter")
+            elif isinstance(pattern, tuple) and len(pattern) == 2:
+                (high, mask) = (_tcpflags_int(pattern[0]),
+                                _tcpflags_int(pattern[1]))
+            else:
+                type_error = TypeError(
+                    "flag pattern not a string or (high, mask) pair in "
+                    "tcpflags_filter: %r" % (pattern,))
+                raise type_error
+            self._patterns.append((high, mask))
+        if not self._patterns:
             value_error = ValueError(
-                "invalid flag mask in TCPFlags.matches: %r" % flagmask)
+                "no flag patterns in tcpflags_filter: %r" % (source,))
             raise value_error
-        return ((self._value & mask_bits) == flag_bits)
+        self._table = {}
+        for v in xrange(256):
+            self._table[v] = False
+            for (high, mask) in self._patterns:
+                if (v & mask) == high:
+                    self._table[v] = True
+                    break
+    def __call__(self, flags):
+        """
+        If *flags* is a single flags value (an integer, a TCPFlags
+        object, or a flag string), returns ``True`` if it matches.  If
+        *flags* is a sequence of integers, returns a list of booleans,
+        one for each value, or a boolean array if *flags* is a NumPy
+        array.
+        """
+        if isinstance(flags, (int, long, TCPFlags, basestring)):
+            return self._table[_tcpflags_int(flags)]
+        if hasattr(flags, 'dtype') and hasattr(flags, 'ndim'):
+            return self._match_numpy(flags)
+        return _tcpflags_match_table(flags, self._table, "tcpflags_filter")
+    def _match_numpy(self, flags):
+        import numpy as np
+        flags = np.asarray(flags)
+        if flags.size and (flags.min() < 0 or flags.max() > 0xFF):
+            value_error = ValueError(
+                "Illegal TCP flag value in tcpflags_filter")
+            raise value_error
+        table = np.array([self._table[v] for v in xrange(256)], dtype=bool)
+        return table[flags]
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, ','.join(
+            '%s/%s' % (_tcpflags_str[high], _tcpflags_str[mask])
+            for (high, mask) in self._patterns))
 
 TCP_FIN = TCPFlags('F')
 TCP_SYN = TCPFlags('S')
@@ -1009,9 +2449,11 @@ __impl_version__ = "netsa-python " + netsa.__version__
 __all__ = """
     has_IPv6Addr
     IPAddr IPv4Addr IPv6Addr
-    ip_set
-    IPWildcard
-    TCPFlags
+    parse_ip_array format_many
+    ip_set mapped_ip_set
+    ip_prefix_map
+    IPWildcard IPWildcardSet
+    TCPFlags tcpflags_filter
 
     TCP_FIN TCP_SYN TCP_RST TCP_PSH TCP_ACK TCP_URG TCP_ECE TCP_CWR
 
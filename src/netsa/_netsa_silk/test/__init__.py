@@ -2,6 +2,8 @@
 # See license information in LICENSE-OPENSOURCE.txt
 
 from netsa._netsa_silk.test.ipaddr import *
+from netsa._netsa_silk.test.ipprefixmap import *
 from netsa._netsa_silk.test.ipset import *
 from netsa._netsa_silk.test.ipwildcard import *
+from netsa._netsa_silk.test.ipwildcardset import *
 from netsa._netsa_silk.test.tcpflags import *
@@ -2,9 +2,11 @@
 # See license information in LICENSE-OPENSOURCE.txt
 
 import unittest
+from StringIO import StringIO
 
 import netsa._netsa_silk
 from netsa._netsa_silk import IPAddr, IPv4Addr, IPv6Addr, has_IPv6Addr
+from netsa._netsa_silk import parse_ip_array, format_many
 
 def ipv6_enabled():
     return True
@@ -1283,3 +1285,111 @@ class IPAddrTest(unittest.TestCase):
             self.assertEqual(c, a.mask_prefix(112))
             self.assertEqual(c, c.mask(b))
             self.assertEqual(c, c.mask_prefix(112))
+
+    def test_parse_ip_array_1(self):
+        (values, is_ipv6) = parse_ip_array(["1.2.3.4", "0.0.0.0\n",
+                                            "255.255.255.255"])
+        self.assertEqual(list(values), [0x01020304, 0, 0xFFFFFFFF])
+        self.assertEqual(list(is_ipv6), [0, 0, 0])
+        self.assertEqual(values.itemsize, 4)
+
+    def test_parse_ip_array_2(self):
+        addrs = ["123.004.0056.00078", " 12345678 ", "1.2.3.4"]
+        (values, is_ipv6) = parse_ip_array(iter(addrs))
+        self.assertEqual(list(values), [int(IPAddr(a)) for a in addrs])
+        self.assertEqual(list(is_ipv6), [0, 0, 0])
+
+    def test_parse_ip_array_3(self):
+        if ipv6_enabled():
+            addrs = ["1.2.3.4", "2001:db8::1", "::FFFF:1.2.3.4", "::"]
+            (values, is_ipv6) = parse_ip_array(addrs)
+            self.assertEqual(list(values), [int(IPAddr(a)) for a in addrs])
+            self.assertEqual(list(is_ipv6), [0, 1, 1, 1])
+
+    def test_parse_ip_array_4(self):
+        self.assertEqual([list(x) for x in parse_ip_array([])], [[], []])
+        self.assertRaises(ValueError, parse_ip_array, ["1.2.3.4", "1.2.3"])
+        self.assertRaises(ValueError, parse_ip_array, ["1.2.3.256"])
+        self.assertRaises(TypeError, parse_ip_array, [1])
+
+    def test_parse_ip_array_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        (values, is_ipv6) = parse_ip_array(["1.2.3.4", "5.6.7.8"],
+                                           numpy=True)
+        self.assertEqual(values.dtype, numpy.uint32)
+        self.assertEqual(list(values), [0x01020304, 0x05060708])
+        self.assertEqual(list(is_ipv6), [False, False])
+
+    def test_sort_mixed(self):
+        if ipv6_enabled():
+            addrs = [IPAddr('::ffff:1.2.3.5'), IPAddr('1.2.3.4'),
+                     IPAddr('2001:db8::1'), IPAddr('::1'),
+                     IPAddr('1.2.3.6')]
+            self.assertEqual([str(a) for a in sorted(addrs)],
+                             ['::1', '1.2.3.4', '::ffff:1.2.3.5',
+                              '1.2.3.6', '2001:db8::1'])
+            self.assert_(IPAddr('1.2.3.4') < IPAddr('::ffff:1.2.3.5'))
+            self.assert_(IPAddr('::ffff:1.2.3.4') < IPAddr('1.2.3.5'))
+            self.assertEqual(IPAddr('1.2.3.4'), IPAddr('::ffff:1.2.3.4'))
+
+    def test_interned(self):
+        a = IPAddr.interned('1.2.3.4')
+        self.assert_(a is IPAddr.interned('1.2.3.4'))
+        self.assert_(a is IPAddr.interned(a))
+        self.assertEqual(a, IPAddr('1.2.3.4'))
+        self.assertEqual(type(a), IPv4Addr)
+        self.assert_(IPv4Addr.interned(0x01020304) is
+                     IPv4Addr.interned(0x01020304))
+        if ipv6_enabled():
+            b = IPv6Addr.interned(a)
+            self.assertEqual(type(b), IPv6Addr)
+            self.assert_(b is not a)
+            self.assertEqual(b, a)
+            self.assert_(IPv4Addr.interned(b) is not b)
+        self.assertRaises(ValueError, IPAddr.interned, '1.2.3')
+        self.assertRaises(TypeError, IPAddr.interned, ['1.2.3.4'])
+
+    def test_format_many_1(self):
+        addrs = ['1.2.3.4', IPAddr('10.0.0.1')]
+        self.assertEqual(list(format_many(addrs)), ['1.2.3.4', '10.0.0.1'])
+        self.assertEqual(list(format_many(addrs, 'padded')),
+                         ['001.002.003.004', '010.000.000.001'])
+        self.assertEqual(list(format_many(addrs, 'decimal')),
+                         ['16909060', '167772161'])
+        self.assertEqual(list(format_many([])), [])
+        self.assertRaises(ValueError, format_many, addrs, 'hex')
+
+    def test_format_many_2(self):
+        if ipv6_enabled():
+            addrs = ['1.2.3.4', '::ffff:1.2.3.4', '2001:db8:0:0:1:0:0:1',
+                     '::2', '1:0:0:2::']
+            self.assertEqual(list(format_many(addrs)),
+                             ['1.2.3.4', '::ffff:1.2.3.4', '2001:db8::1:0:0:1',
+                              '::0.0.0.2', '1:0:0:2::'])
+            self.assertEqual(list(format_many(addrs, 'ipv6')),
+                             ['::ffff:1.2.3.4', '::ffff:1.2.3.4',
+                              '2001:db8::1:0:0:1', '::0.0.0.2',
+                              '1:0:0:2::'])
+            self.assertEqual(list(format_many(addrs[2:3], 'padded')),
+                             ['2001:0db8:0000:0000:0001:0000:0000:0001'])
+            self.assertEqual([str(IPAddr(a)) for a in addrs],
+                             list(format_many(addrs)))
+
+    def test_format_many_3(self):
+        (values, is_ipv6) = parse_ip_array(['1.2.3.4', '5.6.7.8'])
+        self.assertEqual(list(format_many(values, is_ipv6=False)),
+                         ['1.2.3.4', '5.6.7.8'])
+        self.assertEqual(list(format_many(values, is_ipv6=is_ipv6)),
+                         ['1.2.3.4', '5.6.7.8'])
+        if ipv6_enabled():
+            self.assertEqual(list(format_many(values, is_ipv6=True)),
+                             ['::1.2.3.4', '::5.6.7.8'])
+
+    def test_format_many_out(self):
+        f = StringIO()
+        addrs = ['1.2.3.4', '1.2.3.5', '1.2.3.4'] * 1000
+        self.assertEqual(format_many(addrs, out=f), None)
+        self.assertEqual(f.getvalue(), ''.join(a + '\n' for a in addrs))
@@ -0,0 +1,158 @@
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+import unittest
+
+import netsa._netsa_silk
+from netsa._netsa_silk import (
+    IPAddr, IPv4Addr, IPv6Addr, IPWildcard, ip_prefix_map, ip_set)
+
+def ipv6_enabled():
+    return True
+
+class IPPrefixMapTest(unittest.TestCase):
+
+    def test_cons_1(self):
+        self.assertEqual(len(ip_prefix_map()), 0)
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b'})
+        self.assertEqual(len(m), 2)
+        m = ip_prefix_map([('10.0.0.0/8', 'a'),
+                           ((IPv4Addr('10.1.0.0'), 16), 'b'),
+                           (IPAddr('10.1.2.3'), 'c')])
+        self.assertEqual(list(m),
+                         [(IPv4Addr('10.0.0.0'), 8),
+                          (IPv4Addr('10.1.0.0'), 16),
+                          (IPv4Addr('10.1.2.3'), 32)])
+
+    def test_cons_2(self):
+        self.assertRaises(ValueError, ip_prefix_map, [('10.0.0.0/33', 'a')])
+        self.assertRaises(ValueError, ip_prefix_map, [('10.0.0.0/x', 'a')])
+        self.assertRaises(ValueError, ip_prefix_map, [('10.0.0/8', 'a')])
+        self.assertRaises(TypeError, ip_prefix_map, [(10, 'a')])
+
+    def test_host_bits(self):
+        m = ip_prefix_map({'10.1.2.3/8': 'a'})
+        self.assertEqual(list(m), [(IPv4Addr('10.0.0.0'), 8)])
+        self.assert_('10.0.0.0/8' in m)
+        self.assertEqual(m['10.255.0.0/8'], 'a')
+
+    def test_mapping(self):
+        m = ip_prefix_map()
+        m['10.0.0.0/8'] = 'a'
+        m['10.0.0.0/8'] = 'b'
+        self.assertEqual(len(m), 1)
+        self.assertEqual(m['10.0.0.0/8'], 'b')
+        self.assertEqual(m.get('11.0.0.0/8'), None)
+        self.assertEqual(m.get('11.0.0.0/8', 'x'), 'x')
+        self.assertRaises(KeyError, m.__getitem__, '10.0.0.0/9')
+        self.assert_('10.0.0.0/9' not in m)
+        del m['10.0.0.0/8']
+        self.assertEqual(len(m), 0)
+        self.assertRaises(KeyError, m.__delitem__, '10.0.0.0/8')
+        m['10.0.0.0/8'] = 'a'
+        m.clear()
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.lookup('10.0.0.1'), None)
+
+    def test_lookup_1(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b',
+                           '10.1.2.0/24': 'c', '10.1.2.3': 'd'})
+        self.assertEqual(m.lookup('10.1.2.3'), 'd')
+        self.assertEqual(m.lookup('10.1.2.4'), 'c')
+        self.assertEqual(m.lookup('10.1.3.0'), 'b')
+        self.assertEqual(m.lookup(IPAddr('10.2.0.0')), 'a')
+        self.assertEqual(m.lookup('11.0.0.0'), None)
+        self.assertEqual(m.lookup('9.255.255.255', 'x'), 'x')
+
+    def test_lookup_2(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a'})
+        self.assertEqual(m.lookup('10.1.0.0'), 'a')
+        m['10.1.0.0/16'] = 'b'
+        self.assertEqual(m.lookup('10.1.0.0'), 'b')
+        del m['10.1.0.0/16']
+        self.assertEqual(m.lookup('10.1.0.0'), 'a')
+
+    def test_lookup_3(self):
+        if ipv6_enabled():
+            m = ip_prefix_map({'::/0': 'all', '2001:db8::/32': 'doc',
+                               '10.0.0.0/8': 'ten'})
+            self.assertEqual(m.lookup('2001:db8::1'), 'doc')
+            self.assertEqual(m.lookup('2001:db9::1'), 'all')
+            self.assertEqual(m.lookup('10.1.2.3'), 'ten')
+            self.assertEqual(m.lookup('::ffff:10.1.2.3'), 'ten')
+            self.assertEqual(m.lookup('11.1.2.3'), 'all')
+
+    def test_lookup_prefix(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b'})
+        self.assertEqual(m.lookup_prefix('10.1.2.3'),
+                         ((IPv4Addr('10.1.0.0'), 16), 'b'))
+        self.assertEqual(m.lookup_prefix('10.2.2.3'),
+                         ((IPv4Addr('10.0.0.0'), 8), 'a'))
+        self.assertEqual(m.lookup_prefix('11.2.2.3'), None)
+
+    def test_lookup_many(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b'})
+        self.assertEqual(m.lookup_many(['10.1.0.0', '10.2.0.0',
+                                        IPAddr('11.0.0.0')], 'x'),
+                         ['b', 'a', 'x'])
+
+    def test_lookup_ints(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b'})
+        values = [int(IPAddr(a)) for a in
+                  ['10.1.0.0', '10.2.0.0', '11.0.0.0']]
+        self.assertEqual(m.lookup_ints(values), ['b', 'a', None])
+        if ipv6_enabled():
+            values = [int(IPAddr('10.1.0.0')),
+                      int(IPAddr('::ffff:10.2.0.0')),
+                      int(IPAddr('10.1.0.0'))]
+            self.assertEqual(m.lookup_ints(values, [0, 1, 1]),
+                             ['b', 'a', None])
+            self.assertEqual(m.lookup_ints(values[1:2], True), ['a'])
+
+    def test_iteritems(self):
+        m = ip_prefix_map({'10.1.0.0/16': 'b', '10.0.0.0/8': 'a'})
+        self.assertEqual(list(m.iteritems()),
+                         [((IPv4Addr('10.0.0.0'), 8), 'a'),
+                          ((IPv4Addr('10.1.0.0'), 16), 'b')])
+
+    def test_iterranges(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.1.0.0/16': 'b',
+                           '10.2.0.0/16': 'a', '12.0.0.0/8': 'c'})
+        self.assertEqual(list(m.iterranges()),
+                         [((IPv4Addr('10.0.0.0'), IPv4Addr('10.0.255.255')),
+                           'a'),
+                          ((IPv4Addr('10.1.0.0'), IPv4Addr('10.1.255.255')),
+                           'b'),
+                          ((IPv4Addr('10.2.0.0'),
+                            IPv4Addr('10.255.255.255')), 'a'),
+                          ((IPv4Addr('12.0.0.0'),
+                            IPv4Addr('12.255.255.255')), 'c')])
+
+    def test_cidr_iter_1(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a', '10.0.0.0/9': 'b',
+                           '10.128.0.0/10': 'a'})
+        self.assertEqual(list(m.cidr_iter()),
+                         [((IPv4Addr('10.0.0.0'), 9), 'b'),
+                          ((IPv4Addr('10.128.0.0'), 9), 'a')])
+
+    def test_cidr_iter_2(self):
+        m = ip_prefix_map({'10.0.0.0/30': 'a', '10.0.0.1': 'b'})
+        self.assertEqual(list(m.cidr_iter()),
+                         [((IPv4Addr('10.0.0.0'), 32), 'a'),
+                          ((IPv4Addr('10.0.0.1'), 32), 'b'),
+                          ((IPv4Addr('10.0.0.2'), 31), 'a')])
+        s = ip_set(IPWildcard('%s/%d' % block)
+                   for (block, value) in m.cidr_iter())
+        self.assertEqual(s, ip_set(IPWildcard('10.0.0.0/30')))
+
+    def test_cidr_iter_3(self):
+        if ipv6_enabled():
+            m = ip_prefix_map({'2001:db8::/32': 'a', '10.0.0.0/8': 'b'})
+            self.assertEqual(list(m.cidr_iter()),
+                             [((IPv6Addr('::ffff:10.0.0.0'), 104), 'b'),
+                              ((IPv6Addr('2001:db8::'), 32), 'a')])
+
+    def test_repr(self):
+        m = ip_prefix_map({'10.0.0.0/8': 'a'})
+        self.assertEqual(repr(m),
+                         "ip_prefix_map([((IPv4Addr('10.0.0.0'), 8), 'a')])")
@@ -2,8 +2,12 @@
 # See license information in LICENSE-OPENSOURCE.txt
 
 import operator
+import os
+import shutil
+import tempfile
 import unittest
 import sys
+from StringIO import StringIO
 
 def op_iand(x, y): x &= y; return x
 def op_ior(x, y): x |= y; return x
@@ -11,7 +15,8 @@ def op_isub(x, y): x -= y; return x
 def op_ixor(x, y): x ^= y; return x
 
 import netsa._netsa_silk
-from netsa._netsa_silk import IPAddr, IPv4Addr, IPv6Addr, ip_set, IPWildcard
+from netsa._netsa_silk import (
+    IPAddr, IPv4Addr, IPv6Addr, ip_set, mapped_ip_set, IPWildcard)
 
 def ipv6_enabled():
     return True
@@ -1594,3 +1599,233 @@ class IPSetTest(unittest.TestCase):
                        '2001:db8:1:2::3:8']]
             prefixes = [128, 126, 127]
             self.assertEqual(set(cidrlist), set(zip(blocks, prefixes)))
+
+    def test_ranges_large_wildcard(self):
+        s = ip_set([IPWildcard('10.0.0.0/8')])
+        self.assertEqual(s.cardinality(), 0x1000000)
+        self.assertTrue('10.255.255.255' in s)
+        self.assertTrue('11.0.0.0' not in s)
+        self.assertEqual(list(s.cidr_iter()), [(IPAddr('10.0.0.0'), 8)])
+
+    def test_ranges_large_union(self):
+        s = ip_set([IPWildcard('10.0.0.0/9')])
+        s.update([IPWildcard('10.128.0.0/9')])
+        self.assertEqual(list(s.cidr_iter()), [(IPAddr('10.0.0.0'), 8)])
+        s.difference_update([IPWildcard('10.1.x.x')])
+        self.assertEqual(s.cardinality(), 0x1000000 - 0x10000)
+        self.assertTrue('10.1.2.3' not in s)
+        self.assertTrue('10.2.0.0' in s)
+
+    def test_ranges_add_coalesce(self):
+        s = ip_set(['1.2.3.4', '1.2.3.6'])
+        s.add('1.2.3.5')
+        self.assertEqual(list(s.cidr_iter()),
+                         [(IPAddr('1.2.3.4'), 31), (IPAddr('1.2.3.6'), 32)])
+        s.add('1.2.3.7')
+        self.assertEqual(list(s.cidr_iter()), [(IPAddr('1.2.3.4'), 30)])
+
+    def test_ranges_discard_split(self):
+        s = ip_set([IPWildcard('1.2.3.4-7')])
+        s.discard('1.2.3.5')
+        self.assertEqual(len(s), 3)
+        self.assertEqual(sorted(s), [IPAddr('1.2.3.4'), IPAddr('1.2.3.6'),
+                                     IPAddr('1.2.3.7')])
+
+    def test_ranges_intersection_multiple(self):
+        s = ip_set([IPWildcard('1.2.3.x')])
+        s2 = s.intersection([IPWildcard('1.2.3.0-127')],
+                            [IPWildcard('1.2.3.64-255')])
+        self.assertEqual(list(s2.cidr_iter()), [(IPAddr('1.2.3.64'), 26)])
+
+    def test_ranges_mixed_wildcard_fields(self):
+        s = ip_set([IPWildcard('1.2,4.3-5,250-255.x')])
+        self.assertEqual(s.cardinality(), 2 * 9 * 256)
+        self.assertTrue('1.4.251.17' in s)
+        self.assertTrue('1.3.251.17' not in s)
+        self.assertTrue('1.4.6.17' not in s)
+
+    def test_cidr_iter_3(self):
+        s = ip_set([IPWildcard('1.2.3.5-255'), IPWildcard('1.2.4.0-250')])
+        cidrs = list(s.cidr_iter())
+        self.assertEqual(cidrs[0], (IPAddr('1.2.3.5'), 32))
+        self.assertEqual(cidrs[-1], (IPAddr('1.2.4.250'), 32))
+        self.assertEqual(sorted(cidrs), cidrs)
+        total = 0
+        for (addr, prefix) in cidrs:
+            self.assertEqual(addr, addr.mask_prefix(prefix))
+            total += 1 << (32 - prefix)
+        self.assertEqual(total, s.cardinality())
+        self.assertEqual(ip_set(IPWildcard('%s/%d' % c) for c in cidrs), s)
+
+    def test_cidr_iter_4(self):
+        s = ip_set([IPWildcard('0.0.0.0/0')])
+        self.assertEqual(list(s.cidr_iter()), [(IPAddr('0.0.0.0'), 0)])
+        if ipv6_enabled():
+            s = ip_set([IPWildcard('::/0')])
+            self.assertEqual(list(s.cidr_iter()), [(IPAddr('::'), 0)])
+            s = ip_set([IPWildcard('::ffff:1.2.3.0/120'), '::1'])
+            self.assertEqual(list(s.cidr_iter()),
+                             [(IPAddr('::1'), 128),
+                              (IPAddr('::ffff:1.2.3.0'), 120)])
+
+    def test_from_strings_1(self):
+        addrs = ['1.2.3.4\n', '1.2.3.5\n', '9.9.9.9\n', '1.2.3.4\n']
+        s = ip_set.from_strings(addrs)
+        self.assertEqual(s, ip_set(a.strip() for a in addrs))
+        self.assertEqual(s.cardinality(), 3)
+        self.assertEqual(type(iter(s).next()), IPv4Addr)
+
+    def test_from_strings_2(self):
+        if ipv6_enabled():
+            s = ip_set.from_strings(['1.2.3.4', '2001:db8::1'])
+            self.assertEqual(s, ip_set(['1.2.3.4', '2001:db8::1']))
+            self.assertTrue('::ffff:1.2.3.4' in s)
+            self.assertEqual(type(iter(s).next()), IPv6Addr)
+
+    def test_from_strings_3(self):
+        self.assertRaises(ValueError, ip_set.from_strings, ['1.2.3.x'])
+
+    def test_save_load_1(self):
+        s = ip_set([IPWildcard('1.2.3.x'), '9.9.9.9', '1.2.5.0'])
+        f = StringIO()
+        s.save(f)
+        f.seek(0)
+        t = ip_set.load(f)
+        self.assertEqual(t, s)
+        self.assertEqual(type(iter(t).next()), IPv4Addr)
+        f = StringIO()
+        ip_set().save(f)
+        f.seek(0)
+        self.assertEqual(ip_set.load(f), ip_set())
+
+    def test_save_load_2(self):
+        if ipv6_enabled():
+            s = ip_set([IPWildcard('2001:db8::x'), '1.2.3.4'])
+            f = StringIO()
+            s.save(f)
+            f.seek(0)
+            t = ip_set.load(f)
+            self.assertEqual(t, s)
+            self.assertEqual(type(iter(t).next()), IPv6Addr)
+
+    def test_save_load_3(self):
+        s = ip_set(['1.2.3.4'])
+        f = StringIO()
+        s.save(f)
+        data = f.getvalue()
+        self.assertRaises(ValueError, ip_set.load, StringIO(''))
+        self.assertRaises(ValueError, ip_set.load, StringIO(data[:-1]))
+        self.assertRaises(ValueError, ip_set.load,
+                          StringIO('X' + data[1:]))
+        # Ranges out of order
+        f = StringIO()
+        ip_set(['1.2.3.4', '1.2.3.6']).save(f)
+        data = f.getvalue()
+        self.assertRaises(ValueError, ip_set.load,
+                          StringIO(data[:-16] + data[-8:] + data[-16:-8]))
+
+    def test_mapped_1(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.set')
+            s = ip_set([IPWildcard('1.2.3.x'), '9.9.9.9', '1.2.5.0'])
+            s.save(path)
+            self.assertEqual(ip_set.load(path), s)
+            m = mapped_ip_set(path)
+            try:
+                for a in ['1.2.3.0', '1.2.3.255', '9.9.9.9', '1.2.5.0']:
+                    self.assert_(a in m)
+                    self.assert_(IPAddr(a) in m)
+                for a in ['1.2.2.255', '1.2.4.0', '9.9.9.8', '0.0.0.0',
+                          '255.255.255.255']:
+                    self.assert_(a not in m)
+                self.assertEqual(m.cardinality(), s.cardinality())
+                self.assertEqual(m.to_ip_set(), s)
+                if ipv6_enabled():
+                    self.assert_('::ffff:9.9.9.9' in m)
+                    self.assert_('2001:db8::' not in m)
+            finally:
+                m.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_mapped_2(self):
+        if ipv6_enabled():
+            tmpdir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(tmpdir, 'test.set')
+                s = ip_set([IPWildcard('2001:db8::x'), '1.2.3.4'])
+                s.save(path)
+                m = mapped_ip_set(path)
+                try:
+                    self.assert_('2001:db8::ffff' in m)
+                    self.assert_('2001:db8::1:0' not in m)
+                    self.assert_('1.2.3.4' in m)
+                    self.assert_('1.2.3.5' not in m)
+                    self.assertEqual(len(m), 65537)
+                    self.assertEqual(m.to_ip_set(), s)
+                finally:
+                    m.close()
+                open(path, 'wb').close()
+                self.assertRaises(ValueError, mapped_ip_set, path)
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def test_count_at_least_1(self):
+        s1 = ip_set(['1.2.3.1', '1.2.3.2', '1.2.3.3'])
+        s2 = ip_set(['1.2.3.2', '1.2.3.3', '1.2.3.4'])
+        s3 = ip_set(['1.2.3.3', '1.2.3.4', '1.2.3.5'])
+        self.assertEqual(ip_set.count_at_least(1, s1, s2, s3),
+                         s1 | s2 | s3)
+        self.assertEqual(ip_set.count_at_least(2, s1, s2, s3),
+                         ip_set(['1.2.3.2', '1.2.3.3', '1.2.3.4']))
+        self.assertEqual(ip_set.count_at_least(3, s1, s2, s3),
+                         s1 & s2 & s3)
+        self.assertEqual(ip_set.count_at_least(4, s1, s2, s3), ip_set())
+        self.assertEqual(ip_set.count_at_least(1), ip_set())
+        self.assertRaises(ValueError, ip_set.count_at_least, 0, s1)
+
+    def test_count_at_least_2(self):
+        s1 = ip_set([IPWildcard('1.2.3.0/30')])
+        self.assertEqual(
+            ip_set.count_at_least(2, s1, IPWildcard('1.2.3.2-5'),
+                                  iter(['1.2.3.1', IPAddr('1.2.3.5')]),
+                                  [('1.2.3.0', '1.2.3.0'),
+                                   (IPAddr('1.2.3.3'), '1.2.3.9')]),
+            ip_set([IPWildcard('1.2.3.0-5')]))
+        self.assertRaises(ValueError, ip_set.count_at_least, 1,
+                          ['1.2.3.5', '1.2.3.4'])
+        self.assertRaises(ValueError, ip_set.count_at_least, 1,
+                          [('1.2.3.5', '1.2.3.4')])
+        self.assertRaises(TypeError, ip_set.count_at_least, 1, [5])
+
+    def test_union_of(self):
+        s = ip_set.union_of(ip_set(['1.2.3.4']), ['1.2.3.3', '1.2.3.5'])
+        self.assertEqual(s, ip_set(['1.2.3.3', '1.2.3.4', '1.2.3.5']))
+        self.assertEqual(type(iter(s).next()), IPv4Addr)
+        if ipv6_enabled():
+            s = ip_set.union_of(ip_set(['1.2.3.4']), ['2001:db8::1'])
+            self.assertEqual(s, ip_set(['1.2.3.4', '2001:db8::1']))
+            self.assertEqual(type(iter(s).next()), IPv6Addr)
+
+    def test_intersection_of(self):
+        s = ip_set.intersection_of(IPWildcard('1.2.3.x'),
+                                   ['1.2.3.4', '1.2.4.4'],
+                                   ip_set(['1.2.3.4', '1.2.3.5']))
+        self.assertEqual(s, ip_set(['1.2.3.4']))
+        self.assertEqual(ip_set.intersection_of(), ip_set())
+
+    def test_count_at_least_mapped(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sources = []
+            for i in xrange(4):
+                path = os.path.join(tmpdir, '%d.set' % i)
+                ip_set(IPv4Addr(a) for a in xrange(i, 10)).save(path)
+                sources.append(mapped_ip_set(path))
+            self.assertEqual(ip_set.count_at_least(3, *sources),
+                             ip_set(IPv4Addr(a) for a in xrange(2, 10)))
+            for m in sources:
+                m.close()
+        finally:
+            shutil.rmtree(tmpdir)
@@ -388,3 +388,45 @@ class IPWildcardTest(unittest.TestCase):
             self.assertEqual(wild.is_ipv6(), True)
             wild = IPWildcard("0:ffff:0:0:0:0:0.253-254.125-126,255.x")
             self.assertEqual(wild.is_ipv6(), True)
+
+    def test_match_ints_1(self):
+        wild = IPWildcard('10.1-5,7.x.1-254')
+        values = [int(IPAddr(x)) for x in
+                  ['10.1.0.1', '10.6.0.1', '10.7.255.254', '10.7.255.255',
+                   '11.1.0.1']]
+        self.assertEqual(wild.match_ints(values),
+                         [True, False, True, False, False])
+
+    def test_match_ints_2(self):
+        wild = IPWildcard('1.2.3.0/24')
+        self.assertEqual(wild.match_ints([0x01020300, 0x010202FF]),
+                         [True, False])
+        if ipv6_enabled():
+            self.assertEqual(
+                wild.match_ints([0xFFFF01020304, 0x01020304], True),
+                [True, False])
+            self.assertEqual(
+                wild.match_ints([0xFFFF01020304, 0x01020304], [1, 0]),
+                [True, True])
+
+    def test_match_ints_3(self):
+        if ipv6_enabled():
+            wild = IPWildcard('2001:db8::x:1-5')
+            values = [int(IPAddr(x)) for x in
+                      ['2001:db8::ab:3', '2001:db8::ab:6', '2001:db9::ab:3']]
+            self.assertEqual(wild.match_ints(values, True),
+                             [True, False, False])
+            self.assertEqual(wild.match_ints([0x01020304]), [False])
+
+    def test_silk_IPWildcardIntegerMapped(self):
+        wild = IPWildcard('16909056-16909060')
+        self.assert_('1.2.3.4' in wild)
+        self.assert_('1.2.3.5' not in wild)
+        if ipv6_enabled():
+            self.assert_('::ffff:1.2.3.4' in wild)
+            self.assert_('::1.2.3.4' not in wild)
+
+    def test_iter_ipv6_cidr(self):
+        if ipv6_enabled():
+            self.assertEqual(list(IPWildcard('2001:db8::/127')),
+                             [IPAddr('2001:db8::'), IPAddr('2001:db8::1')])
@@ -0,0 +1,74 @@
+# Copyright 2008-2016 by Carnegie Mellon University
+# See license information in LICENSE-OPENSOURCE.txt
+
+import unittest
+
+import netsa._netsa_silk
+from netsa._netsa_silk import IPAddr, IPWildcard, IPWildcardSet, ip_set
+
+def ipv6_enabled():
+    return True
+
+class IPWildcardSetTest(unittest.TestCase):
+
+    def test_cons_1(self):
+        self.assertEqual(len(IPWildcardSet()), 0)
+        self.assertEqual(len(IPWildcardSet(['1.2.3.x', '1.2.3.4'])), 2)
+
+    def test_cons_2(self):
+        s = IPWildcardSet([IPWildcard('1.2.3.x')])
+        s.add('1.2.4.x')
+        s.update(['1.2.5.x', IPWildcard('1.2.6.x')])
+        self.assertEqual([str(w) for w in s],
+                         ['1.2.3.x', '1.2.4.x', '1.2.5.x', '1.2.6.x'])
+
+    def test_cons_3(self):
+        self.assertRaises(ValueError, IPWildcardSet, ['1.2.3.y'])
+
+    def test_in_1(self):
+        s = IPWildcardSet(['10.1-5,7.x.1-254', '192.168.0.0/16'])
+        self.assert_('10.7.0.1' in s)
+        self.assert_('10.6.0.1' not in s)
+        self.assert_('192.168.255.255' in s)
+        self.assert_(IPAddr('192.169.0.0') not in s)
+        self.assert_('0.0.0.0' not in IPWildcardSet())
+
+    def test_in_2(self):
+        if ipv6_enabled():
+            s = IPWildcardSet(['1.2.3.x', '2001:db8::x:1-5'])
+            self.assert_('::ffff:1.2.3.4' in s)
+            self.assert_('2001:db8::ab:3' in s)
+            self.assert_('2001:db8::ab:6' not in s)
+
+    def test_matching_1(self):
+        s = IPWildcardSet(['1.2.3.x', '1.2.3.0/25', '1.2.3.4',
+                           '16909056-16909060', '1.2,4.3.128-255'])
+        self.assertEqual([str(w) for w in s.matching('1.2.3.4')],
+                         ['1.2.3.x', '1.2.3.0/25', '1.2.3.4',
+                          '16909056-16909060'])
+        self.assertEqual([str(w) for w in s.matching('1.2.3.200')],
+                         ['1.2.3.x', '1.2,4.3.128-255'])
+        self.assertEqual(s.matching('1.2.5.0'), [])
+
+    def test_matching_2(self):
+        wildcards = ['1.x.3.4', 'x.2.x.4', '1.2.3.x', '1.2.x.x',
+                     '1.3.3.4', '0-1.0-2.0-3.0-4']
+        s = IPWildcardSet(wildcards)
+        for addr in ['1.2.3.4', '1.3.3.4', '9.2.0.4', '0.0.0.0']:
+            self.assertEqual(
+                [str(w) for w in s.matching(addr)],
+                [w for w in wildcards if addr in IPWildcard(w)])
+
+    def test_match_ints(self):
+        s = IPWildcardSet(['1.2.3.x', '5.6.7.8'])
+        values = [int(IPAddr(a)) for a in ['1.2.3.9', '5.6.7.8', '5.6.7.9']]
+        self.assertEqual(s.match_ints(values), [True, True, False])
+
+    def test_to_ip_set(self):
+        s = IPWildcardSet(['1.2.3.x', '1.2.3.0/25', '1.2.4.0-127'])
+        self.assertEqual(s.to_ip_set(),
+                         ip_set([IPWildcard('1.2.3.x'),
+                                 IPWildcard('1.2.4.0/25')]))
+        self.assertEqual(IPWildcardSet(['10.0.0.0/8', '10.x.x.x'])
+                         .to_ip_set().cardinality(), 0x1000000)
+        self.assertEqual(IPWildcardSet().to_ip_set(), ip_set())
@@ -1,12 +1,16 @@
 # Copyright 2008-2016 by Carnegie Mellon University
 # See license information in LICENSE-OPENSOURCE.txt
 
+import array
+import copy
 import operator
+import pickle
 import unittest
 import sys
 
 from netsa._netsa_silk import (TCPFlags, TCP_FIN, TCP_SYN, TCP_RST, TCP_PSH,
-                               TCP_URG, TCP_ECE, TCP_CWR, TCP_ACK)
+                               TCP_URG, TCP_ECE, TCP_CWR, TCP_ACK,
+                               tcpflags_filter)
 
 class TCPFlagsTest(unittest.TestCase):
 
@@ -230,3 +234,106 @@ class TCPFlagsTest(unittest.TestCase):
         self.assertEqual(TCPFlags('fsa').matches('fs'), True)
         self.assertRaises(ValueError, TCPFlags('').matches, 'a/s/')
         self.assertRaises(ValueError, TCPFlags('').matches, 'x')
+
+    def test_shared(self):
+        self.assert_(TCPFlags('SA') is TCPFlags(0x12))
+        self.assert_(TCPFlags(' as ') is TCPFlags(TCPFlags('SA')))
+        self.assert_(TCP_SYN | TCP_ACK is TCPFlags('SA'))
+        self.assert_(pickle.loads(pickle.dumps(TCP_SYN)) is TCP_SYN)
+        self.assert_(pickle.loads(pickle.dumps(TCP_SYN, 2)) is TCP_SYN)
+        self.assert_(copy.copy(TCP_SYN) is TCP_SYN)
+
+    def test_str_all(self):
+        names = 'FSRPAUEC'
+        for v in xrange(256):
+            flags = TCPFlags(v)
+            self.assertEqual(
+                str(flags),
+                ''.join(names[i] for i in xrange(8) if v & (1 << i)))
+            self.assertEqual(
+                flags.padded(),
+                ''.join(names[i] if v & (1 << i) else ' '
+                        for i in xrange(8)))
+
+    def test_histogram(self):
+        counts = TCPFlags.histogram([2, 18, 18, 16])
+        self.assertEqual(len(counts), 256)
+        self.assertEqual(counts[2], 1)
+        self.assertEqual(counts[18], 2)
+        self.assertEqual(counts[16], 1)
+        self.assertEqual(sum(counts), 4)
+        self.assertEqual(TCPFlags.histogram(array.array('B', [1, 1])),
+                         TCPFlags.histogram([1, 1]))
+        self.assertRaises(ValueError, TCPFlags.histogram, [1, 256])
+        self.assertRaises(ValueError, TCPFlags.histogram, [-1])
+        self.assertRaises(ValueError, TCPFlags.histogram, ['S'])
+        self.assertRaises(ValueError, TCPFlags.histogram, 5)
+
+    def test_flag_counts(self):
+        self.assertEqual(TCPFlags.flag_counts([2, 18, 18, 16, 0x81]),
+                         (1, 3, 0, 0, 3, 0, 0, 1))
+        self.assertEqual(TCPFlags.flag_counts([]), (0,) * 8)
+
+    def test_matches_mask(self):
+        values = [0x02, 0x12, 0x10, 0x03, 0x00]
+        self.assertEqual(TCPFlags.matches_mask(values, 'S', 'SA'),
+                         [True, False, False, True, False])
+        self.assertEqual(TCPFlags.matches_mask(values, TCP_SYN, 0x13),
+                         [True, False, False, False, False])
+        self.assertEqual(TCPFlags.matches_mask(values, 0, 0),
+                         [True] * 5)
+        self.assertEqual(
+            TCPFlags.matches_mask(values, 'S', 'SA'),
+            [TCPFlags(v).matches('S/SA') for v in values])
+        self.assertRaises(ValueError, TCPFlags.matches_mask, [256], 0, 0)
+        self.assertRaises(ValueError, TCPFlags.matches_mask, [[]], 0, 0)
+        self.assertRaises(ValueError, TCPFlags.matches_mask, [], 'X', 0)
+
+    def test_filter_1(self):
+        f = tcpflags_filter('S/SA')
+        self.assertEqual(f(0x02), True)
+        self.assertEqual(f(0x12), False)
+        self.assertEqual(f(TCP_SYN), True)
+        self.assertEqual(f('SF'), True)
+        self.assertEqual(f([0x02, 0x12, 0x03, 0x00]),
+                         [True, False, True, False])
+        self.assertEqual(f(array.array('B', [0x02, 0x10])), [True, False])
+        self.assertEqual(repr(f), "tcpflags_filter('S/SA')")
+
+    def test_filter_2(self):
+        f = tcpflags_filter('S/SA, SA/SA')
+        g = tcpflags_filter(['S/SA', (TCP_SYN | TCP_ACK, 'SA')])
+        for v in xrange(256):
+            expected = (TCPFlags(v).matches('S/SA') or
+                        TCPFlags(v).matches('SA/SA'))
+            self.assertEqual(f(v), expected)
+            self.assertEqual(g(v), expected)
+        self.assertEqual(f(range(256)), g(range(256)))
+        self.assertEqual(tcpflags_filter('FS')(0x03), True)
+
+    def test_filter_3(self):
+        self.assertRaises(ValueError, tcpflags_filter, 'S/SA/')
+        self.assertRaises(ValueError, tcpflags_filter, 'S/SA,X')
+        self.assertRaises(ValueError, tcpflags_filter, 'S/SA,')
+        self.assertRaises(ValueError, tcpflags_filter, 'S/SA, ,SA/SA')
+        self.assertRaises(ValueError, tcpflags_filter, '')
+        self.assertRaises(ValueError, tcpflags_filter, ',')
+        self.assertRaises(ValueError, tcpflags_filter, ' ')
+        self.assertRaises(ValueError, tcpflags_filter, [])
+        self.assertRaises(ValueError, tcpflags_filter, ['S/SA', ''])
+        self.assertRaises(TypeError, tcpflags_filter, 5)
+        self.assertRaises(TypeError, tcpflags_filter, [5])
+        f = tcpflags_filter('S/SA')
+        self.assertRaises(ValueError, f, 256)
+        self.assertRaises(ValueError, f, [1, 256])
+        self.assertRaises(ValueError, f, [-1])
+
+    def test_filter_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        f = tcpflags_filter('S/SA')
+        result = f(numpy.array([0x02, 0x12, 0x03], dtype=numpy.uint8))
+        self.assertEqual(result.dtype, numpy.bool_)
+        self.assertEqual(list(result), [True, False, True])
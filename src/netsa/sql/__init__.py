@@ -1,11 +1,16 @@
 # Copyright 2008-2016 by Carnegie Mellon University
 # See license information in LICENSE-OPENSOURCE.txt
 
+import datetime
 import os
 import re
 import threading
+import time
 import urllib
 
+# Number of rows fetched at a time by results
+DEFAULT_BATCH_SIZE = 1000
+
 class sql_exception(Exception):
     """
     Specific exceptions generated by :mod:`netsa.sql` derive from this.
@@ -19,6 +24,13 @@ class sql_no_driver_exception(sql_exception):
     """
     pass
 
+class sql_pool_timeout_exception(sql_exception):
+    """
+    This exception is raised when no connection becomes available in
+    a :class:`db_connection_pool` before the pool's timeout expires.
+    """
+    pass
+
 class sql_invalid_uri_exception(sql_exception):
     """
     This exception is raised when the URI passed to :func:`db_connect`
@@ -50,6 +62,14 @@ class db_driver(object):
         values from the URI.
         """
         return None
+    def connect_for_pool(self, uri, user, password):
+        """
+        Like :meth:`connect`, but for a connection which will be kept
+        in a :class:`db_connection_pool`, and so may be used by
+        different threads (though only by one at a time).  Drivers
+        override this if such connections must be opened differently.
+        """
+        return self.connect(uri, user, password)
     def create_pool(self, uri, user, password, **params):
         """
         Returns ``None`` if this :class:`db_driver` does not support
@@ -68,17 +88,37 @@ class db_connection(object):
     __slots__ = """
         _driver
         _variants
+        _batch_size
     """.split()
     def __init__(self, driver, variants):
         if not isinstance(driver, db_driver):
             raise TypeError("db_connection must be created based on db_driver")
         self._driver = driver
         self._variants = variants
+        self._batch_size = DEFAULT_BATCH_SIZE
     def get_driver(self):
         """
         Returns the :class:`db_driver` used to open this connection.
         """
         return self._driver
+    def get_batch_size(self):
+        """
+        Returns the number of rows fetched from the database at a time
+        by results from this connection.
+        """
+        return self._batch_size
+    def set_batch_size(self, batch_size):
+        """
+        Sets the number of rows fetched from the database at a time
+        by results of queries executed after this call.  Larger
+        batches mean fewer round trips to the database for large
+        result sets, at the cost of memory.  The default is
+        :data:`DEFAULT_BATCH_SIZE`.
+        """
+        if batch_size < 1:
+            value_error = ValueError("batch_size must be positive")
+            raise value_error
+        self._batch_size = batch_size
     def clone(self):
         """
         Returns a fresh open :class:`db_connection` open to the same
@@ -95,6 +135,45 @@ class db_connection(object):
         otherwise.
         """
         raise NotImplementedError("db_connection.execute")
+    def execute_many(self, query_or_sql, param_iter):
+        """
+        Executes the given SQL query (either a SQL string or a query
+        compiled with :class:`db_query`) for side effects once for
+        each :class:`dict` of variable bindings in *param_iter*, which
+        may be any iterable.  Returns the number of times the query
+        was executed.
+
+        Drivers do this as efficiently as the database allows (for
+        example by using the DB API ``executemany`` method), so this
+        is much faster than calling :meth:`execute` in a loop.  As
+        with :meth:`execute`, the changes are not committed until
+        :meth:`commit` is called.
+        """
+        query = _as_db_query(query_or_sql)
+        count = 0
+        for params in param_iter:
+            self.execute(query, **params)
+            count += 1
+        return count
+    def bulk_load(self, table, columns, row_iter):
+        """
+        Inserts rows into the table named *table*.  Each row in
+        *row_iter* (which may be any iterable) is a sequence with one
+        value for each of the column names in *columns*.  Returns the
+        number of rows inserted.
+
+        Rows are streamed into the database using the fastest method
+        available to the driver: ``COPY`` for PostgreSQL via
+        :mod:`psycopg2`, array binding for Oracle, and ``executemany``
+        otherwise.  The table and column names are put into the SQL
+        as they are, so they must come from a trusted source.  As
+        with :meth:`execute`, the changes are not committed until
+        :meth:`commit` is called.
+        """
+        query = _bulk_insert_query(table, columns)
+        param_names = ["c%d" % i for i in xrange(len(columns))]
+        return self.execute_many(
+            query, (dict(zip(param_names, row)) for row in row_iter))
     def commit(self):
         """
         Commits the current database transaction in progress.  Note
@@ -144,6 +223,14 @@ class db_pool(object):
         Returns a :class:`db_connection` subclass instance from the
         pool, open on the database specified when the pool was
         created.
+
+        The connection goes back to the pool when it is no longer
+        referenced, so a connection must not be kept any longer than
+        it is needed.  A :class:`db_connection_pool` also takes a
+        connection back when it is passed to
+        :meth:`db_connection_pool.release` or its ``close`` method is
+        called.  Until it is returned, a connection holds one of the
+        pool's connection slots.
         """
         raise NotImplementedError("db_pool.connect")
 
@@ -155,6 +242,7 @@ class db_result(object):
         _connection
         _query
         _params
+        _batch_size
     """.split()
     def __init__(self, connection, query, params):
         if not isinstance(connection, db_connection):
@@ -162,9 +250,10 @@ class db_result(object):
         if isinstance(query, db_query):
             self._query = query
         else:
-            self._query = db_query(query)
+            self._query = _as_db_query(query)
         self._connection = connection
         self._params = dict(params)
+        self._batch_size = connection.get_batch_size()
     def get_connection(self):
         """
         Returns the :class:`db_connection` which produced this result
@@ -197,7 +286,59 @@ class db_result(object):
         It is an error to attempt to iterate over a result set more
         than once, or multiple times at once.
         """
-        raise NotImplementedError("db_result.__iter__")
+        for rows in self._iter_fetch(self._batch_size):
+            for r in rows:
+                yield r
+    def iter_batches(self, batch_size=None, columns=False):
+        """
+        Returns an iterator over the rows of this result set in
+        batches of at most *batch_size* rows (by default, the batch
+        size of the connection).  Each batch is a :class:`list` of row
+        tuples, as returned by iteration over the result set.  If
+        *columns* is ``True``, each batch is instead a :class:`list`
+        with one :class:`list` of values for each column, which is
+        convenient for processing a column at a time.
+
+        As with iteration, it is an error to attempt to iterate over
+        a result set more than once, or multiple times at once.
+        """
+        if batch_size is None:
+            batch_size = self._batch_size
+        elif batch_size < 1:
+            value_error = ValueError("batch_size must be positive")
+            raise value_error
+        for rows in self._iter_fetch(batch_size):
+            if columns:
+                yield [list(c) for c in zip(*rows)]
+            else:
+                yield rows
+    def _iter_fetch(self, batch_size):
+        try:
+            while True:
+                rows = self._fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+            # Work around try: finally: not allowed in generators in 2.4
+        except:
+            self._close()
+            raise
+        self._close()
+    def _fetchmany(self, batch_size):
+        """
+        Returns a :class:`list` of up to *batch_size* more rows from
+        this result set, or an empty list when there are no more.
+        Drivers implement this (usually by calling ``fetchmany`` on a
+        DB API cursor) to support iteration.
+        """
+        raise NotImplementedError("db_result._fetchmany")
+    def _close(self):
+        """
+        Called when iteration over this result set ends, whether all
+        of the rows were read or not.  Drivers may override this to
+        release resources held by the result set.
+        """
+        pass
 
 _drivers = []
 _drivers_lock = threading.RLock()
@@ -310,19 +451,428 @@ def db_create_pool(uri, user=None, password=None, **params):
     as well as in the URI, the values given in this call override the
     values given in the URI.
 
+    If the driver for the URI does not provide its own pooling, a
+    :class:`db_connection_pool` is returned instead, and any
+    additional parameters are passed on to it.
+
     See :func:`db_connect` for details on database URIs.
     """
     parsed_uri = db_parse_uri(uri)
+    can_connect = False
     for d in get_drivers():
         if d.can_handle(parsed_uri['scheme']):
+            can_connect = True
             pool = d.create_pool(uri, user, password, **params)
             if pool:
                 return pool
+    if can_connect:
+        return db_connection_pool(uri, user, password, **params)
     no_driver = sql_no_driver_exception(
         "No pooled database driver for scheme %s found." %
         repr(parsed_uri['scheme']))
     raise no_driver
 
+class db_connection_pool(db_pool):
+    """
+    A thread-safe pool of connections to the database given by *uri*
+    (opened with *user* and *password*, as with :func:`db_connect`),
+    which works with any driver.
+
+    At most *max_size* connections are open at once.  When they are
+    all in use, :meth:`connect` waits for one to be returned, for up
+    to *timeout* seconds (or forever, if *timeout* is ``None``),
+    before raising :exc:`sql_pool_timeout_exception`.  *min_size*
+    connections are opened when the pool is created, and idle
+    connections beyond those are closed after *idle_timeout* seconds
+    (or never, if *idle_timeout* is ``None``).
+
+    If *check* is true, an idle connection is checked with a trivial
+    query before it is handed out, and is replaced if the check
+    fails.  *check* may also be a SQL string or :class:`db_query` to
+    use as the check.
+
+    Connections are best used with :meth:`connection`, which returns
+    them to the pool automatically::
+
+        pool = db_connection_pool("nsql-sqlite3:/var/db/flows.db",
+                                  max_size=4)
+        with pool.connection() as conn:
+            for (sensor, count) in conn.execute(count_query):
+                ...
+    """
+    __slots__ = """
+        _driver
+        _uri
+        _user
+        _password
+        _min_size
+        _max_size
+        _idle_timeout
+        _timeout
+        _check_query
+        _cond
+        _idle
+        _in_use
+        _size
+        _closed
+        _stats
+    """.split()
+    def __init__(self, uri, user=None, password=None, min_size=0,
+                 max_size=10, idle_timeout=None, timeout=None, check=True):
+        if max_size < 1:
+            value_error = ValueError("max_size must be positive")
+            raise value_error
+        if not (0 <= min_size <= max_size):
+            value_error = ValueError(
+                "min_size must be between 0 and max_size")
+            raise value_error
+        parsed_uri = db_parse_uri(uri)
+        driver = None
+        for d in get_drivers():
+            if d.can_handle(parsed_uri['scheme']):
+                driver = d
+                break
+        if driver is None:
+            no_driver = sql_no_driver_exception(
+                "No database driver for scheme %s found." %
+                repr(parsed_uri['scheme']))
+            raise no_driver
+        db_pool.__init__(self, driver)
+        self._uri = uri
+        self._user = user
+        self._password = password
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        if check is True:
+            self._check_query = _pool_check_query
+        elif check:
+            self._check_query = _as_db_query(check)
+        else:
+            self._check_query = None
+        # Reentrant, since a connection dropped by a reference cycle
+        # may be returned by the garbage collector with the lock held.
+        self._cond = threading.Condition(threading.RLock())
+        # (connection, time returned) pairs, most recently returned last
+        self._idle = []
+        self._in_use = set()
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            'checkouts': 0,
+            'creations': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'failed_checks': 0,
+            'expired': 0,
+            'discarded': 0,
+        }
+        for i in xrange(min_size):
+            self._size += 1
+            self._idle.append((self._open(), time.time()))
+    def _open(self):
+        # Opens a new connection for a slot already counted in _size
+        try:
+            conn = self._driver.connect_for_pool(
+                self._uri, self._user, self._password)
+        except:
+            self._remove(None)
+            raise
+        self._cond.acquire()
+        try:
+            self._stats['creations'] += 1
+        finally:
+            self._cond.release()
+        return conn
+    def _remove(self, stat):
+        # Gives up the slot of a connection which is being thrown away
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            if stat:
+                self._stats[stat] += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+    def _expire_idle(self, now):
+        # Must be called with the lock held
+        if self._idle_timeout is None:
+            return
+        while (self._idle and self._size > self._min_size and
+               self._idle[0][1] + self._idle_timeout < now):
+            del self._idle[0]
+            self._size -= 1
+            self._stats['expired'] += 1
+    def _check(self, conn):
+        if self._check_query is None:
+            return True
+        try:
+            for r in conn.execute(self._check_query):
+                pass
+        except Exception:
+            return False
+        return True
+    def connect(self):
+        """
+        Takes a connection out of the pool, opening a new one if none
+        are idle and the pool is not full, or waiting for one to be
+        returned otherwise.
+
+        The connection is returned to the pool by :meth:`release`, by
+        calling its ``close`` method, or when it is no longer
+        referenced (including by any result sets it produced), after
+        which it may no longer be used.  Until then it holds one of
+        the *max_size* connection slots.
+        """
+        wait_start = None
+        while True:
+            self._cond.acquire()
+            try:
+                if self._closed:
+                    closed = sql_exception("Connection pool is closed")
+                    raise closed
+                now = time.time()
+                self._expire_idle(now)
+                if self._idle:
+                    conn = self._idle.pop()[0]
+                elif self._size < self._max_size:
+                    self._size += 1
+                    conn = None
+                else:
+                    if wait_start is None:
+                        wait_start = now
+                        self._stats['waits'] += 1
+                    if self._timeout is None:
+                        self._cond.wait()
+                    else:
+                        remaining = wait_start + self._timeout - now
+                        if remaining <= 0:
+                            self._stats['timeouts'] += 1
+                            timed_out = sql_pool_timeout_exception(
+                                "No connection available after %g seconds"
+                                % self._timeout)
+                            raise timed_out
+                        self._cond.wait(remaining)
+                    continue
+            finally:
+                self._cond.release()
+            if conn is None:
+                conn = self._open()
+            elif not self._check(conn):
+                self._remove('failed_checks')
+                continue
+            break
+        self._cond.acquire()
+        try:
+            self._in_use.add(conn)
+            self._stats['checkouts'] += 1
+            if wait_start is not None:
+                self._stats['wait_time'] += time.time() - wait_start
+        finally:
+            self._cond.release()
+        return _db_pooled_connection(self, conn)
+    def release(self, connection):
+        """
+        Returns a connection obtained from :meth:`connect` to the
+        pool.  Any uncommitted changes are rolled back.  Releasing a
+        connection which has already been returned does nothing.
+        """
+        if not (isinstance(connection, _db_pooled_connection) and
+                connection._conn_pool is self):
+            value_error = ValueError(
+                "Connection was not checked out from this pool")
+            raise value_error
+        connection.close()
+    def _put_back(self, connection):
+        # Called by _db_pooled_connection.close with the real connection
+        self._cond.acquire()
+        try:
+            self._in_use.discard(connection)
+        finally:
+            self._cond.release()
+        try:
+            connection.rollback()
+            connection.set_batch_size(DEFAULT_BATCH_SIZE)
+        except Exception:
+            self._remove('discarded')
+            return
+        self._cond.acquire()
+        try:
+            if self._closed:
+                self._size -= 1
+            else:
+                now = time.time()
+                self._idle.append((connection, now))
+                self._expire_idle(now)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+    def connection(self):
+        """
+        Returns a context manager which takes a connection out of the
+        pool for the body of a ``with`` statement, and returns it to
+        the pool afterwards.
+        """
+        return _db_pool_checkout(self)
+    def close(self):
+        """
+        Closes the idle connections in the pool.  Connections which
+        are in use are closed when they are returned, and any further
+        attempt to :meth:`connect` raises :exc:`sql_exception`.
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._size -= len(self._idle)
+            del self._idle[:]
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+    def get_stats(self):
+        """
+        Returns a :class:`dict` of statistics about the use of this
+        pool, for use in sizing it.  The keys are:
+
+        ``size``, ``idle``, ``in_use``
+            The number of connections currently open, idle, and
+            checked out.
+        ``checkouts``, ``creations``
+            The number of times a connection has been checked out,
+            and the number of connections opened.
+        ``waits``, ``wait_time``, ``timeouts``
+            The number of checkouts which had to wait for a
+            connection to be returned, the total number of seconds
+            spent waiting, and the number which gave up waiting.
+        ``failed_checks``, ``expired``, ``discarded``
+            The number of connections closed because they failed a
+            health check, were idle too long, or could not be rolled
+            back when returned.
+        """
+        self._cond.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = len(self._in_use)
+        finally:
+            self._cond.release()
+        return stats
+
+class _db_pool_checkout(object):
+    __slots__ = """
+        _pool
+        _conn
+    """.split()
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+    def __enter__(self):
+        self._conn = self._pool.connect()
+        return self._conn
+    def __exit__(self, exc_type, exc_value, traceback):
+        conn = self._conn
+        self._conn = None
+        self._pool.release(conn)
+        return False
+
+class _db_pooled_connection(db_connection):
+    """
+    A connection checked out of a :class:`db_connection_pool`, which
+    passes work on to the pool's connection and gives that back to
+    the pool when closed or garbage collected.
+    """
+    __slots__ = """
+        _conn_pool
+        _conn
+        _fetches
+    """.split()
+    def __init__(self, pool, conn):
+        self._conn = None
+        db_connection.__init__(self, conn.get_driver(), conn.get_variants())
+        self._conn_pool = pool
+        self._conn = conn
+        # Iterations over result sets which are still being read
+        self._fetches = set()
+    def _get_conn(self):
+        conn = self._conn
+        if conn is None:
+            released = sql_exception(
+                "Connection has been returned to the pool")
+            raise released
+        return conn
+    def get_batch_size(self):
+        return self._get_conn().get_batch_size()
+    def set_batch_size(self, batch_size):
+        self._get_conn().set_batch_size(batch_size)
+    def clone(self):
+        return self._get_conn().clone()
+    def execute(self, query_or_sql, **params):
+        result = self._get_conn().execute(query_or_sql, **params)
+        if isinstance(result, db_result):
+            # Keep this connection checked out while rows are read
+            result = _db_pooled_result(self, result)
+        return result
+    def execute_many(self, query_or_sql, param_iter):
+        return self._get_conn().execute_many(query_or_sql, param_iter)
+    def bulk_load(self, table, columns, row_iter):
+        return self._get_conn().bulk_load(table, columns, row_iter)
+    def commit(self):
+        self._get_conn().commit()
+    def rollback(self):
+        self._get_conn().rollback()
+    def close(self):
+        """
+        Returns this connection to the pool.  Any uncommitted changes
+        are rolled back.
+        """
+        conn = self._conn
+        if conn is not None:
+            self._conn = None
+            fetches = list(self._fetches)
+            self._fetches.clear()
+            try:
+                # Finish any result sets still being read, so that they
+                # clean up while the connection is still ours.
+                for fetch in fetches:
+                    fetch.close()
+            finally:
+                self._conn_pool._put_back(conn)
+    def _end_fetch(self, fetch):
+        self._fetches.discard(fetch)
+        fetch.close()
+    def __del__(self):
+        self.close()
+
+class _db_pooled_result(db_result):
+    __slots__ = """
+        _result
+    """.split()
+    def __init__(self, connection, result):
+        db_result.__init__(self, connection, result.get_query(),
+                           result.get_params())
+        self._result = result
+    def _iter_fetch(self, batch_size):
+        conn = self._connection
+        conn._get_conn()
+        fetch = self._result._iter_fetch(batch_size)
+        conn._fetches.add(fetch)
+        try:
+            while True:
+                # Stop if the connection has gone back to the pool
+                conn._get_conn()
+                try:
+                    rows = fetch.next()
+                except StopIteration:
+                    break
+                yield rows
+            # Work around try: finally: not allowed in generators in 2.4
+        except:
+            conn._end_fetch(fetch)
+            raise
+        conn._end_fetch(fetch)
+
 query_param_exp = r"(?xsm) : [a-zA-Z_][a-zA-Z_0-9]*"
 query_quote_exp = r"(?xsm) ' (?: [^'\\] | \\. | '' | '[ \t]*\n[ \t*]') * ' "
 query_other_exp = r"(?xsm) ([^:'] | ::)+"
@@ -331,6 +881,226 @@ query_param_re = re.compile(query_param_exp)
 query_quote_re = re.compile(query_quote_exp)
 query_other_re = re.compile(query_other_exp)
 
+# Queries made for plain SQL strings given to execute, so that the
+# same SQL doesn't need to be converted again every time.
+_sql_query_cache = {}
+_sql_query_cache_max = 1024
+
+def _as_db_query(query_or_sql):
+    if isinstance(query_or_sql, db_query):
+        return query_or_sql
+    sql = query_or_sql
+    try:
+        return _sql_query_cache[sql]
+    except KeyError:
+        pass
+    except TypeError:
+        # Not hashable, so let db_query deal with it
+        return db_query(sql)
+    if len(_sql_query_cache) >= _sql_query_cache_max:
+        _sql_query_cache.clear()
+    query = _sql_query_cache[sql] = db_query(sql)
+    return query
+
+def _bulk_insert_query(table, columns):
+    # Makes a query to insert one row of values for the given columns,
+    # with the params named c0, c1, ...
+    return db_query("insert into %s (%s) values (%s)" %
+                    (table, ", ".join(columns),
+                     ", ".join(":c%d" % i for i in xrange(len(columns)))))
+
+def _copy_text_value(value, encoding='utf-8'):
+    # Converts a value to PostgreSQL COPY text format, with unicode
+    # encoded to match the connection's client encoding
+    if value is None:
+        return "\\N"
+    if isinstance(value, unicode):
+        value = value.encode(encoding)
+    elif isinstance(value, float):
+        # str() only keeps 12 significant digits
+        value = repr(value)
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat(' ')
+    elif not isinstance(value, str):
+        value = str(value)
+    if '\\' in value:
+        value = value.replace('\\', '\\\\')
+    if '\t' in value or '\n' in value or '\r' in value:
+        value = value.replace('\t', '\\t').replace('\n', '\\n') \
+                     .replace('\r', '\\r')
+    return value
+
+class _row_counter(object):
+    """
+    Wraps an iterator, counting the items taken from it.  Used by
+    drivers to report how many rows were passed to ``executemany``.
+    """
+    __slots__ = """
+        _rows
+        count
+    """.split()
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self.count = 0
+    def __iter__(self):
+        return self
+    def next(self):
+        r = self._rows.next()
+        self.count += 1
+        return r
+
+class _copy_text_reader(object):
+    """
+    A file-like object that reads a stream of rows as PostgreSQL
+    ``COPY ... FROM STDIN`` text format, for drivers that can load
+    data that way.  Only as many rows are converted as are needed for
+    each read.  Unicode values are encoded with *encoding*, which
+    should be the Python name of the connection's client encoding.
+    """
+    __slots__ = """
+        _rows
+        _buffer
+        _encoding
+        count
+    """.split()
+    def __init__(self, row_iter, encoding='utf-8'):
+        self._rows = iter(row_iter)
+        self._buffer = ""
+        self._encoding = encoding
+        self.count = 0
+    def _line(self, row):
+        encoding = self._encoding
+        return "\t".join([_copy_text_value(v, encoding) for v in row]) + "\n"
+    def readline(self, size=-1):
+        if self._buffer:
+            data = self._buffer
+            self._buffer = ""
+            return data
+        for row in self._rows:
+            self.count += 1
+            return self._line(row)
+        return ""
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        n = len(self._buffer)
+        for row in self._rows:
+            line = self._line(row)
+            chunks.append(line)
+            n += len(line)
+            self.count += 1
+            if 0 <= size <= n:
+                break
+        data = "".join(chunks)
+        if 0 <= size < len(data):
+            (data, self._buffer) = (data[:size], data[size:])
+        else:
+            self._buffer = ""
+        return data
+
+# Helpers shared by the PostgreSQL drivers
+
+def _pg_execute_many(pg_conn, sql, param_iter, execute_batch=None,
+                     page_size=1000):
+    # Runs the pyformat sql once for each dict of params in param_iter
+    # on the DB API connection pg_conn, using psycopg2's execute_batch
+    # if it's given, and returns how many times it was run.
+    counter = _row_counter(param_iter)
+    cursor = pg_conn.cursor()
+    if execute_batch:
+        execute_batch(cursor, sql, counter, page_size=page_size)
+    else:
+        cursor.executemany(sql, counter)
+    cursor.close()
+    return counter.count
+
+def _pg_bulk_load(pg_conn, table, columns, row_iter, encoding='utf-8'):
+    # Streams the rows through COPY, which is much faster than any
+    # kind of insert, and returns how many there were.
+    reader = _copy_text_reader(row_iter, encoding)
+    cursor = pg_conn.cursor()
+    cursor.copy_expert("copy %s (%s) from stdin" %
+                       (table, ", ".join(columns)), reader)
+    cursor.close()
+    return reader.count
+
+# Names of server-side cursors which have been closed, and so can be
+# used again.  A name is only put back once its cursor is closed, so
+# names in use are never shared, even across connections.
+_pg_cursor_names = []
+_pg_cursor_names_count = 0
+_pg_cursor_names_lock = threading.Lock()
+
+def _pg_get_cursor_name():
+    global _pg_cursor_names_count
+    _pg_cursor_names_lock.acquire()
+    try:
+        if _pg_cursor_names:
+            return _pg_cursor_names.pop()
+        _pg_cursor_names_count += 1
+        return "_netsa_sql_cursor_%d" % _pg_cursor_names_count
+    finally:
+        _pg_cursor_names_lock.release()
+
+def _pg_release_cursor_name(name):
+    _pg_cursor_names_lock.acquire()
+    try:
+        _pg_cursor_names.append(name)
+    finally:
+        _pg_cursor_names_lock.release()
+
+_pg_select_re = re.compile(r"^\s*(select|with)\b", re.I)
+_pg_from_re = re.compile(r"\bfrom\b", re.I)
+_pg_limit_re = re.compile(r"\blimit\s+(\d+)\s*;?\s*$", re.I)
+
+def _pg_want_server_cursor(sql, options, fetch_size):
+    # Only queries can be read through a cursor
+    if not _pg_select_re.match(sql):
+        return False
+    if options.get('withhold') or options.get('scrollable'):
+        return True
+    # Queries without a from clause (e.g. "select nextval(...)"), or
+    # with a limit that fits in one fetch, return few enough rows
+    # that a cursor would just add round trips.
+    if not _pg_from_re.search(sql):
+        return False
+    m = _pg_limit_re.search(sql)
+    if m and int(m.group(1)) <= fetch_size:
+        return False
+    return True
+
+def _pg_cursor_options(sql, options, default_fetch_size):
+    # Returns whether to run sql through a server-side cursor, and
+    # the number of rows to fetch from it at a time, given the
+    # query's options (see db_query.with_options).
+    fetch_size = options.get('fetch_size', default_fetch_size)
+    if fetch_size < 1:
+        value_error = ValueError("fetch_size must be positive")
+        raise value_error
+    cursor_mode = options.get('cursor', 'auto')
+    if cursor_mode == 'auto':
+        use_cursor = _pg_want_server_cursor(sql, options, fetch_size)
+    elif cursor_mode in ('server', 'client'):
+        use_cursor = (cursor_mode == 'server')
+    else:
+        value_error = ValueError(
+            "cursor must be 'auto', 'server', or 'client', not %r" %
+            cursor_mode)
+        raise value_error
+    return (use_cursor, fetch_size)
+
+def _pg_declare_sql(name, sql, options):
+    # Returns SQL to declare a server-side cursor with the given name
+    # for sql, as the query's options ask.
+    if options.get('scrollable'):
+        scroll = "scroll"
+    else:
+        scroll = "no scroll"
+    if options.get('withhold'):
+        hold = " with hold"
+    else:
+        hold = ""
+    return "declare %s %s cursor%s for %s" % (name, scroll, hold, sql)
+
 def _map_params(sql, param_func, other_func=None):
     # Convert query in a general way, calling param_func on each
     # param and putting what param_func returns into the
@@ -340,29 +1110,29 @@ def _map_params(sql, param_func, other_func=None):
             return x
         other_func = noop
     (i, l, m) = (0, len(sql), True)
-    result = ""
+    result = []
     while m and i < l:
         m = query_param_re.match(sql, i)
         if m:
-            result += param_func(m.group()[1:])
+            result.append(param_func(m.group()[1:]))
             i = m.end()
             continue
         m = query_quote_re.match(sql, i)
         if m:
-            result += other_func(m.group())
+            result.append(other_func(m.group()))
             i = m.end()
             continue
         m = query_other_re.match(sql, i)
         if m:
-            result += other_func(m.group())
+            result.append(other_func(m.group()))
             i = m.end()
             continue
         # No matches.  Accept that, and pass through characters until
         # we match again.
         m = True
-        result += other_func(sql[i])
+        result.append(other_func(sql[i]))
         i += 1
-    return result
+    return ''.join(result)
 
 def _map_params_positional(sql, param_func, other_func=None):
     param_names = []
@@ -403,20 +1173,71 @@ class db_query(object):
     has the same effect as::
 
         conn.execute(test_query, ...)
+
+    Options controlling how the query is executed may be attached
+    using :meth:`with_options`.
     """
     __slots__ = """
         _sql
         _variants
+        _compiled
+        _options
     """.split()
     def __init__(self, sql, **variants):
         self._sql = sql
         self._variants = variants
+        # (accepted variants, paramstyle) -> (sql, param names)
+        self._compiled = {}
+        self._options = {}
     def __call__(self, _conn, **params):
         """
         Execute this :class:`db_query` on the given
         :class:`db_connection` with parameters.
         """
         return _conn.execute(self, **params)
+    def with_options(self, **options):
+        """
+        Returns a copy of this :class:`db_query` with the given
+        execution options added to (or replacing) its current
+        options.  Options are hints to the driver, and any options a
+        driver does not understand are ignored.  The PostgreSQL
+        drivers understand the following:
+
+        ``cursor``
+            ``'server'`` to read results through a server-side
+            cursor, a batch of rows at a time, ``'client'`` to read
+            all of the results at once, or ``'auto'`` (the default)
+            to use a server-side cursor for queries that may return
+            many rows.
+
+        ``fetch_size``
+            The number of rows to fetch from a server-side cursor at
+            a time.  Larger values suit large exports.
+
+        ``withhold``
+            If true, the server-side cursor remains usable after the
+            transaction that created it is committed.
+
+        ``scrollable``
+            If true, the server-side cursor is declared ``scroll``.
+
+        For example::
+
+            export_query = db_query("select * from flows").with_options(
+                cursor='server', fetch_size=50000)
+        """
+        query = db_query(self._sql, **self._variants)
+        # Options don't change the SQL, so share the translations
+        query._compiled = self._compiled
+        query._options = dict(self._options)
+        query._options.update(options)
+        return query
+    def get_options(self):
+        """
+        Returns the :class:`dict` of execution options for this
+        query, as given to :meth:`with_options`.
+        """
+        return self._options
     def get_variant_sql(self, accepted_variants):
         """
         Given a list of accepted variant tags, returns the most
@@ -428,28 +1249,68 @@ class db_query(object):
             if v in self._variants:
                 return self._variants[v]
         return self._sql
+    def get_variant_compiled(self, accepted_variants, paramstyle):
+        """
+        Given a list of accepted variant tags and the name of a DB API
+        2.0 paramstyle (``'qmark'``, ``'numeric'``, ``'named'``,
+        ``'format'``, or ``'pyformat'``), returns the most appropriate
+        SQL for this query converted to that paramstyle, and a list of
+        the names of the params in the order their placeholders
+        appear.  The result is computed once and then cached, which
+        makes this useful for drivers that execute the same query
+        many times.
+        """
+        key = (tuple(accepted_variants), paramstyle)
+        try:
+            return self._compiled[key]
+        except KeyError:
+            pass
+        sql = self.get_variant_sql(accepted_variants)
+        other_func = None
+        if paramstyle == 'qmark':
+            def param_func(param_name):
+                return "?"
+        elif paramstyle == 'numeric':
+            param_num = [0]
+            def param_func(param_name):
+                param_num[0] += 1
+                return ":%d" % param_num[0]
+        elif paramstyle == 'named':
+            def param_func(param_name):
+                return ":%s" % param_name
+        elif paramstyle == 'format':
+            def other_func(x):
+                return x.replace('%', '%%')
+            def param_func(param_name):
+                return "%s"
+        elif paramstyle == 'pyformat':
+            def other_func(x):
+                return x.replace('%', '%%')
+            def param_func(param_name):
+                return "%%(%s)s" % param_name
+        else:
+            value_error = ValueError(
+                "Unknown paramstyle %s" % repr(paramstyle))
+            raise value_error
+        compiled = _map_params_positional(sql, param_func, other_func)
+        self._compiled[key] = compiled
+        return compiled
     def get_variant_qmark_params(self, accepted_variants, params):
         """
         Like :meth:`get_variant_format_parms`, but for the DB API 2.0
         'format' paramstyle (i.e. ``%s`` placeholders).  This also
         escapes any percent signs originally present in the query.
         """
-        sql = self.get_variant_sql(accepted_variants)
-        def param_func_qmark(param_name):
-            return "?"
-        (sql, param_names) = _map_params_positional(sql, param_func_qmark)
+        (sql, param_names) = \
+            self.get_variant_compiled(accepted_variants, 'qmark')
         return (sql, [params[p] for p in param_names])
     def get_variant_numeric_params(self, accepted_variants, params):
         """
         Like :meth:`get_variant_format_params`, but for the DB API 2.0
         'numeric' paramstyle (i.e. ``:<n>`` placeholders).
         """
-        sql = self.get_variant_sql(accepted_variants)
-        param_num = [0]
-        def param_func_numeric(param_name):
-            param_num[0] += 1
-            return ":%d" % param_num[0]
-        (sql, param_names) = _map_params_positional(sql, param_func_numeric)
+        (sql, param_names) = \
+            self.get_variant_compiled(accepted_variants, 'numeric')
         return (sql, [params[p] for p in param_names])
     def get_variant_named_params(self, accepted_variants, params):
         """
@@ -458,10 +1319,8 @@ class db_query(object):
         this paramstyle is the native style required by the
         :mod:`netsa.sql` API.
         """
-        sql = self.get_variant_sql(accepted_variants)
-        def param_func_named(param_name):
-            return ":%s" % param_name
-        sql = _map_params(sql, param_func_named)
+        (sql, param_names) = \
+            self.get_variant_compiled(accepted_variants, 'named')
         return (sql, params)
     def get_variant_format_params(self, accepted_variants, params):
         """
@@ -473,13 +1332,8 @@ class db_query(object):
         style, and a list of params suitable for filling those
         placeholders.
         """
-        sql = self.get_variant_sql(accepted_variants)
-        def other_func_format(x):
-            return x.replace('%', '%%')
-        def param_func_format(param_name):
-            return "%s"
         (sql, param_names) = \
-            _map_params_positional(sql, param_func_format, other_func_format)
+            self.get_variant_compiled(accepted_variants, 'format')
         return (sql, [params[p] for p in param_names])
     def get_variant_pyformat_params(self, accepted_variants, params):
         """
@@ -490,12 +1344,8 @@ class db_query(object):
         query.
 
         """
-        sql = self.get_variant_sql(accepted_variants)
-        def other_func_pyformat(x):
-            return x.replace('%', '%%')
-        def param_func_pyformat(param_name):
-            return "%%(%s)s" % param_name
-        sql = _map_params(sql, param_func_pyformat, other_func_pyformat)
+        (sql, param_names) = \
+            self.get_variant_compiled(accepted_variants, 'pyformat')
         return (sql, params)
 
 # <scheme>://<netloc>/<path>[;<params>][?<query>][#<fragment>]
@@ -560,6 +1410,9 @@ def db_parse_uri(uri):
         'fragment': frag,
     }
 
+# Query used to check the health of pooled connections
+_pool_check_query = db_query("select 1", oracle="select 1 from dual")
+
 # Bring in the deprecated legacy connection function
 from netsa.sql.legacy import connect_uri
 
@@ -568,9 +1421,11 @@ __all__ = """
     sql_exception
     sql_no_driver_exception
     sql_invalid_uri_exception
+    sql_pool_timeout_exception
 
     db_connect
     db_create_pool
+    db_connection_pool
     db_query
 
     connect_uri
@@ -3,6 +3,10 @@
 
 import cx_Oracle
 import netsa.sql
+from itertools import islice
+
+# Number of rows to bind as an array per execute in execute_many
+_BATCH_SIZE = 1000
 
 class cxo_driver(netsa.sql.db_driver):
     __slots__ = """
@@ -51,6 +55,33 @@ class cxo_connection(netsa.sql.db_connection):
         return cxo_connection(self._user, self._password, self._dsn)
     def execute(self, query_or_sql, **params):
         return cxo_result(self, query_or_sql, params)
+    def execute_many(self, query_or_sql, param_iter):
+        query = netsa.sql._as_db_query(query_or_sql)
+        (sql, param_names) = \
+            query.get_variant_compiled(self.get_variants(), 'named')
+        rows = (dict((n, params[n]) for n in param_names)
+                for params in param_iter)
+        return self._execute_many(sql, rows)
+    def bulk_load(self, table, columns, row_iter):
+        sql = ("insert into %s (%s) values (%s)" %
+               (table, ", ".join(columns),
+                ", ".join(":%d" % (i + 1) for i in xrange(len(columns)))))
+        return self._execute_many(sql, (tuple(row) for row in row_iter))
+    def _execute_many(self, sql, rows):
+        # Bind the rows as arrays, a batch at a time, so that each
+        # round trip to the server inserts many rows.
+        cursor = self._cx_oracle_conn.cursor()
+        cursor.prepare(sql)
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(islice(rows, _BATCH_SIZE))
+            if not batch:
+                break
+            cursor.executemany(None, batch)
+            count += len(batch)
+        cursor.close()
+        return count
     def commit(self):
         self._cx_oracle_conn.commit()
     def rollback(self):
@@ -64,15 +95,16 @@ class cxo_result(netsa.sql.db_result):
     def __init__(self, connection, query, params):
         netsa.sql.db_result.__init__(self, connection, query, params)
         self._cx_oracle_cursor = self._connection._cx_oracle_conn.cursor()
+        # Have the server send a whole batch of rows per round trip,
+        # including with the reply to the execute itself.
+        self._cx_oracle_cursor.arraysize = self._batch_size
+        if hasattr(self._cx_oracle_cursor, 'prefetchrows'):
+            self._cx_oracle_cursor.prefetchrows = self._batch_size + 1
         variants = self._connection.get_variants()
         (query, params) = \
             self._query.get_variant_named_params(variants, params)
         self._cx_oracle_cursor.execute(query, params)
-    def __iter__(self):
-        while True:
-            r = self._cx_oracle_cursor.fetchone()
-            if r == None:
-                return
-            yield r
+    def _fetchmany(self, batch_size):
+        return self._cx_oracle_cursor.fetchmany(batch_size)
 
 netsa.sql.register_driver(cxo_driver())
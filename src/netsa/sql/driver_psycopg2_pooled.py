@@ -2,10 +2,16 @@
 # See license information in LICENSE-OPENSOURCE.txt
 
 import psycopg2
+import psycopg2.extensions
 import netsa.sql
-import threading
 
-# Number of rows to fetch per cursor iteration
+try:
+    from psycopg2.extras import execute_batch as _execute_batch
+except ImportError:
+    # psycopg2 before 2.7
+    _execute_batch = None
+
+# Default number of rows to fetch per cursor iteration
 _CURSOR_SIZE = 4096
 
 class ppg_driver(netsa.sql.db_driver):
@@ -105,16 +111,12 @@ class ppg_connection(netsa.sql.db_connection):
         _psycopg2_conn
         _ppg_connparams
         _ppg_pool
-        _cursor_counter
-        _cursor_counter_lock
     """.split()
     def __init__(self, driver, variants, conn, pool=None, connparams=None):
         netsa.sql.db_connection.__init__(self, driver, variants)
         self._psycopg2_conn = conn
         self._ppg_pool = pool
         self._ppg_connparams = connparams
-        self._cursor_counter = 0
-        self._cursor_counter_lock = threading.Lock()
         self.execute("set timezone = 0")
     def clone(self):
         if self._ppg_pool != None:
@@ -125,22 +127,28 @@ class ppg_connection(netsa.sql.db_connection):
                                   connparams=self._ppg_connparams)
     def execute(self, query_or_sql, **params):
         return ppg_result(self, query_or_sql, params)
+    def execute_many(self, query_or_sql, param_iter):
+        query = netsa.sql._as_db_query(query_or_sql)
+        (sql, param_names) = \
+            query.get_variant_compiled(self.get_variants(), 'pyformat')
+        return netsa.sql._pg_execute_many(
+            self._psycopg2_conn, sql, param_iter, _execute_batch)
+    def bulk_load(self, table, columns, row_iter):
+        encoding = psycopg2.extensions.encodings.get(
+            self._psycopg2_conn.encoding, 'utf-8')
+        return netsa.sql._pg_bulk_load(
+            self._psycopg2_conn, table, columns, row_iter, encoding)
     def commit(self):
         self._psycopg2_conn.commit()
     def rollback(self):
         if self._psycopg2_conn:
             self._psycopg2_conn.rollback()
-    def _next_cursor_name(self):
-        self._cursor_counter_lock.acquire()
-        n = self._cursor_counter
-        self._cursor_counter += 1
-        self._cursor_counter_lock.release()
-        return "_netsa_sql_cursor_%d" % n
 
 class ppg_result(netsa.sql.db_result):
     __slots__ = """
         _psycopg2_cursor
         _pg_cursor_name
+        _pg_fetch_size
     """.split()
     def __init__(self, connection, query, params):
         netsa.sql.db_result.__init__(self, connection, query, params)
@@ -148,47 +156,47 @@ class ppg_result(netsa.sql.db_result):
         variants = self._connection.get_variants()
         (query, params) = \
             self._query.get_variant_pyformat_params(variants, params)
-        # Does it look like a query?
-        if (query.lstrip()[:6].lower() == 'select' or
-                query.lstrip()[:4].lower() == 'with'):
-            # Yes, let's use a server-side cursor on it.
-            self._pg_cursor_name = self._connection._next_cursor_name()
-            query = ("declare %s no scroll cursor for %s" %
-                     (self._pg_cursor_name, query))
-            self._psycopg2_cursor.execute(query, params)
+        options = self._query.get_options()
+        (use_cursor, self._pg_fetch_size) = \
+            netsa.sql._pg_cursor_options(query, options, _CURSOR_SIZE)
+        if use_cursor:
+            # Use a server-side cursor, and fetch the results in chunks
+            self._pg_cursor_name = netsa.sql._pg_get_cursor_name()
+            query = netsa.sql._pg_declare_sql(
+                self._pg_cursor_name, query, options)
+            try:
+                self._psycopg2_cursor.execute(query, params)
+            except:
+                netsa.sql._pg_release_cursor_name(self._pg_cursor_name)
+                self._pg_cursor_name = None
+                raise
             # If the cursor isn't fetched from, the query will not
             # begin to execute at all, which means side effects won't
             # happen.
             self._psycopg2_cursor.execute(
                 "fetch forward %d from %s" %
-                (_CURSOR_SIZE, self._pg_cursor_name))
+                (self._pg_fetch_size, self._pg_cursor_name))
         else:
             # No, run the query as-is.
             self._pg_cursor_name = None
             self._psycopg2_cursor.execute(query, params)
-    def __iter__(self):
-        if self._pg_cursor_name == None:
-            # Non-cursored query, process it directly
-            while True:
-                r = self._psycopg2_cursor.fetchone()
-                if r == None:
-                    return
-                yield r
-        else:
-            # New cursored query, process it in chunks
-            try:
-                while self._psycopg2_cursor.rowcount:
-                    for r in self._psycopg2_cursor.fetchall():
-                        yield r
-                    self._psycopg2_cursor.execute(
-                        "fetch forward %d from %s" %
-                        (_CURSOR_SIZE, self._pg_cursor_name))
-                # Work around try: finally: not allowed in generators in 2.4
-            except:
-                self._psycopg2_cursor.execute(
-                    "close %s" % self._pg_cursor_name)
-                raise
-            self._psycopg2_cursor.execute(
-                "close %s" % self._pg_cursor_name)
+    def _fetchmany(self, batch_size):
+        cursor = self._psycopg2_cursor
+        rows = cursor.fetchmany(batch_size)
+        if self._pg_cursor_name != None:
+            # Cursored query, fetch more rows from the server until
+            # the batch is full or there are no more
+            while len(rows) < batch_size and cursor.rowcount > 0:
+                cursor.execute(
+                    "fetch forward %d from %s" %
+                    (self._pg_fetch_size, self._pg_cursor_name))
+                rows.extend(cursor.fetchmany(batch_size - len(rows)))
+        return rows
+    def _close(self):
+        if self._pg_cursor_name != None:
+            name = self._pg_cursor_name
+            self._pg_cursor_name = None
+            self._psycopg2_cursor.execute("close %s" % name)
+            netsa.sql._pg_release_cursor_name(name)
 
 netsa.sql.register_driver(ppg_driver())
@@ -79,6 +79,13 @@ class pgs_connection(netsa.sql.db_connection):
                               self._password, self._sslmode)
     def execute(self, query_or_sql, **params):
         return pgs_result(self, query_or_sql, params)
+    def execute_many(self, query_or_sql, param_iter):
+        query = netsa.sql._as_db_query(query_or_sql)
+        (sql, param_names) = \
+            query.get_variant_compiled(self.get_variants(), 'pyformat')
+        return netsa.sql._pg_execute_many(
+            self._pgdb_conn, sql,
+            (_fix_datetime_params(params) for params in param_iter))
     def commit(self):
         self._pgdb_conn.commit()
     def rollback(self):
@@ -91,6 +98,18 @@ class pgs_connection(netsa.sql.db_connection):
         self._cursor_counter_lock.release()
         return "_netsa_sql_cursor_%d" % n
 
+def _fix_datetime_params(params):
+    # Work around mx vs. standard datetime issues
+    fixed = None
+    for k in params:
+        if isinstance(params[k], datetime.datetime):
+            if fixed is None:
+                fixed = dict(params)
+            fixed[k] = str(params[k])
+    if fixed is None:
+        return params
+    return fixed
+
 class pgs_result(netsa.sql.db_result):
     __slots__ = """
         _pgdb_cursor
@@ -124,28 +143,20 @@ class pgs_result(netsa.sql.db_result):
             # No, run the query as-is.
             self._pg_cursor_name = None
             self._pgdb_cursor.execute(query, params)
-    def __iter__(self):
-        if self._pg_cursor_name == None:
-            # Non-cursored query, process it diretly
-            while True:
-                r = self._pgdb_cursor.fetchone()
-                if r == None:
-                    return
-                yield r
-        else:
-            # New cursored query, process it in chunks
-            try:
-                while self._pgdb_cursor.rowcount:
-                    for r in self._pgdb_cursor.fetchall():
-                        yield r
-                    self._pgdb_cursor.execute(
-                        "fetch forward %d from %s" %
-                        (_CURSOR_SIZE, self._pg_cursor_name))
-                # Work around try: finally: not allowed in generators in 2.4
-            except:
-                self._pgdb_cursor.execute(
-                    "close %s" % self._pg_cursor_name)
-                raise
+    def _fetchmany(self, batch_size):
+        cursor = self._pgdb_cursor
+        rows = cursor.fetchmany(batch_size)
+        if self._pg_cursor_name != None:
+            # Cursored query, fetch more rows from the server until
+            # the batch is full or there are no more
+            while len(rows) < batch_size and cursor.rowcount > 0:
+                cursor.execute(
+                    "fetch forward %d from %s" %
+                    (_CURSOR_SIZE, self._pg_cursor_name))
+                rows.extend(cursor.fetchmany(batch_size - len(rows)))
+        return rows
+    def _close(self):
+        if self._pg_cursor_name != None:
             self._pgdb_cursor.execute(
                 "close %s" % self._pg_cursor_name)
 
@@ -60,11 +60,7 @@ class sl_result(netsa.sql.db_result):
             if isinstance(params[k], datetime.datetime):
                 params[k] = datetime_iso(params[k])
         self._sqlite_cursor.execute(query, params)
-    def __iter__(self):
-        while True:
-            r = self._sqlite_cursor.fetchone()
-            if r == None:
-                return
-            yield r
+    def _fetchmany(self, batch_size):
+        return self._sqlite_cursor.fetchmany(batch_size)
 
 netsa.sql.register_driver(sl_driver())
@@ -11,6 +11,12 @@ class sl3_driver(netsa.sql.db_driver):
         scheme = "nsql-sqlite3"
         return (uri_scheme == scheme or uri_scheme.startswith(scheme + "-"))
     def connect(self, uri, user, password):
+        return self._connect(uri, check_same_thread=True)
+    def connect_for_pool(self, uri, user, password):
+        # A pool hands connections between threads, though each is
+        # only used by one thread at a time.
+        return self._connect(uri, check_same_thread=False)
+    def _connect(self, uri, check_same_thread):
         parsed_uri = netsa.sql.db_parse_uri(uri)
         if not self.can_handle(parsed_uri['scheme']):
             return None
@@ -19,6 +25,7 @@ class sl3_driver(netsa.sql.db_driver):
         return sl3_connection(
             self, ['sqlite3'],
             database=parsed_uri['path'],
+            check_same_thread=check_same_thread,
         )
 
 class sl3_connection(netsa.sql.db_connection):
@@ -27,19 +34,36 @@ class sl3_connection(netsa.sql.db_connection):
 
         _sqlite3_conn
     """.split()
-    def __init__(self, driver, variants, database):
+    def __init__(self, driver, variants, database, check_same_thread=True):
         netsa.sql.db_connection.__init__(self, driver, variants)
         self._database = database
         self._sqlite3_conn = None
-        self._connect()
-    def _connect(self):
+        self._connect(check_same_thread)
+    def _connect(self, check_same_thread):
         self._sqlite3_conn = sqlite3.connect(
             database=self._database,
-            detect_types=sqlite3.PARSE_DECLTYPES)
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=check_same_thread)
     def clone(self):
         return sl3_connection(self._driver, self._variants, self._database)
     def execute(self, query_or_sql, **params):
         return sl3_result(self, query_or_sql, params)
+    def execute_many(self, query_or_sql, param_iter):
+        query = netsa.sql._as_db_query(query_or_sql)
+        (sql, param_names) = \
+            query.get_variant_compiled(self.get_variants(), 'qmark')
+        rows = ([params[n] for n in param_names] for params in param_iter)
+        return self._execute_many(sql, rows)
+    def bulk_load(self, table, columns, row_iter):
+        sql = ("insert into %s (%s) values (%s)" %
+               (table, ", ".join(columns), ", ".join("?" * len(columns))))
+        return self._execute_many(sql, row_iter)
+    def _execute_many(self, sql, rows):
+        # sqlite3 runs all of the rows inside the one implicit
+        # transaction, which is much faster than a transaction per row.
+        counter = netsa.sql._row_counter(rows)
+        self._sqlite3_conn.cursor().executemany(sql, counter)
+        return counter.count
     def commit(self):
         self._sqlite3_conn.commit()
     def rollback(self):
@@ -57,11 +81,7 @@ class sl3_result(netsa.sql.db_result):
         (query, params) = \
             self._query.get_variant_qmark_params(variants, params)
         self._sqlite3_cursor.execute(query, params)
-    def __iter__(self):
-        while True:
-            r = self._sqlite3_cursor.fetchone()
-            if r == None:
-                return
-            yield r
+    def _fetchmany(self, batch_size):
+        return self._sqlite3_cursor.fetchmany(batch_size)
 
 netsa.sql.register_driver(sl3_driver())
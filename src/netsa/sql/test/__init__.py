@@ -1,6 +1,8 @@
 # Copyright 2008-2016 by Carnegie Mellon University
 # See license information in LICENSE-OPENSOURCE.txt
 
+import threading
+import time
 import unittest
 import netsa.sql
 
@@ -135,9 +137,332 @@ class db_query(unittest.TestCase):
             sql, ("select * from test where z = %(a)s",
                   {'a': 1, 'b': 2, 'c': 3}))
 
+    def test_compiled_cache(self):
+        params = {'a': 1, 'b': 2, 'c': 3}
+        first = self.test_query.get_variant_format_params(['x'], params)
+        second = self.test_query.get_variant_format_params(['x'], params)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.test_query.get_variant_qmark_params(['x'], params),
+            ("select * from test where x = ? and b = ? and c = ?",
+             [1, 2, 1]))
+        self.assertEqual(
+            self.test_query.get_variant_format_params(['y'], params),
+            ("select * from test where y = %s and b = %s", [1, 2]))
+
+    def test_with_options(self):
+        params = {'a': 1, 'b': 2, 'c': 3}
+        query = self.test_query.with_options(cursor='server')
+        query2 = query.with_options(fetch_size=10, cursor='client')
+        self.assertEqual(self.test_query.get_options(), {})
+        self.assertEqual(query.get_options(), {'cursor': 'server'})
+        self.assertEqual(query2.get_options(),
+                         {'cursor': 'client', 'fetch_size': 10})
+        self.assertEqual(
+            query2.get_variant_qmark_params(['y'], params),
+            self.test_query.get_variant_qmark_params(['y'], params))
+
+class db_execute_many(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = netsa.sql.db_connect("nsql-sqlite3::memory:")
+        self.conn.execute("create table test (a integer, b text)")
+
+    def test_execute_many(self):
+        count = self.conn.execute_many(
+            "insert into test (b, a) values (:b, :a)",
+            ({'a': i, 'b': str(i * 2), 'c': None} for i in xrange(100)))
+        self.assertEqual(count, 100)
+        self.assertEqual(
+            list(self.conn.execute("select sum(a), count(b) from test")),
+            [(4950, 100)])
+
+    def test_bulk_load(self):
+        count = self.conn.bulk_load(
+            "test", ["a", "b"], ((i, "x%d" % i) for i in xrange(10)))
+        self.assertEqual(count, 10)
+        self.conn.rollback()
+        self.assertEqual(list(self.conn.execute("select * from test")), [])
+        count = self.conn.bulk_load("test", ["b", "a"], [("y", 1)])
+        self.conn.commit()
+        self.assertEqual(count, 1)
+        self.assertEqual(list(self.conn.execute("select * from test")),
+                         [(1, u"y")])
+
+    def test_bulk_load_generic(self):
+        # The generic fallback builds an insert and uses execute_many
+        count = netsa.sql.db_connection.bulk_load(
+            self.conn, "test", ["a", "b"], [(1, "p"), (2, None)])
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            list(self.conn.execute("select * from test order by a")),
+            [(1, u"p"), (2, None)])
+
+    def test_copy_text_reader(self):
+        rows = [(1, None, "a\tb\\c"), (u"\u00e9", "x\ny", 2.5)]
+        data = netsa.sql._copy_text_reader(rows).read()
+        self.assertEqual(
+            data, "1\t\\N\ta\\tb\\\\c\n\xc3\xa9\tx\\ny\t2.5\n")
+        reader = netsa.sql._copy_text_reader(rows)
+        chunks = []
+        while True:
+            chunk = reader.read(5)
+            if not chunk:
+                break
+            self.assert_(len(chunk) <= 5)
+            chunks.append(chunk)
+        self.assertEqual("".join(chunks), data)
+        self.assertEqual(reader.count, 2)
+        # Floats keep their full precision, and unicode is encoded in
+        # the given encoding
+        data = netsa.sql._copy_text_reader(
+            [(1.0 / 3, 0.1 + 0.2, u"\u00e9")], 'latin-1').read()
+        self.assertEqual(
+            data, "0.3333333333333333\t0.30000000000000004\t\xe9\n")
+
+class db_result_batches(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = netsa.sql.db_connect("nsql-sqlite3::memory:")
+        self.conn.execute("create table test (a integer, b text)")
+        self.conn.bulk_load("test", ["a", "b"],
+                            ((i, "x%d" % i) for i in xrange(10)))
+
+    def test_iter(self):
+        self.conn.set_batch_size(3)
+        self.assertEqual(self.conn.get_batch_size(), 3)
+        self.assertEqual(
+            [a for (a, b) in self.conn.execute("select * from test")],
+            range(10))
+        self.assertRaises(ValueError, self.conn.set_batch_size, 0)
+
+    def test_iter_batches(self):
+        result = self.conn.execute("select * from test")
+        batches = list(result.iter_batches(4))
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        self.assertEqual(batches[2], [(8, u"x8"), (9, u"x9")])
+
+    def test_iter_batches_columns(self):
+        result = self.conn.execute("select * from test where a < 5")
+        batches = list(result.iter_batches(columns=True))
+        self.assertEqual(
+            batches,
+            [[[0, 1, 2, 3, 4], [u"x0", u"x1", u"x2", u"x3", u"x4"]]])
+
+class db_connection_pool(unittest.TestCase):
+
+    def test_checkout(self):
+        pool = netsa.sql.db_create_pool("nsql-sqlite3::memory:", max_size=2)
+        self.assert_(isinstance(pool, netsa.sql.db_connection_pool))
+        with pool.connection() as conn:
+            self.assertEqual(list(conn.execute("select 1")), [(1,)])
+            first = conn._conn
+        with pool.connection() as conn:
+            self.assert_(conn._conn is first)
+        stats = pool.get_stats()
+        self.assertEqual((stats['checkouts'], stats['creations']), (2, 1))
+        self.assertEqual((stats['size'], stats['idle'], stats['in_use']),
+                         (1, 1, 0))
+        self.assertRaises(netsa.sql.sql_exception, conn.execute, "select 1")
+        pool.release(conn)
+        self.assertRaises(ValueError, pool.release, first)
+        other = netsa.sql.db_connection_pool("nsql-sqlite3::memory:")
+        self.assertRaises(ValueError, other.release, pool.connect())
+
+    def test_dropped_connections(self):
+        pool = netsa.sql.db_connection_pool(
+            "nsql-sqlite3::memory:", max_size=1, timeout=0.01)
+        for i in xrange(3):
+            conn = pool.connect()
+            del conn
+        conn = pool.connect()
+        conn.close()
+        conn.close()
+        # A result set keeps its connection out of the pool
+        result = pool.connect().execute("select 1")
+        self.assertRaises(netsa.sql.sql_pool_timeout_exception, pool.connect)
+        self.assertEqual(list(result), [(1,)])
+        self.assert_(result.get_connection().get_batch_size() > 0)
+        del result
+        stats = pool.get_stats()
+        self.assertEqual((stats['checkouts'], stats['creations']), (5, 1))
+        self.assertEqual((stats['idle'], stats['in_use']), (1, 0))
+
+    def test_results_after_release(self):
+        pool = netsa.sql.db_connection_pool("nsql-sqlite3::memory:")
+        with pool.connection() as conn:
+            conn.execute("create table t (a integer)")
+            conn.execute_many("insert into t values (:a)",
+                              ({'a': i} for i in xrange(10)))
+            conn.commit()
+            conn.set_batch_size(2)
+            unread = conn.execute("select a from t")
+            partly_read = conn.execute("select a from t")
+            batches = partly_read.iter_batches()
+            self.assertEqual(batches.next(), [(0,), (1,)])
+        other = pool.connect()
+        self.assertRaises(netsa.sql.sql_exception, list, unread)
+        self.assertRaises(netsa.sql.sql_exception, list, batches)
+        self.assertEqual(len(list(other.execute("select a from t"))), 10)
+        self.assertEqual(pool.get_stats()['creations'], 1)
+
+    def test_sqlite3_threads(self):
+        # Only connections opened by a pool may change threads
+        pool = netsa.sql.db_connection_pool("nsql-sqlite3::memory:")
+        conns = [pool.connect(), netsa.sql.db_connect("nsql-sqlite3::memory:")]
+        errors = []
+        def work():
+            for conn in conns:
+                try:
+                    list(conn.execute("select 1"))
+                except Exception, e:
+                    errors.append(e)
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_timeout(self):
+        pool = netsa.sql.db_connection_pool(
+            "nsql-sqlite3::memory:", max_size=1, timeout=0.01)
+        conn = pool.connect()
+        self.assertRaises(netsa.sql.sql_pool_timeout_exception, pool.connect)
+        pool.release(conn)
+        conn = pool.connect()
+        stats = pool.get_stats()
+        self.assertEqual((stats['waits'], stats['timeouts']), (1, 1))
+        self.assertEqual(stats['creations'], 1)
+
+    def test_threads(self):
+        pool = netsa.sql.db_connection_pool(
+            "nsql-sqlite3::memory:", min_size=1, max_size=2)
+        results = []
+        def work():
+            with pool.connection() as conn:
+                time.sleep(0.01)
+                results.extend(conn.execute("select 1"))
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(1,)] * 8)
+        stats = pool.get_stats()
+        self.assertEqual(stats['checkouts'], 8)
+        self.assert_(stats['creations'] <= 2)
+        self.assert_(stats['waits'] > 0)
+        self.assertEqual(stats['failed_checks'], 0)
+
+    def test_check_and_expire(self):
+        pool = netsa.sql.db_connection_pool(
+            "nsql-sqlite3::memory:", check="select * from no_such_table")
+        pool.release(pool.connect())
+        conn = pool.connect()
+        stats = pool.get_stats()
+        self.assertEqual((stats['failed_checks'], stats['creations']), (1, 2))
+        pool = netsa.sql.db_connection_pool(
+            "nsql-sqlite3::memory:", min_size=1, idle_timeout=0)
+        conns = [pool.connect(), pool.connect()]
+        kept = conns[1]._conn
+        for conn in conns:
+            pool.release(conn)
+        time.sleep(0.01)
+        self.assert_(pool.connect()._conn is kept)
+        stats = pool.get_stats()
+        self.assertEqual((stats['expired'], stats['size']), (1, 1))
+
+class _fake_pg_cursor(object):
+    # Records what is done with a DB API cursor
+    def __init__(self, log):
+        self.log = log
+    def executemany(self, sql, params):
+        self.log.append((sql, list(params)))
+    def copy_expert(self, sql, f):
+        self.log.append((sql, f.read()))
+    def close(self):
+        pass
+
+class _fake_pg_conn(object):
+    def __init__(self):
+        self.log = []
+    def cursor(self):
+        return _fake_pg_cursor(self.log)
+
+class pg_helpers(unittest.TestCase):
+
+    def test_want_server_cursor(self):
+        def check(sql, **options):
+            return netsa.sql._pg_cursor_options(sql, options, 100)[0]
+        self.assert_(check("select * from flows"))
+        self.assert_(check("  WITH x as (select 1) select * from x"))
+        self.assert_(check("select * from flows limit 1000"))
+        # Not a query
+        self.assertFalse(check("insert into flows values (1)"))
+        self.assertFalse(check("selection"))
+        # No from clause, or a limit that fits in one fetch
+        self.assertFalse(check("select nextval('flow_ids')"))
+        self.assertFalse(check("select * from flows limit 100;"))
+        self.assertFalse(
+            check("select * from flows limit 1000", fetch_size=5000))
+        # withhold and scrollable need a server-side cursor
+        self.assert_(check("select 1", withhold=True))
+        self.assert_(check("select * from flows limit 5", scrollable=True))
+        self.assertFalse(check("update flows set x = 1", withhold=True))
+        # Explicit modes
+        self.assert_(check("select 1", cursor="server"))
+        self.assertFalse(check("select * from flows", cursor="client"))
+
+    def test_cursor_options(self):
+        self.assertEqual(
+            netsa.sql._pg_cursor_options("select * from t", {}, 4096),
+            (True, 4096))
+        self.assertEqual(
+            netsa.sql._pg_cursor_options("select * from t",
+                                         {'fetch_size': 10}, 4096),
+            (True, 10))
+        self.assertRaises(ValueError, netsa.sql._pg_cursor_options,
+                          "select * from t", {'fetch_size': 0}, 4096)
+        self.assertRaises(ValueError, netsa.sql._pg_cursor_options,
+                          "select * from t", {'cursor': 'bogus'}, 4096)
+
+    def test_declare_sql(self):
+        self.assertEqual(
+            netsa.sql._pg_declare_sql("c", "select 1", {}),
+            "declare c no scroll cursor for select 1")
+        self.assertEqual(
+            netsa.sql._pg_declare_sql(
+                "c", "select 1", {'withhold': True, 'scrollable': True}),
+            "declare c scroll cursor with hold for select 1")
+
+    def test_cursor_names(self):
+        a = netsa.sql._pg_get_cursor_name()
+        b = netsa.sql._pg_get_cursor_name()
+        self.assertNotEqual(a, b)
+        netsa.sql._pg_release_cursor_name(a)
+        self.assertEqual(netsa.sql._pg_get_cursor_name(), a)
+        netsa.sql._pg_release_cursor_name(a)
+        netsa.sql._pg_release_cursor_name(b)
+
+    def test_execute_many_and_bulk_load(self):
+        conn = _fake_pg_conn()
+        rows = [{'a': 1}, {'a': 2}]
+        self.assertEqual(
+            netsa.sql._pg_execute_many(conn, "insert %(a)s", iter(rows)), 2)
+        self.assertEqual(conn.log, [("insert %(a)s", rows)])
+        conn = _fake_pg_conn()
+        self.assertEqual(
+            netsa.sql._pg_bulk_load(conn, "t", ["a", "b"],
+                                    iter([(1, "x"), (2, None)])), 2)
+        self.assertEqual(conn.log,
+                         [("copy t (a, b) from stdin", "1\tx\n2\t\\N\n")])
+
 __all__ = """
 
     db_connect
     db_query
+    db_execute_many
+    db_result_batches
+    db_connection_pool
+    pg_helpers
 
 """.split()
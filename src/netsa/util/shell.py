@@ -121,8 +121,13 @@ __docformat__ = "restructuredtext en"
 
 import copy
 import errno
+import fcntl
+import heapq
+import itertools
 import netsa
 import os
+import Queue
+import re
 import select
 import shlex
 import signal
@@ -136,6 +141,50 @@ try:
 except:
     MAXFD = 256
 
+# Directories listing a process's own open file descriptors, if the
+# platform has one.
+_FD_DIRS = ["/proc/self/fd", "/dev/fd"]
+
+def _close_fds(low=3):
+    """
+    Closes every file descriptor numbered *low* or higher in the
+    current process.  Used in a freshly forked child before exec.
+    Only the descriptors that are actually open get closed, by listing
+    them out of :data:`_FD_DIRS`, so the cost doesn't grow with the
+    descriptor limit (which can be a million or more).  If no listing
+    is available, falls back to closing every possible descriptor up
+    to :data:`MAXFD`.
+    """
+    for fd_dir in _FD_DIRS:
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        # On some systems /dev/fd is a static 0, 1, 2 whatever is
+        # open.  A real listing also shows the descriptor used to read
+        # the directory, so anything that short isn't trusted.
+        if len(fds) <= low:
+            continue
+        for name in fds:
+            try:
+                fd = int(name)
+            except ValueError:
+                continue
+            if fd >= low:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        return
+    if hasattr(os, 'closerange'):
+        os.closerange(low, MAXFD)
+    else:
+        for i in xrange(low, MAXFD):
+            try:
+                os.close(i)
+            except:
+                pass
+
 # Exception for reporting a pipeline failure (failure during runtime
 # of the pipeline, not config failure setting it up.
 class PipelineException(Exception):
@@ -206,6 +255,50 @@ def open_stream(stream, mode):
         raise TypeError("Invalid type to open as stream (fd)")
     return (stream, stream_file)
 
+class Resource_usage(object):
+    """
+    Resources used by a single process in a pipeline, as found in the
+    result of :func:`run_parallel`.  All values are ``None`` when they
+    are not known, for example because the process is still running
+    or was never started.
+
+      *start_time*, *end_time*
+        Wall-clock times (as from :func:`time.time`) when the process
+        was started and when its exit was noticed.
+      *utime*, *stime*
+        User and system CPU time used by the process, in seconds.
+      *maxrss*
+        Maximum resident set size of the process, in the units used by
+        :func:`os.wait4` (kilobytes on Linux).
+      *bytes_out*
+        Number of bytes the process wrote to the next command in its
+        pipeline, if the *count_bytes* option was given.
+    """
+    __slots__ = ['start_time', 'end_time', 'utime', 'stime', 'maxrss',
+                 'bytes_out']
+    def __init__(self):
+        self.start_time = None
+        self.end_time = None
+        self.utime = None
+        self.stime = None
+        self.maxrss = None
+        self.bytes_out = None
+    def _set_end(self, rusage):
+        self.end_time = time.time()
+        if rusage is not None:
+            self.utime = rusage.ru_utime
+            self.stime = rusage.ru_stime
+            self.maxrss = rusage.ru_maxrss
+    def get_wall_time(self):
+        "Seconds between the start and end of the process."
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+    def __repr__(self):
+        return "<Resource_usage %s>" % ', '.join(
+            "%s=%r" % (k, getattr(self, k)) for k in self.__slots__
+            if getattr(self, k) is not None)
+
 class Task(object):
     __slots__ = ['_task_groups', '_name', '_cond_var']
     def __init__(self, name,
@@ -269,15 +362,24 @@ class Task(object):
         before the process was run), will have an exit status of
         ``None``."""
         raise NotImplementedError("Task.get_exit_status")
+    def get_resource_usage(self):
+        """Returns a list of :class:`Resource_usage` objects, one for
+        each exit status returned by :meth:`get_exit_status`."""
+        raise NotImplementedError("Task.get_resource_usage")
 
 class Task_group(object):
-    __slots__ = ['_name', '_tasks', '_running_tasks', '_failed', '_cond_var']
-    def __init__(self, name=None):
+    __slots__ = ['_name', '_tasks', '_running_tasks', '_failed', '_cond_var',
+                 '_on_idle']
+    def __init__(self, name=None, on_idle=None):
         self._name = name
         self._tasks = []
         self._running_tasks = set([])
         self._failed = False
         self._cond_var = threading.Condition()
+        # Called with this group whenever its last running task
+        # finishes.  May be called with locks held, so it mustn't
+        # block.
+        self._on_idle = on_idle
     def __str__(self):
         return self.get_status()
     def get_name(self):
@@ -316,6 +418,8 @@ class Task_group(object):
                     # It was a failure: boom
                     self.abort()
                 self._cond_var.notifyAll()
+                if not self._running_tasks and self._on_idle is not None:
+                    self._on_idle(self)
         finally:
             self._cond_var.release()
     def abort(self):
@@ -326,12 +430,13 @@ class Task_group(object):
                 return
             else:
                 self._failed = True
-            # Make thread to do the aborting,  Ungh.
+            # Have the supervisor do the aborting, since we may be
+            # called with other locks held.
             running_tasks = list(self._running_tasks)
             def abort_subtasks():
                 for task in running_tasks:
                     task.abort()
-            threading.Thread(target=abort_subtasks).start()
+            get_supervisor().call_later(0, abort_subtasks)
         finally:
             self._cond_var.release()
     def is_running(self):
@@ -347,17 +452,275 @@ class Task_group(object):
         finally:
             self._cond_var.release()
     def get_status(self):
-        return '\n'.join(task.get_status() for task in self._tasks)
+        return '\n'.join(filter(None, (task.get_status()
+                                       for task in self._tasks)))
     def get_exit_status(self):
         return [s for task in self._tasks for s in task.get_exit_status()]
+    def get_resource_usage(self):
+        return [u for task in self._tasks for u in task.get_resource_usage()]
 
 NUKE_DELAY = 4.0                # Seconds before using SIGKILL after SIGTERM
+STDERR_LIMIT = 64 * 1024        # Bytes of stderr output kept per command
+
+# Shortest and longest intervals between checks for exited children
+SUPERVISOR_MIN_POLL = 0.001
+SUPERVISOR_MAX_POLL = 0.05
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class Supervisor(object):
+    """
+    Watches over every running :class:`Task_process` from a single
+    thread, however many there are.  The supervisor collects the
+    stderr output of each process that has a stderr pipe, reaps each
+    process when it exits, and runs delayed actions such as killing
+    processes which do not respond to SIGTERM.
+
+    Exited processes are detected by polling :func:`os.waitpid` for
+    each child with ``WNOHANG``.  The polling interval starts short
+    whenever something happens and backs off while nothing does.  A
+    ``SIGCHLD`` handler can't be used, since Python only allows signal
+    handlers to be set from the main thread, and children of other
+    parts of the program must not be reaped here.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owner_pid = os.getpid()
+        self._thread = None
+        (self._wake_in, self._wake_out) = os.pipe()
+        _set_nonblocking(self._wake_in)
+        _set_nonblocking(self._wake_out)
+        # pid -> Task_process for running children
+        self._children = {}
+        # fd -> Task_process for open stderr pipes
+        self._readers = {}
+        # heap of (time, sequence, function) for delayed actions
+        self._timers = []
+        self._timer_seq = 0
+        self._poll = SUPERVISOR_MIN_POLL
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="netsa.util.shell")
+            self._thread.setDaemon(True)
+            self._thread.start()
+    def _wake(self):
+        try:
+            os.write(self._wake_out, 'x')
+        except OSError:
+            # The pipe is full, so a wakeup is already pending
+            pass
+    def add_child(self, pid, task, stderr_fd=None):
+        """
+        Starts watching the process *pid*, belonging to *task*.  If
+        *stderr_fd* is not ``None``, it is the read end of a pipe from
+        the process's stderr, and will be closed by the supervisor.
+        """
+        self._lock.acquire()
+        try:
+            self._children[pid] = task
+            if stderr_fd is not None:
+                _set_nonblocking(stderr_fd)
+                self._readers[stderr_fd] = task
+            self._poll = SUPERVISOR_MIN_POLL
+            self._start()
+        finally:
+            self._lock.release()
+        self._wake()
+    def call_later(self, delay, func):
+        """
+        Calls *func* from the supervisor thread after *delay* seconds.
+        """
+        self._lock.acquire()
+        try:
+            self._timer_seq += 1
+            heapq.heappush(self._timers,
+                           (time.time() + delay, self._timer_seq, func))
+            self._start()
+        finally:
+            self._lock.release()
+        self._wake()
+    def _read_stderr(self, fd, task):
+        """
+        Reads whatever is available from the stderr pipe *fd*.  Returns
+        ``False`` once the pipe has been closed and removed.
+        """
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                data = ""
+            if data:
+                task._add_stderr(data)
+                continue
+            self._lock.acquire()
+            try:
+                del self._readers[fd]
+            finally:
+                self._lock.release()
+            os.close(fd)
+            return False
+    def _reap(self):
+        """
+        Collects the exit status of any children which have exited.
+        """
+        self._lock.acquire()
+        try:
+            children = self._children.items()
+        finally:
+            self._lock.release()
+        reaped = False
+        for (pid, task) in children:
+            rusage = None
+            try:
+                if hasattr(os, 'wait4'):
+                    (result_pid, result_exit, rusage) = \
+                        os.wait4(pid, os.WNOHANG)
+                else:
+                    (result_pid, result_exit) = os.waitpid(pid, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                # Someone else reaped our child: we can't know how it
+                # exited.
+                (result_pid, result_exit) = (pid, 255 << 8)
+            if result_pid == 0:
+                continue
+            reaped = True
+            self._lock.acquire()
+            try:
+                del self._children[pid]
+                fds = [fd for (fd, t) in self._readers.iteritems()
+                       if t is task]
+            finally:
+                self._lock.release()
+            # Take any remaining stderr output before reporting the
+            # exit.  Don't wait for EOF, since the process may have
+            # left children of its own holding the pipe open.
+            for fd in fds:
+                if self._read_stderr(fd, task):
+                    self._lock.acquire()
+                    try:
+                        del self._readers[fd]
+                    finally:
+                        self._lock.release()
+                    os.close(fd)
+            task._set_status(result_exit, rusage)
+        return reaped
+    def _run_timers(self):
+        while True:
+            self._lock.acquire()
+            try:
+                if not (self._timers and self._timers[0][0] <= time.time()):
+                    return
+                func = heapq.heappop(self._timers)[2]
+            finally:
+                self._lock.release()
+            try:
+                func()
+            except:
+                traceback.print_exc()
+    def _run(self):
+        while True:
+            try:
+                self._run_once()
+            except:
+                if traceback is None:
+                    # The interpreter is shutting down and has cleared
+                    # out the module globals, so there's nothing to do.
+                    return
+                # Keep supervising, whatever happens
+                traceback.print_exc()
+                time.sleep(SUPERVISOR_MAX_POLL)
+    def _run_once(self):
+        self._lock.acquire()
+        try:
+            fds = self._readers.keys()
+            timeout = None
+            if self._children:
+                timeout = self._poll
+            if self._timers:
+                delay = max(0, self._timers[0][0] - time.time())
+                if timeout is None or delay < timeout:
+                    timeout = delay
+        finally:
+            self._lock.release()
+        try:
+            if hasattr(select, 'poll'):
+                # poll has no limit on the number of descriptors
+                poller = select.poll()
+                for fd in [self._wake_in] + fds:
+                    poller.register(fd, select.POLLIN)
+                if timeout is not None:
+                    timeout = int(timeout * 1000)
+                rl = [fd for (fd, event) in poller.poll(timeout)]
+            else:
+                (rl, wl, xl) = select.select([self._wake_in] + fds, [], [],
+                                             timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        active = False
+        for fd in rl:
+            if fd == self._wake_in:
+                try:
+                    while os.read(self._wake_in, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            self._lock.acquire()
+            try:
+                task = self._readers.get(fd)
+            finally:
+                self._lock.release()
+            if task is not None and not self._read_stderr(fd, task):
+                # EOF on stderr usually means the process exited
+                active = True
+        if self._reap():
+            active = True
+        self._lock.acquire()
+        try:
+            if active:
+                self._poll = SUPERVISOR_MIN_POLL
+            elif not rl:
+                self._poll = min(self._poll * 2, SUPERVISOR_MAX_POLL)
+        finally:
+            self._lock.release()
+        self._run_timers()
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def get_supervisor():
+    """
+    Returns the :class:`Supervisor` for this process, creating it if
+    needed.  A forked child gets a new supervisor of its own, since the
+    supervisor thread does not survive the fork.
+    """
+    global _supervisor
+    _supervisor_lock.acquire()
+    try:
+        if _supervisor is None or _supervisor._owner_pid != os.getpid():
+            _supervisor = Supervisor()
+        return _supervisor
+    finally:
+        _supervisor_lock.release()
 
 class Task_process(Task):
     __slots__ = ['_exit_status', '_ignore_exits', '_pid',
-                 '_stderr_text', '_aborted']
+                 '_stderr_chunks', '_stderr_size', '_stderr_dropped',
+                 '_stderr_limit', '_stderr_callback', '_stderr_partial',
+                 '_aborted', '_status_count', '_usage']
     def __init__(self, args, fin, fout, ferr, fout_append, ferr_append,
-                 ignore_exits, fout_to_ferr):
+                 ignore_exits, fout_to_ferr, status_count=1,
+                 stderr_limit=STDERR_LIMIT, stderr_callback=None):
         Task.__init__(self, format_args(args),
                       fin, fout, ferr, fout_append, ferr_append)
         self._cond_var.acquire()
@@ -366,26 +729,28 @@ class Task_process(Task):
             self._exit_status = None
             self._ignore_exits = ignore_exits
             self._pid = None
-            self._stderr_text = ""
-
-            # If ferr is None, let's set up a collector thread
+            # Only the last stderr_limit bytes of stderr are reported.
+            # It's kept as a list of chunks, which is compacted down
+            # to the limit whenever it gets to twice that.
+            self._stderr_chunks = []
+            self._stderr_size = 0
+            self._stderr_dropped = 0
+            self._stderr_limit = stderr_limit
+            # Called with each complete line of stderr, if given
+            self._stderr_callback = stderr_callback
+            self._stderr_partial = ""
+            # Number of pipeline commands this process stands for
+            self._status_count = status_count
+            self._usage = Resource_usage()
+
+            # If ferr is None, the supervisor collects stderr for us
             used_own_ferr = False
+            ferr_in = None
             if ferr is None:
                 used_own_ferr = True
                 (ferr_in, ferr) = os.pipe()
-                def collect_stderr():
-                    try:
-                        last_read = None
-                        while self.is_running():
-                            (rl, wl, xl) = select.select([ferr_in], [], [], 1.0)
-                            if rl:
-                                while last_read != "":
-                                    last_read = os.read(ferr_in, 1024)
-                                    self._stderr_text += last_read
-                    finally:
-                        os.close(ferr_in)
-                threading.Thread(target=collect_stderr).start()
             # All of our ducks are lined up.
+            self._usage.start_time = time.time()
             pid = os.fork()
             if pid == 0:
                 # Child
@@ -413,11 +778,7 @@ class Task_process(Task):
                                 open_stream(ferr, ferr_append and 'a' or 'w')
                             os.dup2(err_fd, 2)
                         # Close everything else
-                        for i in xrange(3, MAXFD):
-                            try:
-                                os.close(i)
-                            except:
-                                pass
+                        _close_fds(3)
                         if callable(args[0]):
                             # The "program" is actually a function
                             try:
@@ -450,14 +811,69 @@ class Task_process(Task):
             if used_own_ferr:
                 os.close(ferr)
             self._pid = pid
-            def wait_for_process():
-                (result_pid, result_exit) = os.waitpid(self._pid, 0)
-                assert result_pid == self._pid
-                self._set_status(result_exit)
-            threading.Thread(target=wait_for_process).start()
+            get_supervisor().add_child(pid, self, ferr_in)
         finally:
             self._cond_var.release()
-    def _set_status(self, status):
+    def _add_stderr(self, data):
+        self._cond_var.acquire()
+        try:
+            self._stderr_chunks.append(data)
+            self._stderr_size += len(data)
+            if self._stderr_size > 2 * self._stderr_limit:
+                (text, dropped) = self._stderr_tail()
+                self._stderr_chunks = [text]
+                self._stderr_size = len(text)
+                self._stderr_dropped = dropped
+            lines = None
+            if self._stderr_callback is not None:
+                text = self._stderr_partial + data
+                lines = text.split('\n')
+                partial = lines.pop()
+                # Lines longer than the limit are passed on in pieces,
+                # so that stderr stays bounded while it's streamed
+                size = max(self._stderr_limit, 1)
+                if len(text) > size:
+                    lines = _split_long_lines(lines, size)
+                    while len(partial) > size:
+                        lines.append(partial[:size])
+                        partial = partial[size:]
+                self._stderr_partial = partial
+        finally:
+            self._cond_var.release()
+        # Don't hold the lock while running somebody else's code
+        if lines:
+            self._call_stderr_callback(lines)
+    def _call_stderr_callback(self, lines):
+        for line in lines:
+            try:
+                self._stderr_callback(line)
+            except:
+                traceback.print_exc()
+    def _stderr_tail(self):
+        # Returns the last stderr_limit bytes of stderr, and the
+        # number of bytes before them.  Called with the lock held.
+        text = ''.join(self._stderr_chunks)
+        dropped = self._stderr_dropped
+        if len(text) > self._stderr_limit:
+            dropped += len(text) - self._stderr_limit
+            text = text[len(text) - self._stderr_limit:]
+        return (text, dropped)
+    def get_stderr(self):
+        """
+        Returns the stderr output collected so far, or the end of it
+        if there was more than the limit.
+        """
+        self._cond_var.acquire()
+        try:
+            return self._stderr_tail()[0]
+        finally:
+            self._cond_var.release()
+    def _set_status(self, status, rusage=None):
+        self._usage._set_end(rusage)
+        if self._stderr_partial:
+            # Pass on the last line, which had no newline
+            self._call_stderr_callback([self._stderr_partial])
+            self._stderr_partial = ""
         self._cond_var.acquire()
         try:
             self._exit_status = status
@@ -494,11 +910,9 @@ class Task_process(Task):
             return
         # Try SIGTERM
         self._abort(signal.SIGTERM)
-        # Set up a thread to try SIGKILL in a short time
-        def delayed_nuke():
-            time.sleep(NUKE_DELAY)
-            self._abort(signal.SIGKILL)
-        threading.Thread(target=delayed_nuke).start()
+        # Try SIGKILL in a short time
+        get_supervisor().call_later(
+            NUKE_DELAY, lambda: self._abort(signal.SIGKILL))
     def is_running(self):
         self._cond_var.acquire()
         try:
@@ -532,17 +946,93 @@ class Task_process(Task):
             else:
                 stat_line = self.get_name() + " " + \
                     format_status(self._exit_status)
-            if self._stderr_text:
-                stderr_text = self._stderr_text
+            (stderr_text, dropped) = self._stderr_tail()
+            if stderr_text:
                 if stderr_text[-1] == '\n':
                     stderr_text = stderr_text[:-1]
+                if dropped:
+                    stderr_text = ("[... %d bytes of stderr omitted ...]\n" %
+                                   dropped) + stderr_text
                 stat_line = stat_line + "\n  " + \
                     "\n  ".join(stderr_text.split('\n'))
             return stat_line
         finally:
             self._cond_var.release()
     def get_exit_status(self):
-        return [self._exit_status]
+        return [self._exit_status] * self._status_count
+    def get_resource_usage(self):
+        return [self._usage] * self._status_count
+
+class Task_byte_counter(Task):
+    """
+    Copies everything from one pipe to another in a background thread,
+    keeping count of the bytes in the *bytes_out* of a
+    :class:`Resource_usage`.  It doesn't stand for any command in the
+    pipeline, so it has no exit statuses of its own.
+    """
+    __slots__ = ['_running', '_usage']
+    def __init__(self, fd_in, fd_out, usage):
+        Task.__init__(self, "byte counter", None, None, None, False, False)
+        self._running = True
+        self._usage = usage
+        usage.bytes_out = 0
+        thread = threading.Thread(target=self._copy, args=(fd_in, fd_out),
+                                  name="netsa.util.shell byte counter")
+        thread.setDaemon(True)
+        thread.start()
+    def _copy(self, fd_in, fd_out):
+        try:
+            try:
+                count = 0
+                while True:
+                    try:
+                        data = os.read(fd_in, 65536)
+                    except OSError, e:
+                        if e.errno == errno.EINTR:
+                            continue
+                        raise
+                    if not data:
+                        break
+                    while data:
+                        try:
+                            n = os.write(fd_out, data)
+                        except OSError, e:
+                            if e.errno == errno.EINTR:
+                                continue
+                            raise
+                        data = data[n:]
+                        count += n
+                        self._usage.bytes_out = count
+            except OSError:
+                # The reader went away, so the writer will get SIGPIPE
+                # once we close our end.
+                pass
+        finally:
+            os.close(fd_in)
+            os.close(fd_out)
+            self._cond_var.acquire()
+            try:
+                self._running = False
+                self._notify_status_change()
+            finally:
+                self._cond_var.release()
+    def abort(self):
+        # Killing the processes on either side ends the copying
+        pass
+    def is_running(self):
+        self._cond_var.acquire()
+        try:
+            return self._running
+        finally:
+            self._cond_var.release()
+    def is_success(self):
+        return not self.is_running()
+    def get_status(self):
+        return ""
+    def get_exit_status(self):
+        return []
+    def get_resource_usage(self):
+        return []
 
 
 def _interpolate_vars(arg_list, vars):
@@ -594,63 +1084,167 @@ def _interpolate_vars(arg_list, vars):
     return [isinstance(x, basestring) and (x % vars) or x
             for x in arg_list]
 
+def _split_long_lines(lines, size):
+    # Splits any lines longer than size into pieces of that size
+    result = []
+    for line in lines:
+        while len(line) > size:
+            result.append(line[:size])
+            line = line[size:]
+        result.append(line)
+    return result
+
+def _command_name(args):
+    # A short name for a command, to label its output with
+    if callable(args[0]):
+        return getattr(args[0], '__name__', repr(args[0]))
+    return os.path.basename(args[0])
+
+def _stderr_logger_callback(logger, name):
+    # Log each line of stderr from the command called name as a
+    # warning, to a logging.Logger or the logger with the given name.
+    if isinstance(logger, basestring):
+        import logging
+        logger = logging.getLogger(logger)
+    def log_line(line):
+        logger.warning("%s: %s", name, line)
+    return log_line
+
 # Fork off a single child for a command
 # Returns a tuple (pid, ignore, ignore_status) to allow for ignoring
 # exit status if options indicate.
 def fork_child(task_group, command, stdin, stdout, stdout_append,
-               vars, defaults):
+               vars, defaults, status_count=1):
+    if not isinstance(command, CompiledCommand):
+        command = command.compile(defaults)
     # Apply substitutions
-    args = _interpolate_vars(command.argv, vars)
+    args = command.expand_argv(vars)
     if callable(args[0]):
         args = [args[0], vars] + args[1:]
-    stderr = command.get_options(defaults).get('stderr', None)
+    stderr = command.stderr
     if isinstance(stderr, basestring):
         stderr = stderr % vars
-    stderr_append = command.get_options(defaults).get('stderr_append', False)
-    ignore = command.get_options(defaults).get('ignore_exit_status', False)
-    ignore_status = command.get_options(defaults).get('ignore_exit_statuses',[])
-    ignore_exits = False
-    if ignore_status: ignore_exits = ignore_status
-    if ignore: ignore_exits = True
-    stdout_to_stderr = command.get_options(defaults) \
-        .get('stdout_to_stderr', False)
+    stderr_callback = command.stderr_callback
+    if command.stderr_logger is not None and stderr_callback is None:
+        stderr_callback = _stderr_logger_callback(command.stderr_logger,
+                                                  _command_name(args))
     # Fork an individual child in a pipeline
     task = Task_process(args, stdin, stdout, stderr,
-                        stdout_append, stderr_append, ignore_exits,
-                        stdout_to_stderr)
+                        stdout_append, command.stderr_append,
+                        command.ignore_exits, command.stdout_to_stderr,
+                        status_count, command.stderr_limit, stderr_callback)
     task.add_task_group(task_group)
     return task
 
+class _Stage_runner(object):
+    """
+    The function run by the single process for a run of adjacent
+    :func:`stage` commands.  The stages are chained together as
+    generators, fed the lines of stdin, and whatever comes out of the
+    last stage is written to stdout.
+    """
+    __slots__ = ['stages']
+    def __init__(self, stages):
+        # list of (function, argument list) pairs
+        self.stages = stages
+    def __repr__(self):
+        return ' | '.join(display_argv([f] + args)
+                          for (f, args) in self.stages)
+    def __call__(self, vars):
+        records = sys.stdin
+        for (f, args) in self.stages:
+            records = f(records, vars=vars, *args)
+        write = sys.stdout.write
+        for record in records:
+            if not isinstance(record, str):
+                record = "%s\n" % (record,)
+            write(record)
+
+def fork_stages(task_group, stages, stdin, stdout, stdout_append,
+                vars, defaults):
+    # Fuse a run of stages into a single child process.  The options
+    # of the first stage apply to the whole run.
+    stages = [cmd.compile(defaults) for cmd in stages]
+    stage_argvs = [cmd.expand_argv(vars) for cmd in stages]
+    runner = _Stage_runner([(argv[0], argv[1:]) for argv in stage_argvs])
+    return fork_child(task_group, stages[0].with_argv([runner]),
+                      stdin, stdout, stdout_append, vars, defaults,
+                      len(stages))
+
+def _command_runs(commands):
+    # Split a pipeline's commands into the groups that each get a
+    # process: every run of adjacent stages shares one, and every
+    # other command gets its own.
+    runs = []
+    for cmd in commands:
+        if cmd.is_stage and runs and runs[-1][-1].is_stage:
+            runs[-1].append(cmd)
+        else:
+            runs.append([cmd])
+    return runs
+
 # Fork off children for a pipeline, and return a Pipeline_waiter
 def fork_children(task_group, pipeline, vars={}, defaults={}):
-    commands = pipeline.commands
-    in_file = pipeline.get_options(defaults).get('stdin', '/dev/null')
+    pipeline = pipeline.compile(defaults)
+    in_file = pipeline.stdin
     if isinstance(in_file, basestring):
         in_file = in_file % vars
-    out_file = pipeline.get_options(defaults).get('stdout', '/dev/null')
+    out_file = pipeline.stdout
     if isinstance(out_file, basestring):
         out_file = out_file % vars
-    out_append = pipeline.get_options(defaults).get('stdout_append', False)
+    out_append = pipeline.stdout_append
+    # Descriptors which belong to us and haven't been handed over yet.
+    # An int stdin or stdout belongs to us, and is closed even if
+    # starting the pipeline fails.
+    owned_fds = set(fd for fd in (in_file, out_file) if isinstance(fd, int))
+    try:
+        _fork_runs(task_group, pipeline, in_file, out_file, out_append,
+                   vars, owned_fds)
+    except:
+        for fd in owned_fds:
+            os.close(fd)
+        raise
+
+def _fork_runs(task_group, pipeline, in_file, out_file, out_append, vars,
+               owned_fds):
     # fd of the output side of the last pipe that was opened
     last_pipe = None
-    for i, cmd in enumerate(commands):
+    runs = pipeline.runs
+    for i, run in enumerate(runs):
         if i == 0:
             # The first command's input is in_file
             stdin = in_file
         else:
             # All other commands read from the output side of the last command
             stdin = last_pipe
-        if i == len(commands) - 1:
+        if i == len(runs) - 1:
             # The last command's output is out_file
             stdout = out_file
         else:
             # Everybody else outputs to the input side of a fresh pipe
             (last_pipe, stdout) = os.pipe()
-        fork_child(task_group, cmd, stdin, stdout, out_append, vars, defaults)
+            owned_fds.update((last_pipe, stdout))
+        if run[0].is_stage:
+            task = fork_stages(task_group, run, stdin, stdout, out_append,
+                               vars, {})
+        else:
+            task = fork_child(task_group, run[0], stdin, stdout, out_append,
+                              vars, {})
         if isinstance(stdin, int):
+            owned_fds.discard(stdin)
             os.close(stdin)
         if isinstance(stdout, int):
+            owned_fds.discard(stdout)
             os.close(stdout)
+        if pipeline.count_bytes and i < len(runs) - 1:
+            # Count what goes through the pipe to the next command
+            (counted_pipe, counter_out) = os.pipe()
+            owned_fds.update((counted_pipe, counter_out))
+            counter = Task_byte_counter(last_pipe, counter_out,
+                                        task.get_resource_usage()[0])
+            owned_fds.difference_update((last_pipe, counter_out))
+            counter.add_task_group(task_group)
+            last_pipe = counted_pipe
 
 # Do not use this to make command lines for the shell.  It's intended
 # only for use in producing human-readable output.
@@ -720,6 +1314,12 @@ class CommandSpec(OptionHolder):
         else:
             return "command(%s, %s)" % (repr(display_argv(self.argv)),
                                         display_options(self.options))
+    def compile(self, defaults={}):
+        """
+        Returns a :class:`CompiledCommand` for this command, with its
+        options combined with *defaults*.
+        """
+        return CompiledCommand(self, defaults)
     def expand(self, vars, defaults):
         result = copy.copy(self)
         result.argv = list(result.argv)
@@ -734,6 +1334,20 @@ class CommandSpec(OptionHolder):
                 result.options['stderr'] = result.options['stderr'] % vars
         return result
 
+class StageSpec(CommandSpec):
+    __slots__ = []
+    def __init__(self, argv, options):
+        CommandSpec.__init__(self, argv, options)
+        if not callable(self.argv[0]):
+            msg = "First stage argument must be callable"
+            raise TypeError(msg, self.argv[0])
+    def __repr__(self):
+        if self.options == {}:
+            return "stage(%s)" % repr(display_argv(self.argv))
+        else:
+            return "stage(%s, %s)" % (repr(display_argv(self.argv)),
+                                      display_options(self.options))
+
 class PipelineSpec(OptionHolder):
     __slots__ = ['commands']
     def __init__(self, commands, options):
@@ -745,6 +1359,23 @@ class PipelineSpec(OptionHolder):
             if not isinstance(x, CommandSpec):
                 msg = "All items in a pipeline must be commands"
                 raise TypeError(msg, x)
+    def compile(self, defaults={}):
+        """
+        Returns a :class:`CompiledPipeline` for this pipeline, with its
+        options and those of its commands combined with *defaults*.
+        Compiling a pipeline once saves working out its options and
+        the layout of its arguments every time it is run.  Example::
+
+            p = pipeline("rwfilter --sensors=%(sensor)s ...",
+                         ">%(sensor)s.rw").compile()
+            for sensor in sensors:
+                run_parallel(p, vars={'sensor': sensor})
+
+        Options given when running a compiled pipeline (such as
+        the extra keyword arguments to :func:`run_parallel`) still
+        apply, but the pipeline is compiled again to apply them.
+        """
+        return CompiledPipeline(self, defaults)
     def __repr__(self):
         options = dict(self.options)
         if 'stdin' in options: del options['stdin']
@@ -762,6 +1393,116 @@ class PipelineSpec(OptionHolder):
                                                           stdout_append),
                                          display_options(options))
 
+# Matches variable references which might be argument list variables
+_arg_list_ref = re.compile(r'%\(([^)]*)\)s')
+
+class CompiledCommand(object):
+    """
+    A :func:`command` or :func:`stage` specification with its options
+    resolved, ready to be run many times with different variables.
+    Returned by the :meth:`compile` method of command specifications.
+    """
+    __slots__ = ['source', 'defaults', 'argv', 'is_stage', '_template',
+                 'stderr', 'stderr_append', 'ignore_exits',
+                 'stdout_to_stderr', 'stderr_limit', 'stderr_callback',
+                 'stderr_logger']
+    def __init__(self, command, defaults):
+        self.source = command
+        self.defaults = dict(defaults)
+        self.is_stage = isinstance(command, StageSpec)
+        self._set_argv(command.argv)
+        options = command.get_options(defaults)
+        self.stderr = options.get('stderr', None)
+        self.stderr_append = options.get('stderr_append', False)
+        ignore = options.get('ignore_exit_status', False)
+        ignore_status = options.get('ignore_exit_statuses', [])
+        self.ignore_exits = False
+        if ignore_status: self.ignore_exits = ignore_status
+        if ignore: self.ignore_exits = True
+        self.stdout_to_stderr = options.get('stdout_to_stderr', False)
+        self.stderr_limit = options.get('stderr_limit', STDERR_LIMIT)
+        self.stderr_callback = options.get('stderr_callback', None)
+        self.stderr_logger = options.get('stderr_logger', None)
+        if isinstance(self.stderr_logger, basestring):
+            import logging
+            self.stderr_logger = logging.getLogger(self.stderr_logger)
+    def _set_argv(self, argv):
+        self.argv = list(argv)
+        # For each argument: None if it needs no substitution,
+        # otherwise the names of any variables which could expand
+        # into argument lists.
+        self._template = []
+        for a in self.argv:
+            if isinstance(a, basestring) and '%' in a:
+                self._template.append((a, _arg_list_ref.findall(a)))
+            else:
+                self._template.append((a, None))
+    def with_argv(self, argv):
+        result = copy.copy(self)
+        result._set_argv(argv)
+        return result
+    def compile(self, defaults={}):
+        if not defaults:
+            return self
+        merged = dict(self.defaults)
+        merged.update(defaults)
+        return CompiledCommand(self.source, merged)
+    def expand_argv(self, vars):
+        """
+        Returns the argument vector with the variables in *vars*
+        substituted, as described for :func:`command`.
+        """
+        result = []
+        for (a, refs) in self._template:
+            if refs is None:
+                result.append(a)
+            elif [r for r in refs
+                  if hasattr(vars.get(r), 'get_argument_list')]:
+                # Rare: splice an argument list into the arguments
+                result.extend(_interpolate_vars([a], vars))
+            else:
+                result.append(a % vars)
+        return result
+    def __repr__(self):
+        return "%r.compile()" % (self.source,)
+
+class CompiledPipeline(object):
+    """
+    A :func:`pipeline` specification with all of its options and
+    those of its commands resolved, ready to be run many times with
+    different variables.  Returned by the :meth:`compile` method of
+    pipeline specifications, and may be used wherever a pipeline can.
+    """
+    __slots__ = ['source', 'defaults', 'commands', 'runs', 'stdin',
+                 'stdout', 'stdout_append', 'count_bytes']
+    def __init__(self, pipeline, defaults):
+        self.source = pipeline
+        self.defaults = dict(defaults)
+        # As when running an uncompiled pipeline, commands only get
+        # the defaults, not the pipeline's own options.
+        self.commands = [c.compile(defaults) for c in pipeline.commands]
+        self.runs = _command_runs(self.commands)
+        options = pipeline.get_options(defaults)
+        self.stdin = options.get('stdin', '/dev/null')
+        self.stdout = options.get('stdout', '/dev/null')
+        self.stdout_append = options.get('stdout_append', False)
+        self.count_bytes = options.get('count_bytes', False)
+    def compile(self, defaults={}):
+        """
+        Returns this pipeline compiled with more *defaults*, which
+        take precedence over those it was originally compiled with.
+        """
+        if not defaults:
+            return self
+        merged = dict(self.defaults)
+        merged.update(defaults)
+        return CompiledPipeline(self.source, merged)
+    def with_options(self, options):
+        return CompiledPipeline(self.source.with_options(options),
+                                self.defaults)
+    def __repr__(self):
+        return "%r.compile()" % (self.source,)
+
 def command(*argv, **options):
     """
     Interprets the arguments as a "command specification", and returns
@@ -811,6 +1552,21 @@ def command(*argv, **options):
       *ignore_exit_statuses*
         A list of numeric exit statuses that should not be considered
         errors when they are encountered.
+      *stderr_limit*
+        When *stderr* isn't given, stderr is collected to be reported
+        if the pipeline fails.  Only the last *stderr_limit* bytes are
+        kept.  (The default is ``STDERR_LIMIT``, which is 64 KiB.)
+      *stderr_callback*
+        When *stderr* isn't given, a function to be called with each
+        line of stderr (without its newline) as it arrives.  Lines
+        longer than *stderr_limit* are passed on in pieces of that
+        size.  It is called from a background thread, so it should not
+        block.
+      *stderr_logger*
+        When *stderr* isn't given, a :class:`logging.Logger` (or the
+        name of one) to log each line of stderr to as a warning, as it
+        arrives, labelled with the name of the program.  Ignored if
+        *stderr_callback* is given.
 
     In addition, these options may be "handed down" from the
     :func:`pipeline` call, or from :func:`run_parallel` or
@@ -932,6 +1688,68 @@ def command(*argv, **options):
     # items should be strings, separate items in argv.
     return CommandSpec(argv, options)
 
+def stage(*argv, **options):
+    """
+    Returns a "stage specification": a Python function to be run as a
+    command in a pipeline, which works on records rather than on the
+    bytes of stdin and stdout.  The arguments are the same as those of
+    :func:`command`, except that the first item of *argv* must be a
+    callable.
+
+    The function is called with an iterator over the records coming
+    into the stage as its first argument, the remainder of *argv* as
+    its remaining arguments, and *vars* (as given to
+    :func:`run_parallel` or :func:`run_collect`) as the keyword
+    argument `vars`.  It must return an iterable of the records going
+    out of the stage, and is usually a generator.
+
+    Adjacent stages in a pipeline are run together in a single forked
+    process, with the records passed directly from one function to the
+    next.  Records can therefore be any Python values, and are never
+    copied, converted to text, or sent through a pipe between stages.
+    Only the first and last stages of such a run talk to the outside:
+    the first receives the lines of its stdin (including their
+    newlines), and each record from the last is written to its stdout,
+    strings as they are and other values by :func:`str` followed by a
+    newline.
+
+    Because the stages of a run share a single process, the options
+    given to the first stage of a run (*stderr*, *ignore_exit_status*,
+    and so on) apply to the whole run, and every stage in the run is
+    reported with that process's exit status.  As with Python
+    functions given to :func:`command`, be aware of how objects behave
+    when the interpreter is forked.
+
+    Example: Total the bytes per source address in ``rwcut`` output,
+    with all of the Python work done in a single process::
+
+        def fields(lines, vars):
+            for line in lines:
+                yield line.rstrip('\\n').split('|')
+
+        def totals(records, vars):
+            result = {}
+            for (sip, nbytes) in records:
+                result[sip] = result.get(sip, 0) + int(nbytes)
+            for (sip, total) in sorted(result.iteritems()):
+                yield "%s %d\\n" % (sip.strip(), total)
+
+        # Shell: rwcut --fields=sip,bytes --no-titles --delimited \
+        #          --no-final-delimiter data.rw
+        #        | (python work) | sort -k2 -rn
+        (out, err) = run_collect(
+            "rwcut --fields=sip,bytes --no-titles --delimited"
+            " --no-final-delimiter data.rw",
+            stage(fields), stage(totals), "sort -k2 -rn")
+    """
+    # Already a stage spec?  Re-use, possibly with new options
+    if len(argv) == 1 and isinstance(argv[0], StageSpec):
+        return argv[0].with_options(options)
+    # A single list or tuple?  Treat it as the arguments
+    if len(argv) == 1 and isinstance(argv[0], (list, tuple)):
+        argv = argv[0]
+    return StageSpec(argv, options)
+
 def pipeline(*commands, **options):
     """
     Interprets the arguments as a "pipeline specification", and
@@ -972,6 +1790,13 @@ def pipeline(*commands, **options):
         ``True`` if *stdout* should be opened for append.  Does
         nothing if *stdout* is already an open file.
 
+      *count_bytes*
+        ``True`` if the number of bytes passed between each pair of
+        commands in the pipeline should be counted.  The counts are
+        found in the *bytes_out* of each command's
+        :class:`Resource_usage`.  This costs an extra copy of the
+        data, so is meant for profiling.
+
     Because these options are so common, they may also be given in
     short-hand form.  If the first command in the pipeline is a string
     starting with ``<``, the remainder of the string is intepreted as
@@ -1049,7 +1874,10 @@ def pipeline(*commands, **options):
 
     """
     # Already a pipeline spec?  Re-use, possibly with new options
-    if len(commands) == 1 and isinstance(commands[0], PipelineSpec):
+    if len(commands) == 1 and isinstance(commands[0],
+                                         (PipelineSpec, CompiledPipeline)):
+        if not options:
+            return commands[0]
         return commands[0].with_options(options)
     # A single list or tuple?  Treat it as the arguments
     if len(commands) == 1 and isinstance(commands[0], (list, tuple)):
@@ -1075,6 +1903,16 @@ def pipeline(*commands, **options):
 
 
 
+class Exit_statuses(list):
+    """
+    The exit statuses of a series of pipelines, as a list of lists,
+    with the matching :class:`Resource_usage` objects in *usage*.
+    """
+    __slots__ = ['usage']
+    def __init__(self, exit_statuses, usage):
+        list.__init__(self, exit_statuses)
+        self.usage = usage
+
 def run_parallel(*args, **options):
     """
     Runs a series of commands (as specified by the arguments provided)
@@ -1106,6 +1944,10 @@ def run_parallel(*args, **options):
     process is not run (e.g., because a process preceding it in the
     pipeline fails), the exit status will be `None`.
 
+    The result also has a `usage` attribute, which is a list of lists
+    of the same shape, holding a :class:`Resource_usage` describing
+    the CPU time, memory, and wall-clock time used by each process.
+
     Example: Run three mkdirs in parallel and fail if any of them fails::
 
         # Shell: mkdir a & mkdir b & mkdir c & wait
@@ -1138,6 +1980,15 @@ def run_parallel(*args, **options):
                              ["cat /etc/passwd", "sort -r", "cut -f1 -d:"])
         # If all complete successfully, exits will be:
         #  [[0, 0], [0, 0, 0]]
+
+    Example: find out which command of a pipeline used the most CPU,
+    and how much data went into the last one::
+
+        exits = run_parallel(["rwfilter ...", "rwuniq ...", "sort"],
+                             count_bytes=True)
+        usage = exits.usage[0]
+        slowest = max(range(3), key=lambda i: usage[i].utime + usage[i].stime)
+        sorted_bytes = usage[1].bytes_out
     """
 
     # By default, provide no substitutions
@@ -1168,7 +2019,9 @@ def run_parallel(*args, **options):
     for p in pipelines:
         fork_children(task_group, p, vars, options)
     task_group.wait()
-    exit_statuses = chew_exit_statuses(task_group.get_exit_status())
+    exit_statuses = Exit_statuses(
+        chew_exit_statuses(task_group.get_exit_status()),
+        chew_exit_statuses(task_group.get_resource_usage()))
     if not task_group.is_success():
         # It failed, raise an exception
         pipeline_failure = \
@@ -1178,6 +2031,285 @@ def run_parallel(*args, **options):
     else:
         return exit_statuses
 
+def _split_exit_statuses(p, statuses):
+    # Exit statuses for the commands of pipeline p, with None for any
+    # command that was never started.
+    statuses = list(statuses[:len(p.commands)])
+    return statuses + [None] * (len(p.commands) - len(statuses))
+
+def run_pool(pipelines, max_workers=None, vars_iter=None, fail_fast=True,
+             **options):
+    """
+    Runs a series of pipelines like :func:`run_parallel`, but with at
+    most *max_workers* pipelines running at any one time.  Each item of
+    *pipelines* is passed to the :func:`pipeline` function, and
+    *pipelines* may be any iterable, including a generator.  Pipelines
+    are started in order, each as soon as there is room for it.
+
+    If *vars_iter* is given, it is an iterable of variable substitution
+    dictionaries, one for each pipeline, used in the same way as the
+    *vars* option to :func:`run_parallel`.  If *pipelines* is a single
+    pipeline (a :func:`pipeline` or a :class:`str`) rather than a
+    sequence of pipelines, it is run once for each item of
+    *vars_iter*.  Each dictionary is combined with the *vars* option,
+    if that is given, with its own values taking precedence.
+
+    If *max_workers* is ``None``, the number of CPUs is used.
+
+    :func:`run_pool` is a generator.  As each pipeline finishes, it
+    yields a tuple (`index`, `exit_statuses`, `error`), where `index`
+    is the position of the pipeline in *pipelines* (or of its
+    variables in *vars_iter*), `exit_statuses` is the list of exit
+    statuses of the pipeline's processes, as in the result of
+    :func:`run_parallel`, and `error` is ``None`` if the pipeline
+    succeeded.
+
+    If *fail_fast* is ``True`` (the default), the first pipeline to
+    fail stops everything: no more pipelines are started, any which
+    are running are killed off, and a :exc:`PipelineException` is
+    raised for the failed pipeline.  If *fail_fast* is ``False``,
+    failures are yielded with `error` set to a
+    :exc:`PipelineException`, and the remaining pipelines still run.
+
+    If the generator is closed before it is exhausted, any pipelines
+    that are still running are killed off.
+
+    Additional keyword arguments will be passed down as default values
+    to the :func:`pipeline` and :func:`command` specifications, as in
+    :func:`run_parallel`.
+
+    Example: Pull the data for each sensor, four sensors at a time::
+
+        for (i, exits, error) in run_pool(
+                "rwfilter --sensors=%(sensor)s --type=all "
+                "--start-date=%(date)s --pass=%(sensor)s.rw",
+                max_workers=4,
+                vars={'date': '2016/05/24'},
+                vars_iter=({'sensor': s} for s in sensors)):
+            print "finished", sensors[i]
+
+    Example: Run a list of pipelines two at a time, and report the
+    ones that fail instead of stopping::
+
+        for (i, exits, error) in run_pool(jobs, max_workers=2,
+                                          fail_fast=False):
+            if error:
+                print "job %d failed:" % i, error
+    """
+    vars = options.pop('vars', {})
+    if max_workers is None:
+        try:
+            import multiprocessing
+            max_workers = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            max_workers = 1
+    if max_workers < 1:
+        value_error = ValueError("max_workers must be at least 1")
+        raise value_error
+
+    if isinstance(pipelines, (basestring, PipelineSpec, CompiledPipeline)):
+        # A single pipeline, to be run once per set of variables
+        if vars_iter is None:
+            pipelines = [pipelines]
+        else:
+            pipelines = itertools.repeat(pipelines)
+    if vars_iter is None:
+        jobs = ((x, vars) for x in pipelines)
+    else:
+        def merge_vars(job_vars):
+            merged = dict(vars)
+            merged.update(job_vars)
+            return merged
+        jobs = ((x, merge_vars(v))
+                for (x, v) in itertools.izip(pipelines, vars_iter))
+
+    # Groups put their index here when they run out of running tasks.
+    # A group may report more than once (for example if its first
+    # command exits before the rest have been started), so the report
+    # is checked against the group itself before being believed.
+    idle = Queue.Queue()
+    # index -> (pipeline, task_group) for pipelines not yet reported
+    running = {}
+    jobs = enumerate(jobs)
+    jobs_left = True
+    try:
+        while jobs_left or running:
+            while jobs_left and len(running) < max_workers:
+                try:
+                    (index, (p, job_vars)) = jobs.next()
+                except StopIteration:
+                    jobs_left = False
+                    break
+                p = pipeline(p)
+                task_group = Task_group(
+                    on_idle=lambda g, index=index: idle.put(index))
+                running[index] = (p, task_group)
+                fork_children(task_group, p, job_vars, options)
+            if not running:
+                break
+            index = idle.get()
+            if index not in running:
+                continue
+            (p, task_group) = running[index]
+            if task_group.is_running():
+                continue
+            del running[index]
+            exit_statuses = _split_exit_statuses(
+                p, task_group.get_exit_status())
+            error = None
+            if not task_group.is_success():
+                error = PipelineException("Failure processing pipeline\n" +
+                                          task_group.get_status(),
+                                          exit_statuses)
+                if fail_fast:
+                    raise error
+            yield (index, exit_statuses, error)
+    finally:
+        # Failure, early close, or a keyboard interrupt: kill off
+        # whatever is still running.
+        for (p, task_group) in running.itervalues():
+            task_group.abort()
+        for (p, task_group) in running.itervalues():
+            task_group.wait()
+
+class Pipeline_stream(object):
+    """
+    A readable stream over the stdout of the last command of a running
+    pipeline, as returned by :func:`run_stream`.
+    """
+    __slots__ = ['_task_group', '_pipeline', '_file', '_done']
+    def __init__(self, task_group, p, f):
+        self._task_group = task_group
+        self._pipeline = p
+        self._file = f
+        self._done = False
+    def fileno(self):
+        return self._file.fileno()
+    def read(self, size=-1):
+        data = self._file.read(size)
+        if not data and size != 0:
+            self._finish()
+        return data
+    def readline(self, size=-1):
+        line = self._file.readline(size)
+        if not line and size != 0:
+            self._finish()
+        return line
+    def __iter__(self):
+        return self
+    def next(self):
+        line = self._file.readline()
+        if not line:
+            self._finish()
+            raise StopIteration
+        return line
+    def _finish(self):
+        # End of output: wait for the pipeline and check how it went
+        if self._done:
+            return
+        self._done = True
+        self._file.close()
+        self._task_group.wait()
+        if not self._task_group.is_success():
+            exit_statuses = _split_exit_statuses(
+                self._pipeline, self._task_group.get_exit_status())
+            pipeline_failure = \
+                PipelineException("Failure processing pipeline\n" +
+                                  self._task_group.get_status(),
+                                  [exit_statuses])
+            raise pipeline_failure
+    def close(self):
+        """
+        Stops reading.  If the pipeline is still running, it is killed
+        off.  Waits for the pipeline's processes to exit, but does not
+        check their exit statuses.
+        """
+        if self._done:
+            return
+        self._done = True
+        self._file.close()
+        if self._task_group.is_running():
+            self._task_group.abort()
+        self._task_group.wait()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def run_stream(*args, **options):
+    """
+    Runs a series of commands specifying a single pipeline, like
+    :func:`run_collect`, but returns as soon as the pipeline has been
+    started.  The result is a readable stream over the output of the
+    final command, which can be read while the pipeline runs, without
+    the output being stored anywhere first.
+
+    The stream has the usual :meth:`read`, :meth:`readline`,
+    :meth:`fileno` and :meth:`close` methods, and can be iterated over
+    line by line.  When the end of the output is reached, the stream
+    waits for the pipeline to finish and raises
+    :exc:`PipelineException` if any command failed.  Closing the
+    stream before the end of the output kills off the pipeline.  The
+    stream can also be used in a ``with`` statement, which closes it
+    at the end.
+
+    stderr is collected as in :func:`run_parallel`, and reported in
+    the :exc:`PipelineException` if there is a failure.
+
+    Example: Count the lines of ``rwcut`` output that mention port
+    80, without keeping the output::
+
+        # Shell: rwcut --fields=sport,dport data.rw | grep -c '|80|'
+        count = 0
+        with run_stream("rwcut --fields=sport,dport data.rw") as f:
+            for line in f:
+                if '|80|' in line:
+                    count += 1
+
+    """
+    vars = options.pop('vars', {})
+    p = pipeline(*args)
+    (pipe_out, pipe_in) = os.pipe()
+    task_group = Task_group()
+    try:
+        # fork_children closes pipe_in, even if it fails
+        fork_children(task_group,
+                      p.with_options({'stdout': pipe_in,
+                                      'stdout_append': False}),
+                      vars, options)
+    except:
+        os.close(pipe_out)
+        task_group.abort()
+        task_group.wait()
+        raise
+    return Pipeline_stream(task_group, p, os.fdopen(pipe_out, 'rb'))
+
+def run_iter(*args, **options):
+    """
+    Runs a series of commands specifying a single pipeline, like
+    :func:`run_stream`, and returns an iterator over the lines of
+    output of the final command as they are produced.
+
+    Exit statuses are checked once every line has been read, and
+    :exc:`PipelineException` is raised from the iterator if any
+    command failed.  If the iterator is closed (or garbage collected)
+    before that, the pipeline is killed off instead.
+
+    Example: Print the names of the largest files as ``sort`` finds
+    them::
+
+        # Shell: ls -s | sort -rn | head -5
+        for line in run_iter("ls -s", "sort -rn", "head -5"):
+            print line.split()[1]
+
+    """
+    stream = run_stream(*args, **options)
+    try:
+        for line in stream:
+            yield line
+    finally:
+        stream.close()
+
 def run_collect_files(*args, **options):
     """
     Runs a series of commands like :func:`run_collect`, but returns
@@ -1203,9 +2335,16 @@ def run_collect_files(*args, **options):
         run_parallel(pipeline(*args), **options)
     except PipelineException, e:
         msg = e.get_message()
+        # Only the last STDERR_LIMIT bytes of stderr are reported
         stderr_tmp.flush()
-        stderr_tmp.seek(0)
-        msg = "\n".join(filter(None, [msg, stderr_tmp.read().strip()]))
+        stderr_tmp.seek(0, 2)
+        dropped = max(stderr_tmp.tell() - STDERR_LIMIT, 0)
+        stderr_tmp.seek(dropped)
+        stderr_text = stderr_tmp.read().strip()
+        if dropped and stderr_text:
+            stderr_text = ("[... %d bytes of stderr omitted ...]\n" %
+                           dropped) + stderr_text
+        msg = "\n".join(filter(None, [msg, stderr_text]))
         raise PipelineException(msg, e.get_exit_statuses())
     # Seek back to the start of the temporary files
     stdout_tmp.seek(0)
@@ -1267,9 +2406,13 @@ __all__ = """
     PipelineException
 
     command
+    stage
     pipeline
 
     run_parallel
+    run_pool
+    run_stream
+    run_iter
     run_collect
     run_collect_files
 
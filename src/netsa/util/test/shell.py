@@ -1,10 +1,15 @@
 # Copyright 2008-2016 by Carnegie Mellon University
 # See license information in LICENSE-OPENSOURCE.txt
 
+import os
+import sys
+import threading
+import time
 import unittest
 
 from netsa.files import get_temp_file_name, get_temp_pipe_name
 from netsa.util.shell import *
+from netsa.util.shell import STDERR_LIMIT
 
 class ShellTest(unittest.TestCase):
 
@@ -84,3 +89,246 @@ class ShellTest(unittest.TestCase):
         self.assertEqual(stdout.read(), "bar\nfoo\n")
         stdout.close()
         stderr.close()
+
+    def test_run_parallel_stderr(self):
+        try:
+            run_parallel(["sh -c 'echo oops >&2; exit 3'"])
+        except PipelineException, e:
+            self.assert_("exit(3)" in e.get_message())
+            self.assert_("oops" in e.get_message())
+            self.assertEqual(e.get_exit_statuses(), [[3 << 8]])
+        else:
+            self.fail("PipelineException not raised")
+
+    def test_run_parallel_threads(self):
+        # The number of threads must not grow with the number of
+        # processes being run.
+        run_parallel("true")
+        base_threads = threading.activeCount()
+        max_threads = [0]
+        done = []
+        def watch():
+            while not done:
+                max_threads[0] = max(max_threads[0],
+                                     threading.activeCount())
+                time.sleep(0.01)
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            run_parallel(*[["sleep 0.2", "cat", "cat"]] * 10)
+        finally:
+            done.append(True)
+            watcher.join()
+        self.assert_(max_threads[0] <= base_threads + 1)
+
+    def test_run_collect_closes_fds(self):
+        # Descriptors open in the parent must not leak into children.
+        f = open(get_temp_file_name(), 'w')
+        fd = f.fileno()
+        def check_fd(vars):
+            try:
+                os.fstat(fd)
+                print "open"
+            except OSError:
+                print "closed"
+        try:
+            (stdout, stderr) = run_collect(command(check_fd))
+        finally:
+            f.close()
+        self.assertEqual(stdout, "closed\n")
+
+    def test_run_pool_1(self):
+        f1 = get_temp_file_name()
+        f2 = get_temp_file_name()
+        results = list(run_pool([["echo %(x)s", ">%(f)s"]], max_workers=1,
+                                vars_iter=[{"x": "foo", "f": f1},
+                                           {"x": "bar", "f": f2}]))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0], (0, [0], None))
+        self.assertEqual(open(f1, "r").read(), "foo\n")
+        results = sorted(run_pool(pipeline("echo %(x)s", ">%(f)s"),
+                                  max_workers=1,
+                                  vars_iter=[{"x": "foo", "f": f1},
+                                             {"x": "bar", "f": f2}]))
+        self.assertEqual(results, [(0, [0], None), (1, [0], None)])
+        self.assertEqual(open(f2, "r").read(), "bar\n")
+        # A compiled pipeline is also run once per set of variables
+        results = sorted(run_pool(pipeline("echo %(x)s", ">%(f)s").compile(),
+                                  vars_iter=[{"x": "baz", "f": f1},
+                                             {"x": "qux", "f": f2}]))
+        self.assertEqual(results, [(0, [0], None), (1, [0], None)])
+        self.assertEqual(open(f1, "r").read(), "baz\n")
+        self.assertEqual(open(f2, "r").read(), "qux\n")
+
+    def test_run_pool_2(self):
+        # At most max_workers pipelines run at once
+        start = time.time()
+        results = list(run_pool(["sleep 0.2"] * 4, max_workers=2))
+        self.assert_(time.time() - start >= 0.4)
+        self.assertEqual(sorted(i for (i, exits, error) in results),
+                         [0, 1, 2, 3])
+
+    def test_run_pool_3(self):
+        results = sorted(run_pool("sh -c 'exit %(x)s'", fail_fast=False,
+                                  vars_iter=[{"x": "0"}, {"x": "3"}]))
+        self.assertEqual(results[0], (0, [0], None))
+        self.assertEqual(results[1][:2], (1, [3 << 8]))
+        self.assert_(isinstance(results[1][2], PipelineException))
+        start = time.time()
+        self.assertRaises(
+            PipelineException, list,
+            run_pool(["sleep 10", "false", "sleep 10"], max_workers=3))
+        self.assert_(time.time() - start < 5)
+
+    def test_run_iter_1(self):
+        lines = list(run_iter("seq 1 1000", "sort -rn"))
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[0], "1000\n")
+        try:
+            list(run_iter("sh -c 'echo foo; exit 2'"))
+        except PipelineException, e:
+            self.assertEqual(e.get_exit_statuses(), [[2 << 8]])
+        else:
+            self.fail("PipelineException not raised")
+
+    def test_run_iter_2(self):
+        # Closing early kills off the pipeline
+        start = time.time()
+        lines = run_iter("yes", "cat")
+        self.assertEqual(lines.next(), "y\n")
+        lines.close()
+        self.assert_(time.time() - start < 5)
+
+    def test_run_stream_1(self):
+        f = run_stream(["echo %(x)s", "cat"], vars={"x": "foo"})
+        try:
+            self.assertEqual(f.readline(), "foo\n")
+            self.assertEqual(f.read(), "")
+        finally:
+            f.close()
+
+    def test_run_stream_failure(self):
+        # Starting a pipeline can fail after some commands have
+        # started, and no descriptors should be left open when it does
+        fd_count = len(os.listdir("/dev/fd"))
+        for i in xrange(3):
+            self.assertRaises(
+                KeyError, run_stream, ["echo foo", "cat", "cat %(missing)s"])
+        self.assertEqual(len(os.listdir("/dev/fd")), fd_count)
+
+    def test_stage_1(self):
+        def to_ints(lines, vars):
+            for line in lines:
+                yield int(line)
+        def scale(records, factor, vars):
+            for x in records:
+                yield (x * int(factor), os.getpid())
+        def tagged(records, vars):
+            for (x, pid) in records:
+                yield "%d %d\n" % (x, pid)
+        (stdout, stderr) = run_collect(
+            "seq 1 3", stage(to_ints), stage(scale, "%(n)s"), stage(tagged),
+            "cat", vars={"n": "2"})
+        lines = [line.split() for line in stdout.splitlines()]
+        self.assertEqual([x for (x, pid) in lines], ["2", "4", "6"])
+        # All of the stages ran in the same process
+        self.assertEqual(len(set(pid for (x, pid) in lines)), 1)
+
+    def test_stage_2(self):
+        # Fused stages still get one exit status per command
+        def same(records, vars):
+            return records
+        def fail(records, vars):
+            raise ValueError("bad")
+        self.assertEqual(
+            run_parallel(["echo", stage(same), stage(same), "cat"]),
+            [[0, 0, 0, 0]])
+        try:
+            run_parallel([stage(fail), stage(same), "cat"])
+        except PipelineException, e:
+            self.assertEqual(e.get_exit_statuses()[0][:2], [255 << 8] * 2)
+            self.assert_("ValueError" in e.get_message())
+        else:
+            self.fail("PipelineException not raised")
+        self.assertRaises(TypeError, stage, "cat")
+
+    def test_stderr_limit(self):
+        try:
+            run_parallel([command("sh -c 'seq 1 20000 >&2; exit 1'",
+                                  stderr_limit=100)])
+        except PipelineException, e:
+            message = e.get_message()
+            self.assert_("bytes of stderr omitted" in message)
+            self.assert_("\n  20000" in message)
+            self.assert_("\n  1\n" not in message)
+            self.assert_(len(message) < 400)
+        else:
+            self.fail("PipelineException not raised")
+        try:
+            run_collect("sh -c 'seq 1 200000 >&2; exit 1'")
+        except PipelineException, e:
+            message = e.get_message()
+            self.assert_("bytes of stderr omitted" in message)
+            self.assert_(message.endswith("\n200000"))
+            self.assert_(len(message) < STDERR_LIMIT + 1024)
+        else:
+            self.fail("PipelineException not raised")
+
+    def test_stderr_callback(self):
+        lines = []
+        run_parallel([command("sh -c 'echo foo >&2; printf bar >&2'",
+                              stderr_callback=lines.append)])
+        self.assertEqual(lines, ["foo", "bar"])
+
+    def test_stderr_callback_long_lines(self):
+        lines = []
+        run_parallel([command("sh -c 'printf \"%%05000d\\n\" 0 >&2; "
+                              "head -c 20000 /dev/zero >&2'",
+                              stderr_callback=lines.append,
+                              stderr_limit=4096)])
+        self.assert_(max(len(line) for line in lines) <= 4096)
+        self.assertEqual([len(line) for line in lines[:2]], [4096, 904])
+        self.assertEqual(sum(len(line) for line in lines[2:]), 20000)
+
+    def test_stderr_logger(self):
+        import logging
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+        logger = logging.getLogger("netsa.util.test.shell.stderr")
+        logger.propagate = False
+        logger.addHandler(Handler())
+        run_parallel([command(lambda vars: sys.stderr.write("oops\n"),
+                              stderr_logger=logger)],
+                     vars={"big": "x" * 1000})
+        self.assertEqual(records, ["<lambda>: oops"])
+
+    def test_resource_usage(self):
+        exits = run_parallel(["seq 1 1000", "cat", "cat"], ["true"],
+                             count_bytes=True)
+        self.assertEqual(exits, [[0, 0, 0], [0]])
+        self.assertEqual([len(u) for u in exits.usage], [3, 1])
+        (seq_usage, cat_usage, last_usage) = exits.usage[0]
+        self.assertEqual(seq_usage.bytes_out, 3893)
+        self.assertEqual(cat_usage.bytes_out, 3893)
+        self.assertEqual(last_usage.bytes_out, None)
+        for usage in exits.usage[0] + exits.usage[1]:
+            self.assert_(usage.get_wall_time() >= 0)
+            self.assert_(usage.utime >= 0 and usage.stime >= 0)
+            self.assert_(usage.maxrss > 0)
+
+    def test_compiled_pipeline(self):
+        f1 = get_temp_file_name()
+        f2 = get_temp_file_name()
+        p = pipeline("echo %(x)s", "cat", ">%(f)s").compile()
+        self.assertEqual(run_parallel(p, vars={"x": "foo", "f": f1}),
+                         [[0, 0]])
+        run_parallel(p, vars={"x": "bar", "f": f2})
+        self.assertEqual(open(f1, "r").read(), "foo\n")
+        self.assertEqual(open(f2, "r").read(), "bar\n")
+        # Run-time defaults still apply to options left unset
+        p = pipeline("echo %(x)s", "cat").compile()
+        self.assertEqual(run_collect(p, vars={"x": "baz"}), ("baz\n", ""))
+        p = pipeline(command("false", ignore_exit_status=True)).compile()
+        self.assertEqual(run_parallel(p), [[1 << 8]])